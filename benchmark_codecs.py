@@ -0,0 +1,136 @@
+import argparse
+import timeit
+
+from communicate import CODECS, decode_payload
+
+
+# Сообщения, которые чаще всего передаются во время игры.
+MESSAGES = {
+    '<B1-Motion>': {
+        'type': 'event',
+        'event': {'type': '<B1-Motion>', 'x': 331, 'y': 268}
+    },
+    '<Button-1>': {
+        'type': 'event',
+        'event': {'type': '<Button-1>', 'x': 331, 'y': 268}
+    },
+    '<ButtonRelease-1>': {
+        'type': 'event',
+        'event': {'type': '<ButtonRelease-1>', 'x': 331, 'y': 268}
+    },
+    # События с номерами, которые клиент отправляет, пока предсказывает
+    # положение схваченного кубика.
+    '<B1-Motion> seq': {
+        'type': 'event',
+        'seq': 1042,
+        'event': {'type': '<B1-Motion>', 'x': 331, 'y': 268}
+    },
+    '<Button-1> seq': {
+        'type': 'event',
+        'seq': 1042,
+        'event': {'type': '<Button-1>', 'x': 331, 'y': 268}
+    },
+    '<ButtonRelease-1> seq': {
+        'type': 'event',
+        'seq': 1042,
+        'event': {'type': '<ButtonRelease-1>', 'x': 331, 'y': 268}
+    },
+    'add_cubes': {
+        'type': 'command',
+        'command': {
+            'type': 'add_cubes',
+            'version': 1042,
+            'cubes': [
+                (id_, 300 + id_, 200 + id_, 45, id_, id_)
+                for id_ in range(1, 101)
+            ]
+        }
+    },
+    'remove_cube': {
+        'type': 'command',
+        'command': {'type': 'remove_cube', 'id': 7}
+    },
+    'delta': {
+        'type': 'command',
+        'command': {
+            'type': 'delta',
+            'version': 1042,
+            'base': 1040,
+            'cubes': [(id_, 300 + id_, 200 + id_) for id_ in range(1, 11)]
+        }
+    },
+    'ack': {'type': 'ack', 'version': 1042},
+    'viewport': {
+        'type': 'viewport', 'x1': 1200, 'y1': 800, 'x2': 2000, 'y2': 1400},
+    'motion': {'type': 'motion', 'seq': 1042, 'x': 331, 'y': 268},
+    'input_ack': {
+        'type': 'command',
+        'command': {
+            'type': 'input_ack', 'seq': 1042, 'version': 1042, 'id': 7,
+            'x': 312, 'y': 245
+        }
+    },
+}
+
+
+def get_app_args():
+    parser = argparse.ArgumentParser(
+        "Сравнение размера сообщений и скорости кодирования и декодирования "
+        "для кодеков из `communicate.CODECS`."
+    )
+    parser.add_argument(
+        "--number",
+        "-n",
+        help="Число повторений каждой операции. Значение по умолчанию "
+             "100000.",
+        type=int,
+        default=100000
+    )
+    return parser.parse_args()
+
+
+# Размеры сообщений в кодеке 'binary'. Если сообщение перестало
+# кодироваться `struct` и кодируется `pickle`, его размер заметно растет,
+# и бенчмарк останавливается.
+BINARY_SIZES = {
+    '<B1-Motion>': 9,
+    '<Button-1>': 9,
+    '<ButtonRelease-1>': 9,
+    '<B1-Motion> seq': 13,
+    '<Button-1> seq': 13,
+    '<ButtonRelease-1> seq': 13,
+    'remove_cube': 5,
+    'delta': 129,
+    'ack': 5,
+    'viewport': 17,
+    'motion': 13,
+    'input_ack': 21,
+}
+
+
+def main():
+    args = get_app_args()
+    print("{:<24}{:<10}{:>8}{:>14}{:>14}".format(
+        'сообщение', 'кодек', 'байт', 'encode, оп/с', 'decode, оп/с'))
+    for msg_name, msg in MESSAGES.items():
+        for codec_name, codec in CODECS.items():
+            payload = codec.encode(msg)
+            assert decode_payload(payload) == msg
+            if codec_name == 'binary' and msg_name in BINARY_SIZES:
+                assert len(payload) == BINARY_SIZES[msg_name], \
+                    (msg_name, len(payload))
+            encode_time = timeit.timeit(
+                lambda: codec.encode(msg), number=args.number)
+            decode_time = timeit.timeit(
+                lambda: decode_payload(payload), number=args.number)
+            print("{:<24}{:<10}{:>8}{:>14.0f}{:>14.0f}".format(
+                msg_name,
+                codec_name,
+                len(payload),
+                args.number / encode_time,
+                args.number / decode_time
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,52 @@
 import argparse
+import bisect
+import errno
+import os
+import select
 import socket
+import time
 import tkinter as tk
 import warnings
 
 import colors
+from schema import COMMAND_SCHEMAS, find_schema
+from transport import parse_address, make_tcp_address, \
+    create_client_socket, get_addr
 
-from communicate import send_data_quite, recv_data, CorruptedMessageError, \
-    MIN_PORT_NUMBER, MAX_PORT_NUMBER, DEFAULT_PORT_NUMBER
+from communicate import StreamFramer, OutboundQueue, CorruptedMessageError, \
+    dequantize_coord, warn_no_msg_was_sent, \
+    CONNECTION_ABORTED_ERROR_WARNING_TMPL, \
+    MIN_PORT_NUMBER, MAX_PORT_NUMBER, DEFAULT_PORT_NUMBER, \
+    MAX_ROOM_NAME_LENGTH, DEFAULT_ROLE, make_hello_msg, \
+    get_hello_ack_encoding, encode_frame, decode_datagram, DECODING_ERRORS, \
+    MAX_DATAGRAM_SIZE, SERVER_DATAGRAM_TAGS
 
 
+# Интервал опроса сокетов там, где Tk не поддерживает обработчики файлов
+# (`createfilehandler()`), например, в Windows.
 DT_MS = 30
+# Интервал между сообщениями 'heartbeat', по которым сервер определяет, что
+# соединение с клиентом не потеряно.
+HEARTBEAT_INTERVAL_MS = 5000
+# Датаграммы 'udp_hello' отправляются с этим интервалом, пока сервер не
+# ответит, но не больше `UDP_HELLO_MAX_ATTEMPTS` раз. Если ответа нет,
+# все сообщения передаются по TCP.
+UDP_HELLO_INTERVAL_MS = 200
+UDP_HELLO_MAX_ATTEMPTS = 10
+# Минимальный интервал между перерисовками кубиков на холсте (примерно 60
+# кадров в секунду).
+FRAME_INTERVAL_MS = 16
+# Перемещения мышки с нажатой левой кнопкой отправляются серверу не чаще,
+# чем раз в `motion_interval` мс. Мышь с высокой частотой опроса порождает
+# сотни событий в секунду, а сервер применяет их раз в такт.
+DEFAULT_MOTION_INTERVAL_MS = 20
+MAX_MOTION_INTERVAL_MS = 1000
+# Время, за которое кубик переходит из предсказанного положения в
+# положение, исправленное по ответу сервера.
+CORRECTION_MS = 100
 WINDOW_SHAPE = (800, 600)
 MAX_NUM_PLAYERS = 10
+DEFAULT_ROOM_NAME = 'default'
 
 
 def get_app_args():
@@ -25,7 +60,9 @@ def get_app_args():
         "той же машине, на которой запущен сервер, то ip при запуске клиента "
         "можно не указывать. Программа может работать неправильно, если "
         "соединение было потеряно, а затем восстановлено. В таком случае "
-        "необходимо перезапустить этот скрипт.".format(MAX_NUM_PLAYERS)
+        "необходимо перезапустить этот скрипт. Если мир на сервере больше "
+        "окна, холст прокручивается клавишами со стрелками или перемещением "
+        "мышки с нажатой правой кнопкой.".format(MAX_NUM_PLAYERS)
     )
     parser.add_argument(
         '--server_ip',
@@ -45,11 +82,65 @@ def get_app_args():
         type=int,
         default=DEFAULT_PORT_NUMBER
     )
+    parser.add_argument(
+        "--server_address",
+        help="Адрес сервера: 'tcp://HOST:PORT' или 'unix://PATH', если "
+             "сервер запущен на той же машине с параметром `--address "
+             "unix://PATH`. Если задан, `--server_ip` и `--server_port` не "
+             "используются.",
+        default=None
+    )
+    parser.add_argument(
+        "--room",
+        "-r",
+        help="Название комнаты на сервере. Игроки в разных комнатах играют "
+             "в разных мирах. Значение по умолчанию '{}'.".format(
+                 DEFAULT_ROOM_NAME),
+        default=DEFAULT_ROOM_NAME
+    )
+    parser.add_argument(
+        "--spectator",
+        "-s",
+        help="Войти в комнату зрителем. Зритель видит весь мир, но не может "
+             "двигать кубики и не занимает места игрока. Зрители могут "
+             "подключаться как к серверу, так и к ретранслятору relay.py, "
+             "который позволяет наблюдать за игрой тысячам зрителей.",
+        action='store_true'
+    )
+    parser.add_argument(
+        "--no_udp",
+        help="Не использовать канал UDP, даже если сервер его "
+             "поддерживает. По умолчанию координаты кубиков и перемещения "
+             "мышки передаются по UDP, если сервер запущен с параметром "
+             "`--udp`, и потеря пакета не задерживает последующие "
+             "координаты.",
+        action='store_true'
+    )
+    parser.add_argument(
+        "--motion_interval",
+        help="Минимальный интервал в миллисекундах между сообщениями о "
+             "перемещении мышки. Из событий, произошедших за интервал, "
+             "отправляется последнее. Перед отпусканием кнопки всегда "
+             "отправляется последнее положение мышки. 0 -- отправлять "
+             "каждое событие. Разрешенные значения: 0 - {}. Значение по "
+             "умолчанию {}.".format(
+                 MAX_MOTION_INTERVAL_MS, DEFAULT_MOTION_INTERVAL_MS),
+        type=int,
+        default=DEFAULT_MOTION_INTERVAL_MS
+    )
     return parser.parse_args()
 
 
+# `self.x`, `self.y` -- последние координаты кубика, принятые от сервера,
+# `version` -- версия мира, которой они соответствуют. `self.coords` --
+# прямоугольник кубика на холсте в текущем кадре, `self.drawn_coords` --
+# прямоугольник, переданный холсту. Холст обновляется не при каждом
+# сообщении сервера, а раз в кадр (см. `CubeCanvasClient.render()`). К
+# новым координатам от сервера кубик движется плавно в течение такта
+# сервера (`self.glide`), а кубик, который тащит игрок, рисуется в
+# предсказанном положении (см. `DragPrediction`).
 class CubeClient:
-    def __init__(self, cube_canvas, id_, x, y, size, color):
+    def __init__(self, cube_canvas, id_, x, y, size, color, z, version=0):
         self.cube_canvas = cube_canvas
         self.server_addr = self.cube_canvas.get_root().server_addr
         self.server_id = id_
@@ -57,35 +148,132 @@ class CubeClient:
         self.y = y
         self.size = size
         self.color = color
+        self.z = z
+        self.version = version
+        self.coords = (self.x, self.y, self.x + self.size, self.y + self.size)
+        self.drawn_coords = self.coords
+        # Начальные и конечные координаты, время начала и длительность
+        # плавного перемещения или `None`.
+        self.glide = None
 
         self.id = self.cube_canvas.create_rectangle(
-            self.x,
-            self.y,
-            self.x + self.size,
-            self.y + self.size,
-            fill=self.color
-        )
+            *self.coords, fill=self.color)
         self.cube_canvas.cubes[self.id] = self
         self.cube_canvas.cubes_by_server_ids[self.server_id] = self
+        self.cube_canvas.insert_in_z_order(self)
+
+    def remove(self):
+        self.cube_canvas.remove_from_z_order(self)
+        self.cube_canvas.delete(self.id)
+        del self.cube_canvas.cubes[self.id]
+        del self.cube_canvas.cubes_by_server_ids[self.server_id]
+        self.cube_canvas.dirty_cubes.pop(self.id, None)
+        if self.cube_canvas.is_predicted(self):
+            self.cube_canvas.prediction = None
+
+    def set_position(self, x, y):
+        self.coords = (x, y, x + self.size, y + self.size)
+
+    # Вычисляет положение кубика в кадре `now` и передает его холсту, если
+    # оно изменилось. Возвращает `True`, если кубик еще движется и должен
+    # быть перерисован в следующем кадре.
+    def draw(self, now):
+        moving = False
+        if self.cube_canvas.is_predicted(self):
+            x, y, moving = self.cube_canvas.prediction.get_position(now)
+            self.set_position(x, y)
+        elif self.glide is not None:
+            start_x, start_y, x, y, start_time, duration = self.glide
+            progress = (now - start_time) / duration if duration > 0 else 1
+            if progress >= 1:
+                self.glide = None
+            else:
+                x = start_x + (x - start_x) * progress
+                y = start_y + (y - start_y) * progress
+                moving = True
+            self.set_position(x, y)
+        if self.coords != self.drawn_coords:
+            self.cube_canvas.coords(self.id, *self.coords)
+            self.drawn_coords = self.coords
+        return moving
+
+    # Кубик плавно перемещается из положения на холсте в (x, y).
+    def glide_to(self, x, y):
+        self.glide = (
+            self.coords[0], self.coords[1], x, y, time.monotonic(),
+            self.cube_canvas.get_interpolation_time()
+        )
+        self.cube_canvas.schedule_render(self)
+
+    def move_to(self, x, y, version):
+        self.version = version
+        self.x = x
+        self.y = y
+        # Положение кубика, который тащит игрок, предсказывается.
+        if not self.cube_canvas.is_predicted(self):
+            self.glide_to(x, y)
 
-    def button_1(self, event):
-        conn = self.cube_canvas.get_root().conn_to_server
-        msg = {
-            'type': 'event',
-            'event': {
-                'type': '<Button-1>',
-                'id': self.server_id,
-                'x': event.x,
-                'y': event.y
-            }
-        }
-        send_data_quite(conn, self.server_addr, msg)
 
-    def bind_button_1(self):
-        self.cube_canvas.tag_bind(self.id, '<Button-1>', self.button_1)
+# Предсказание положения кубика, который тащит игрок. Кубик сдвигается на
+# холсте сразу при перемещении мышки, не дожидаясь ответа сервера. Каждое
+# событие отправляется с номером, и в конце такта сервер сообщает номер
+# последнего обработанного события и координаты кубика после его обработки
+# ('input_ack'). Предсказанное положение -- эти координаты (`self.anchor`),
+# сдвинутые на перемещение мышки после события с этим номером. Если
+# предсказание разошлось с сервером, расхождение (`self.correction`)
+# исчезает постепенно за `CORRECTION_MS` мс.
+class DragPrediction:
+    def __init__(self, cube, x, y, seq):
+        self.cube = cube
+        self.first_seq = seq
+        self.release_seq = None
+        self.anchor = (cube.x, cube.y)
+        self.anchor_pointer = (x, y)
+        self.pointer = (x, y)
+        # Ключи -- номера отправленных событий, не подтвержденных
+        # сервером, значения -- координаты мышки в этих событиях.
+        self.pointers = {seq: (x, y)}
+        self.correction = (0, 0)
+        self.correction_start_time = 0
 
-    def set_coords(self, x1, y1, x2, y2):
-        self.cube_canvas.coords(self.id, x1, y1, x2, y2)
+    def add_input(self, seq, x, y):
+        self.pointer = (x, y)
+        self.pointers[seq] = (x, y)
+
+    def get_predicted_position(self):
+        return (
+            self.anchor[0] + self.pointer[0] - self.anchor_pointer[0],
+            self.anchor[1] + self.pointer[1] - self.anchor_pointer[1]
+        )
+
+    # Возвращает координаты кубика в момент `now` и `True`, если
+    # расхождение с сервером еще не исчезло.
+    def get_position(self, now):
+        x, y = self.get_predicted_position()
+        remaining = 1 - (now - self.correction_start_time) \
+            / (CORRECTION_MS / 1000)
+        if remaining <= 0:
+            return x, y, False
+        return (
+            x + self.correction[0] * remaining,
+            y + self.correction[1] * remaining,
+            True
+        )
+
+    def reconcile(self, seq, x, y, now):
+        pointer = self.pointers.get(seq)
+        if pointer is None:
+            return
+        old_x, old_y, _ = self.get_position(now)
+        self.anchor = (x, y)
+        self.anchor_pointer = pointer
+        self.pointers = {
+            seq_: pointer for seq_, pointer in self.pointers.items()
+            if seq_ > seq
+        }
+        new_x, new_y = self.get_predicted_position()
+        self.correction = (old_x - new_x, old_y - new_y)
+        self.correction_start_time = now
 
 
 class CubeCanvasClient(tk.Canvas):
@@ -94,17 +282,82 @@ class CubeCanvasClient(tk.Canvas):
 
         self.server_addr = self.get_root().server_addr
 
-        self.supported_command_types = ['add_cube', 'coords', 'bind_all']
-        self.command_keys = {
-            'add_cube': {'type', 'id', 'x', 'y', 'size', 'color'},
-            'coords': {'type', 'id', 'x1', 'y1', 'x2', 'y2'},
-            'bind_all': {'type'}
-        }
-
         self.num_cubes = 0
+        # Последняя версия мира, координаты из которой применены.
+        # Сообщения 'delta' с меньшей версией устарели: их могли обогнать
+        # датаграммы UDP.
+        self.version = 0
         # Ключи в словаре -- id объектов.
         self.cubes = {}
         self.cubes_by_server_ids = {}
+        # Пары ('z', id объекта) кубиков, упорядоченные по возрастанию 'z'.
+        self.z_order = []
+        # Кубики, координаты которых изменились после последней
+        # перерисовки. Ключи в словаре -- id объектов.
+        self.dirty_cubes = {}
+        self.render_job = None
+        self.last_render_time = 0
+        # Координаты мира последнего перемещения мышки, еще не отправленного
+        # серверу.
+        self.pending_motion = None
+        self.send_motion_job = None
+        self.last_motion_time = 0
+        # Предсказание положения кубика, который тащит игрок,
+        # `DragPrediction` или `None`. Предсказание работает, если сервер
+        # подтверждает события игрока.
+        self.prediction = None
+
+    # Перерисовка откладывается до конца кадра, поэтому несколько
+    # сообщений о кубике, пришедших за кадр, приводят к одному вызову
+    # `self.coords()`. Если предыдущий кадр закончился давно, перерисовка
+    # выполняется, когда Tk обработает все ожидающие события.
+    def schedule_render(self, cube):
+        self.dirty_cubes[cube.id] = cube
+        if self.render_job is not None:
+            return
+        delay = self.last_render_time + FRAME_INTERVAL_MS / 1000 \
+            - time.monotonic()
+        if delay > 0:
+            self.render_job = self.after(int(delay * 1000) + 1, self.render)
+        else:
+            self.render_job = self.after_idle(self.render)
+
+    def render(self):
+        self.render_job = None
+        now = self.last_render_time = time.monotonic()
+        dirty_cubes = self.dirty_cubes
+        self.dirty_cubes = {}
+        for cube in dirty_cubes.values():
+            if cube.draw(now):
+                self.schedule_render(cube)
+
+    # Кубики плавно переходят из одного состояния, принятого от сервера, в
+    # следующее за время одного такта сервера.
+    def get_interpolation_time(self):
+        tick_rate = self.get_root().tick_rate
+        return 1 / tick_rate if tick_rate else 0
+
+    def is_predicted(self, cube):
+        return self.prediction is not None and self.prediction.cube is cube
+
+    # Кубик, который тащил игрок, переходит из предсказанного положения в
+    # положение, принятое от сервера.
+    def end_prediction(self):
+        if self.prediction is None:
+            return
+        cube = self.prediction.cube
+        self.prediction = None
+        cube.glide_to(cube.x, cube.y)
+
+    # Возвращает верхний кубик, на который попадает точка (x, y), так же,
+    # как сервер выбирает схваченный кубик, или `None`.
+    def pick_cube(self, x, y):
+        for _, id_ in reversed(self.z_order):
+            cube = self.cubes[id_]
+            if cube.x <= x <= cube.x + cube.size \
+                    and cube.y <= y <= cube.y + cube.size:
+                return cube
+        return None
 
     def get_root(self):
         root = self.master
@@ -112,155 +365,275 @@ class CubeCanvasClient(tk.Canvas):
             root = root.master
         return root
 
-    def add_cube(self, id_, x, y, size, color):
-        CubeClient(self, id_, x, y, size, color)
+    # Кубики снимка мира идут в порядке 'z' и при инициализации ложатся
+    # поверх уже созданных, поэтому место в `self.z_order` находится сразу,
+    # и холст не переупорядочивается.
+    def add_cubes(self, version, records):
+        all_colors = colors.ALL_COLORS
+        for id_, x, y, size, color_idx, z in records:
+            CubeClient(
+                self, id_, x, y, size, all_colors[color_idx], z, version)
+
+    # Кубики приходят от сервера не в порядке 'z', если они появляются в
+    # видимой области мира при прокрутке холста или перемещении кубиков.
+    # Новый кубик помещается под ближайший кубик с большим 'z'.
+    def insert_in_z_order(self, cube):
+        idx = bisect.bisect(self.z_order, (cube.z, cube.id))
+        self.z_order.insert(idx, (cube.z, cube.id))
+        if idx + 1 < len(self.z_order):
+            self.tag_lower(cube.id, self.z_order[idx + 1][1])
+
+    def remove_from_z_order(self, cube):
+        idx = bisect.bisect_left(self.z_order, (cube.z, cube.id))
+        del self.z_order[idx]
+
+    # Координаты событий пересчитываются из координат окна в координаты
+    # мира с учетом прокрутки холста.
+    def get_world_coords(self, event):
+        return int(self.canvasx(event.x)), int(self.canvasy(event.y))
+
+    # Какой кубик схвачен, определяет сервер по координатам щелчка, поэтому
+    # id кубика в сообщение не входит.
+    def button_1(self, event):
+        x, y = self.get_world_coords(event)
+        event = {
+            'type': '<Button-1>',
+            'x': x,
+            'y': y
+        }
+        self.end_prediction()
+        seq = self.get_root().send_event(event)
+        if self.get_root().input_acks:
+            cube = self.pick_cube(x, y)
+            if cube is not None:
+                self.prediction = DragPrediction(cube, x, y, seq)
 
+    # Кубик отпускается там, куда его довели: перед событием
+    # '<ButtonRelease-1>' отправляется отложенное перемещение мышки.
     def button_release_1(self, event):
-        conn = self.get_root().conn_to_server
-        msg = {
-            'type': 'event',
-            'event': {
-                'type': '<ButtonRelease-1>',
-                'x': event.x,
-                'y': event.y
-            }
+        self.flush_motion()
+        x, y = self.get_world_coords(event)
+        event = {
+            'type': '<ButtonRelease-1>',
+            'x': x,
+            'y': y
         }
-        send_data_quite(conn, self.server_addr, msg)
+        seq = self.get_root().send_event(event)
+        if self.prediction is not None:
+            self.prediction.add_input(seq, x, y)
+            self.prediction.release_seq = seq
+            self.schedule_render(self.prediction.cube)
 
+    # Из перемещений мышки за интервал `motion_interval` серверу
+    # отправляется только последнее.
     def b1_motion(self, event):
-        conn = self.get_root().conn_to_server
+        self.pending_motion = self.get_world_coords(event)
+        if self.prediction is not None:
+            self.prediction.pointer = self.pending_motion
+            self.schedule_render(self.prediction.cube)
+        if self.send_motion_job is not None:
+            return
+        delay = self.last_motion_time \
+            + self.get_root().motion_interval_ms / 1000 - time.monotonic()
+        if delay > 0:
+            self.send_motion_job = self.after(
+                int(delay * 1000) + 1, self.send_motion)
+        else:
+            self.send_motion()
+
+    def send_motion(self):
+        self.send_motion_job = None
+        if self.pending_motion is None:
+            return
+        x, y = self.pending_motion
+        self.pending_motion = None
+        self.last_motion_time = time.monotonic()
+        event = {
+            'type': '<B1-Motion>',
+            'x': x,
+            'y': y
+        }
+        seq = self.get_root().send_event(event, key='<B1-Motion>')
+        if self.prediction is not None:
+            self.prediction.add_input(seq, x, y)
+
+    def flush_motion(self):
+        if self.send_motion_job is not None:
+            self.after_cancel(self.send_motion_job)
+        self.send_motion()
+
+    def button_3(self, event):
+        self.scan_mark(event.x, event.y)
+
+    def b3_motion(self, event):
+        self.scan_dragto(event.x, event.y, gain=1)
+        self.send_viewport()
+
+    def scroll(self, dx, dy):
+        self.xview_scroll(dx, 'units')
+        self.yview_scroll(dy, 'units')
+        self.send_viewport()
+
+    # Сообщает серверу видимую область мира. Сервер присылает только
+    # кубики, находящиеся в этой области или рядом с ней.
+    def send_viewport(self, event=None):
+        x1, y1 = int(self.canvasx(0)), int(self.canvasy(0))
         msg = {
-            'type': 'event',
-            'event': {
-                'type': '<B1-Motion>',
-                'x': event.x,
-                'y': event.y
-            }
+            'type': 'viewport',
+            'x1': x1,
+            'y1': y1,
+            'x2': x1 + self.winfo_width(),
+            'y2': y1 + self.winfo_height()
         }
-        send_data_quite(conn, self.server_addr, msg)
+        self.get_root().send_to_server(msg, key='viewport')
+
+    def set_world_shape(self, width, height):
+        self.configure(scrollregion=(0, 0, width, height))
+        self.send_viewport()
 
+    # Зрители не могут двигать кубики, поэтому у них работает только
+    # прокрутка холста.
     def bind_events(self):
-        self.bind('<ButtonRelease-1>', self.button_release_1)
-        self.bind('<B1-Motion>', self.b1_motion)
-        for cube in self.cubes.values():
-            cube.bind_button_1()
+        if self.get_root().role != 'spectator':
+            self.bind('<Button-1>', self.button_1)
+            self.bind('<ButtonRelease-1>', self.button_release_1)
+            self.bind('<B1-Motion>', self.b1_motion)
+        self.bind('<Button-3>', self.button_3)
+        self.bind('<B3-Motion>', self.b3_motion)
+        self.bind('<Configure>', self.send_viewport)
+        root = self.get_root()
+        root.bind('<Left>', lambda event: self.scroll(-1, 0))
+        root.bind('<Right>', lambda event: self.scroll(1, 0))
+        root.bind('<Up>', lambda event: self.scroll(0, -1))
+        root.bind('<Down>', lambda event: self.scroll(0, 1))
 
+    def warn_bad_command(self, warning_msg, command):
+        warnings.warn(warning_msg)
+        msg = {
+            'type': 'error_msg',
+            'error_class': 'ValueError',
+            'msg': warning_msg,
+            'command': command,
+            'registered_server_cubes': list(self.cubes_by_server_ids)
+        }
+        self.get_root().send_to_server(msg)
+
+    # Структура команды и типы значений проверяются по схеме из
+    # `schema.COMMAND_SCHEMAS`, после чего проверяются значения, зависящие
+    # от кубиков, известных клиенту.
     def is_command_ok(self, command):
-        if command['type'] not in self.supported_command_types:
-            warning_msg = "Команда неизвестного типа {} " \
-                "пришла от сервера. Вероятно, в коде клиентской часть" \
-                "ошибка, так как входные сообщения неправильного типа " \
-                "должны фиксироваться в методе " \
+        schema = find_schema(COMMAND_SCHEMAS, command)
+        if schema is None:
+            self.warn_bad_command(
+                "Команда неизвестного типа пришла от сервера: {}. "
+                "Вероятно, в коде клиентской части ошибка, так как входные "
+                "сообщения неправильного типа должны фиксироваться в методе "
                 "`CubeGameClient.receive_from_server()`".format(
-                    repr(command['type']))
-            warnings.warn(warning_msg)
-
-            msg = {
-                'type': 'error_msg',
-                'error_class': 'ValueError',
-                'msg': warning_msg,
-                'command': command,
-            }
-            send_data_quite(
-                self.get_root().conn_to_server, self.server_addr, msg)
+                    repr(command)),
+                command
+            )
             return False
-        if set(command.keys()) != self.command_keys[command['type']]:
-            warning_msg = "В словаре с описанием команды есть лишние ключи " \
-                "или не хватает ключей.\n" \
-                "excess: {}\n" \
-                "missing: {}\n" \
-                "command: {}".format(
-                    set(command.keys()) - self.command_keys[command['type']],
-                    self.command_keys[command['type']] - set(command.keys()),
-                    command
-                )
-            warnings.warn(warning_msg)
-            msg = {
-                'type': 'error_msg',
-                'error_class': 'ValueError',
-                'msg': warning_msg,
-                'command': command,
-            }
-            send_data_quite(
-                self.get_root().conn_to_server, self.server_addr, msg)
+        if not schema.is_valid(command):
+            self.warn_bad_command(schema.explain(command), command)
             return False
-        if command['type'] == 'add_cube':
-            if not (
-                    isinstance(command['id'], int)
-                    and isinstance(command['x'], (float, int))
-                    and isinstance(command['y'], (float, int))
-                    and isinstance(command['size'], (float, int))
-                    and isinstance(command['color'], str)
-                    and command['id'] not in self.cubes_by_server_ids
-                    and command['size'] > 0
-                    and command['color'] in colors.ALL_COLORS
-            ):
-                warning_msg = "Или значения, или типы значений в словаре с " \
-                    "описанием команды неверны.\n" \
-                    "command: {}\n" \
-                    "Зарегистрированные у клиента " \
-                    "id кубиков сервера: {}".format(
-                        command, self.cubes_by_server_ids)
-                warnings.warn(warning_msg)
-                msg = {
-                    'type': 'error_msg',
-                    'error_class': 'ValueError',
-                    'msg': warning_msg,
-                    'command': command,
-                    'registered_server_cubes': list(
-                        self.cubes_by_server_ids)
-                }
-                send_data_quite(
-                    self.get_root().conn_to_server, self.server_addr, msg)
-                return False
-        elif command['type'] == 'coords':
-            if not (
-                    isinstance(command['id'], int)
-                    and isinstance(command['x1'], (float, int))
-                    and isinstance(command['y1'], (float, int))
-                    and isinstance(command['x2'], (float, int))
-                    and isinstance(command['y2'], (float, int))
-                    and command['id'] in self.cubes_by_server_ids
-            ):
-                warning_msg = "Или значения, или типы значений в словаре с " \
-                    "описанием команды неверны."
-                warnings.warn(warning_msg)
-                msg = {
-                    'type': 'error_msg',
-                    'error_class': 'ValueError',
-                    'msg': warning_msg,
-                    'command': command,
-                    'registered_server_cubes': list(
-                        self.cubes_by_server_ids)
-                }
-                send_data_quite(
-                    self.get_root().conn_to_server, self.server_addr, msg)
-                return False
-        return True
+        if command['type'] == 'add_cubes':
+            ids = [cube[0] for cube in command['cubes']]
+            ok = len(set(ids)) == len(ids) and all(
+                id_ not in self.cubes_by_server_ids
+                and size > 0
+                and 0 <= color_idx < len(colors.ALL_COLORS)
+                for id_, x, y, size, color_idx, z in command['cubes']
+            )
+        elif command['type'] == 'remove_cube':
+            ok = command['id'] in self.cubes_by_server_ids
+        elif command['type'] == 'world_shape':
+            ok = command['width'] > 0 and command['height'] > 0
+        elif command['type'] == 'delta':
+            ok = all(
+                cube[0] in self.cubes_by_server_ids
+                for cube in command['cubes']
+            )
+        else:
+            ok = True
+        if not ok:
+            self.warn_bad_command(
+                "Значения в словаре с описанием команды неверны или "
+                "относятся к кубикам, которые клиенту не известны.\n"
+                "command: {}".format(command),
+                command
+            )
+        return ok
 
     def process_server_command(self, command):
         if not self.is_command_ok(command):
             return
-        if command['type'] == 'add_cube':
-            self.add_cube(
-                command['id'],
-                command['x'],
-                command['y'],
-                command['size'],
-                command['color']
-            )
-        elif command['type'] == 'coords':
-            self.cubes_by_server_ids[command['id']].set_coords(
-                command['x1'],
-                command['y1'],
-                command['x2'],
-                command['y2']
-            )
+        if command['type'] == 'add_cubes':
+            self.add_cubes(command['version'], command['cubes'])
+        elif command['type'] == 'remove_cube':
+            self.cubes_by_server_ids[command['id']].remove()
+        elif command['type'] == 'delta':
+            version = command['version']
+            if version > self.version:
+                self.version = version
+                for id_, x, y in command['cubes']:
+                    cube = self.cubes_by_server_ids[id_]
+                    # Кубик мог прийти в сообщении 'add_cubes' с более
+                    # новыми координатами.
+                    if cube.version < version:
+                        cube.move_to(
+                            dequantize_coord(x), dequantize_coord(y),
+                            version)
+            # Подтверждение устаревшего сообщения повторяется, так как
+            # прежнее подтверждение могло потеряться.
+            self.get_root().send_ack(self.version)
+        elif command['type'] == 'world_shape':
+            self.set_world_shape(command['width'], command['height'])
         elif command['type'] == 'bind_all':
             self.bind_events()
+        elif command['type'] == 'input_ack':
+            self.process_input_ack(command)
         else:
             assert False
 
+    # Подтверждения событий, отправленных до начала предсказания,
+    # пропускаются. Если сервер не дал схватить кубик, например, потому
+    # что его держит другой игрок, предсказание прекращается.
+    def process_input_ack(self, command):
+        prediction = self.prediction
+        if prediction is None or command['seq'] < prediction.first_seq:
+            return
+        cube = prediction.cube
+        if command['id'] != cube.server_id:
+            self.end_prediction()
+            return
+        x, y = dequantize_coord(command['x']), dequantize_coord(command['y'])
+        if cube.version < command['version']:
+            cube.version = command['version']
+            cube.x = x
+            cube.y = y
+        prediction.reconcile(command['seq'], x, y, time.monotonic())
+        self.schedule_render(cube)
+        if prediction.release_seq is not None \
+                and command['seq'] >= prediction.release_seq:
+            self.end_prediction()
+
+    # Датаграмма с координатами могла обогнать сообщения 'add_cubes' и
+    # 'remove_cube', переданные по TCP, поэтому координаты неизвестных
+    # кубиков пропускаются.
+    def process_server_datagram(self, command):
+        if command.get('type') != 'delta' \
+                or not isinstance(command.get('cubes'), list):
+            warning_msg = "По UDP пришла команда {}, в то время как по " \
+                "UDP передаются только команды 'delta'.".format(command)
+            warnings.warn(warning_msg)
+            return
+        command = dict(command, cubes=[
+            cube for cube in command['cubes']
+            if not (isinstance(cube, tuple) and len(cube) == 3)
+            or cube[0] in self.cubes_by_server_ids
+        ])
+        self.process_server_command(command)
+
 
 class MainFrame(tk.Frame):
     def __init__(self, master):
@@ -271,6 +644,9 @@ class MainFrame(tk.Frame):
     def process_server_command(self, command):
         self.cube_canvas.process_server_command(command)
 
+    def process_server_datagram(self, command):
+        self.cube_canvas.process_server_datagram(command)
+
 
 class CubeGameClient(tk.Tk):
     def __init__(self, config):
@@ -280,25 +656,65 @@ class CubeGameClient(tk.Tk):
 
         self.server_ip = config['server_ip']
         self.server_port = config['server_port']
-        self.server_addr = (self.server_ip, self.server_port)
+        address = config['server_address']
+        if address is None:
+            address = make_tcp_address(self.server_ip, self.server_port)
+        self.server_addr = get_addr(address)
+        self.room = config['room']
+        self.role = 'spectator' if config['spectator'] else DEFAULT_ROLE
+        self.motion_interval_ms = config['motion_interval']
+        # Канал UDP имеет смысл только при подключении по TCP.
+        self.use_udp = not config['no_udp'] \
+            and parse_address(address)[0] == socket.AF_INET
 
-        self.msg_types = ['error_msg', 'command']
+        self.msg_types = ['error_msg', 'command', 'hello_ack']
+        # Частота тактов сервера. Становится известна из ответа на 'hello'.
+        self.tick_rate = None
 
         self.geometry('{}x{}'.format(*WINDOW_SHAPE))
 
         self.main_frame = MainFrame(self)
         self.main_frame.pack(fill=tk.BOTH, expand=1)
 
-        # Сокет для обмена данными с сервером.
-        # Используется только в режиме 'client'.
-        self.conn_to_server = socket.socket()
-        self.conn_to_server.settimeout(0)
+        # Сокет для обмена данными с сервером и адрес, по которому он
+        # подключается. Используется только в режиме 'client'.
+        self.conn_to_server, self.server_sockaddr = \
+            create_client_socket(address)
+        self.framer = StreamFramer(self.conn_to_server, self.server_addr)
+        self.outbox = OutboundQueue(self.conn_to_server, self.server_addr)
+
+        # Сокет канала UDP. Создается, если сервер сообщил порт UDP в
+        # 'hello_ack'. Канал используется после ответа сервера на
+        # 'udp_hello' (`self.udp_ready`).
+        self.udp_sock = None
+        self.udp_token = None
+        self.udp_ready = False
+        self.udp_hello_attempts = 0
+        self.send_udp_hello_job = None
+        # Номер последнего события, отправленного при работающем канале
+        # UDP или если сервер подтверждает события. По номерам сервер
+        # отличает устаревшие перемещения мышки, а клиент -- события,
+        # которые сервер уже обработал.
+        self.event_seq = 0
+        # Сервер сообщает номер последнего обработанного события (см.
+        # `DragPrediction`).
+        self.input_acks = False
 
-        self.connect_to_server_job = None
+        # Tk вызывает обработчики, когда сокеты готовы к чтению или записи.
+        # `self.watched_sockets` хранит для каждого сокета маску событий и
+        # обработчик. Если Tk не поддерживает обработчики файлов, сокеты
+        # опрашиваются функцией `select.select()` каждые `DT_MS` мс.
+        self.watched_sockets = {}
+        self.file_handlers_supported = hasattr(self.tk, 'createfilehandler')
+        self.poll_sockets_job = None
+        if not self.file_handlers_supported:
+            self.poll_sockets()
+
+        self.connected = False
         self.connect_to_server()
 
-        self.receive_from_server_job = None
-        self.receive_from_server()
+        self.send_heartbeat_job = None
+        self.send_heartbeat()
 
     @staticmethod
     def check_config(config):
@@ -319,22 +735,230 @@ class CubeGameClient(tk.Tk):
                 "Разрещенные порты: {} - {}.".format(
                     config['server_port'], MIN_PORT_NUMBER, MAX_PORT_NUMBER)
             )
+        if not (1 <= len(config['room']) <= MAX_ROOM_NAME_LENGTH):
+            raise ValueError(
+                "Название комнаты должно содержать от {} до {} символов, в "
+                "то время как\nconfig['room'] = {}".format(
+                    1, MAX_ROOM_NAME_LENGTH, repr(config['room']))
+            )
+        if config['server_address'] is not None:
+            parse_address(config['server_address'])
+        if not (0 <= config['motion_interval'] <= MAX_MOTION_INTERVAL_MS):
+            raise ValueError(
+                "Интервал между сообщениями о перемещении мышки должен быть "
+                "в диапазоне от {} до {} мс, в то время как\n"
+                "config['motion_interval'] = {}".format(
+                    0, MAX_MOTION_INTERVAL_MS, config['motion_interval'])
+            )
+
+    def watch_socket(self, sock, mask, callback):
+        if self.watched_sockets.get(sock) == (mask, callback):
+            return
+        self.watched_sockets[sock] = (mask, callback)
+        if self.file_handlers_supported:
+            self.tk.createfilehandler(sock, mask, callback)
+
+    def unwatch_socket(self, sock):
+        if self.watched_sockets.pop(sock, None) is None:
+            return
+        if self.file_handlers_supported:
+            self.tk.deletefilehandler(sock)
+
+    def poll_sockets(self):
+        readers = [
+            sock for sock, (mask, _) in self.watched_sockets.items()
+            if mask & tk.READABLE
+        ]
+        writers = [
+            sock for sock, (mask, _) in self.watched_sockets.items()
+            if mask & tk.WRITABLE
+        ]
+        if readers or writers:
+            # В Windows о неудачном подключении сообщает третий список.
+            r, w, x = select.select(readers, writers, writers, 0)
+            for sock in set(r + w + x):
+                if sock in self.watched_sockets:
+                    mask, callback = self.watched_sockets[sock]
+                    callback(sock, mask)
+        self.poll_sockets_job = self.after(DT_MS, self.poll_sockets)
 
+    # Подключение выполняется один раз без блокировки. О завершении
+    # подключения сообщает готовность сокета к записи.
     def connect_to_server(self):
+        error = self.conn_to_server.connect_ex(self.server_sockaddr)
+        if error == 0:
+            self.on_connected()
+        elif error in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.watch_socket(
+                self.conn_to_server, tk.WRITABLE, self.check_connection)
+        else:
+            self.on_connection_failed(error)
+
+    def check_connection(self, sock, mask):
+        error = self.conn_to_server.getsockopt(
+            socket.SOL_SOCKET, socket.SO_ERROR)
+        if error == 0:
+            try:
+                self.conn_to_server.getpeername()
+            except OSError as e:
+                error = e.errno or errno.ENOTCONN
+        if error == 0:
+            self.on_connected()
+        else:
+            self.on_connection_failed(error)
+
+    def on_connection_failed(self, error):
+        self.unwatch_socket(self.conn_to_server)
+        warnings.warn(
+            "Не удалось подключиться к серверу {}: {}".format(
+                self.server_addr, os.strerror(error)))
+
+    def on_connected(self):
+        self.connected = True
+        self.watch_socket(
+            self.conn_to_server, tk.READABLE, self.handle_server_socket)
+        # Способ кодирования сообщений согласуется до входа в комнату.
+        # Ответ сервера на 'hello' придет раньше сообщений, отправленных
+        # после входа в комнату.
+        hello = make_hello_msg()
+        hello['input_acks'] = True
+        if self.use_udp:
+            hello['udp'] = True
+        self.send_to_server(hello)
+        msg = {'type': 'join', 'room': self.room, 'role': self.role}
+        self.send_to_server(msg)
+
+    # Соединение с сервером закрывается, если он разорвал его или
+    # произошла ошибка сокета.
+    def disconnect(self):
+        self.connected = False
+        self.unwatch_socket(self.conn_to_server)
+        self.conn_to_server.close()
+
+    def send_heartbeat(self):
+        if self.connected:
+            self.send_to_server({'type': 'heartbeat'}, key='heartbeat')
+        self.send_heartbeat_job = self.after(
+            HEARTBEAT_INTERVAL_MS, self.send_heartbeat)
+
+    def send_to_server(self, msg, key=None):
         try:
-            self.conn_to_server.connect(self.server_addr)
-        except BlockingIOError:
-            # Не удалось установить соединнение
-            pass
+            self.outbox.put_data(msg, key=key)
+        except ValueError as e:
+            warnings.warn(e)
+            warn_no_msg_was_sent(msg, self.server_addr)
+            return
+        self.flush_to_server()
+
+    # Перемещения мышки при работающем канале UDP отправляются
+    # датаграммами. Остальные события отправляются по TCP с номером, чтобы
+    # сервер мог пропустить датаграммы, отправленные раньше них. Возвращает
+    # номер события или `None`, если события отправляются без номеров.
+    def send_event(self, event, key=None):
+        if not self.udp_ready and not self.input_acks:
+            self.send_to_server({'type': 'event', 'event': event}, key=key)
+            return None
+        self.event_seq += 1
+        if event['type'] == '<B1-Motion>' and self.udp_ready:
+            msg = {
+                'type': 'motion',
+                'seq': self.event_seq,
+                'x': event['x'],
+                'y': event['y']
+            }
+            self.send_datagram(msg)
+        else:
+            msg = {'type': 'event', 'seq': self.event_seq, 'event': event}
+            self.send_to_server(msg, key=key)
+        return self.event_seq
+
+    def send_ack(self, version):
+        msg = {'type': 'ack', 'version': version}
+        if self.udp_ready:
+            self.send_datagram(msg)
+        else:
+            self.send_to_server(msg, key='ack')
+
+    # Ошибки отправки не обрабатываются: датаграмма теряется так же, как
+    # если бы ее потеряла сеть.
+    def send_datagram(self, msg):
+        try:
+            self.udp_sock.send(encode_frame(msg, self.outbox.encoding.codec))
         except OSError:
-            # Соединение уже установлено
             pass
-        self.connect_to_server_job = self.after(
-            DT_MS, self.connect_to_server)
+
+    def flush_to_server(self):
+        if not self.outbox:
+            return
+        try:
+            self.outbox.flush()
+        except ConnectionAbortedError as e:
+            warnings.warn(e)
+            warnings.warn(
+                CONNECTION_ABORTED_ERROR_WARNING_TMPL.format(self.server_addr))
+            self.drop_outbox()
+        except OSError as e:
+            # Например, соединение еще не установлено или уже разорвано.
+            warnings.warn(e)
+            self.drop_outbox()
+        if self.outbox.overflowed:
+            warnings.warn(
+                "Сервер {} не успевает принимать данные.".format(
+                    self.server_addr))
+            self.drop_outbox()
+        # Пока в очереди остаются данные, Tk сообщает о готовности сокета
+        # к записи.
+        if self.connected:
+            mask = tk.READABLE | tk.WRITABLE if self.outbox else tk.READABLE
+            self.watch_socket(
+                self.conn_to_server, mask, self.handle_server_socket)
+
+    def drop_outbox(self):
+        for frame, _ in self.outbox.frames:
+            warn_no_msg_was_sent(frame, self.server_addr)
+        encoding = self.outbox.encoding
+        self.outbox = OutboundQueue(self.conn_to_server, self.server_addr)
+        self.outbox.encoding = encoding
+
+    def handle_udp_socket(self, sock, mask):
+        self.receive_datagrams()
+
+    def receive_datagrams(self):
+        while True:
+            try:
+                data = self.udp_sock.recv(MAX_DATAGRAM_SIZE)
+            except BlockingIOError:
+                return
+            except ConnectionRefusedError:
+                # Сообщение ICMP о недоставленной датаграмме.
+                continue
+            except OSError as e:
+                warnings.warn(e)
+                return
+            try:
+                msg = decode_datagram(data, SERVER_DATAGRAM_TAGS)
+            except DECODING_ERRORS as e:
+                warnings.warn(
+                    "Не удалось декодировать датаграмму от сервера: "
+                    "{}".format(e))
+                continue
+            if msg.get('type') == 'udp_ready':
+                self.udp_ready = True
+            elif msg.get('type') == 'command':
+                self.main_frame.process_server_datagram(msg['command'])
+            else:
+                warnings.warn(
+                    "Датаграмма неизвестного типа {} пришла от "
+                    "сервера.".format(repr(msg.get('type'))))
+
+    def handle_server_socket(self, sock, mask):
+        self.flush_to_server()
+        if self.connected:
+            self.receive_from_server()
 
     def receive_from_server(self):
         try:
-            msgs, e = recv_data(self.conn_to_server, self.server_addr)
+            msgs, e = self.framer.receive()
             for msg in msgs:
                 if msg['type'] == 'error_msg':
                     warnings.warn(
@@ -344,6 +968,8 @@ class CubeGameClient(tk.Tk):
                     )
                 elif msg['type'] == 'command':
                     self.main_frame.process_server_command(msg['command'])
+                elif msg['type'] == 'hello_ack':
+                    self.process_hello_ack(msg)
                 else:
                     warning_msg = "Сообщение неизвестного типа {} " \
                         "пришло от сервера.".format(repr(msg['type']))
@@ -354,29 +980,67 @@ class CubeGameClient(tk.Tk):
                         'msg': warning_msg,
                         'event': msg['event'],
                     }
-                    send_data_quite(
-                        self.get_root().conn_to_server, self.server_addr, msg)
+                    self.send_to_server(msg)
             if e is not None:
                 raise e
         except CorruptedMessageError as e:
             warnings.warn(e.message)
+            self.send_to_server(e.get_error_msg())
         except BlockingIOError:
             pass
-        except ConnectionRefusedError as e:
-            # Вероятно, сервер не запущен
-            warnings.warn(e)
-        except ConnectionResetError as e:
-            self.conn_to_server.close()
-            self.receive_from_server_job = None
-            warnings.warn(e)
-            return
         except OSError as e:
+            self.disconnect()
             warnings.warn(e)
-        self.receive_from_server_job = self.after(
-            DT_MS, self.receive_from_server)
+
+    def process_hello_ack(self, msg):
+        encoding = get_hello_ack_encoding(msg)
+        if encoding is None:
+            warning_msg = "Сервер выбрал неподдерживаемый способ " \
+                "кодирования сообщений.\nmsg = {}".format(msg)
+            warnings.warn(warning_msg)
+            msg = {
+                'type': 'error_msg',
+                'error_class': 'ValueError',
+                'msg': warning_msg,
+            }
+            self.send_to_server(msg)
+            return
+        self.outbox.encoding = encoding
+        self.tick_rate = msg['tick_rate']
+        self.input_acks = msg.get('input_acks') is True
+        if self.use_udp and isinstance(msg.get('udp_port'), int) \
+                and isinstance(msg.get('udp_token'), int):
+            self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_sock.settimeout(0)
+            self.udp_sock.connect((self.server_sockaddr[0], msg['udp_port']))
+            self.udp_token = msg['udp_token']
+            self.watch_socket(
+                self.udp_sock, tk.READABLE, self.handle_udp_socket)
+            self.send_udp_hello()
+
+    def send_udp_hello(self):
+        self.send_udp_hello_job = None
+        if self.udp_ready:
+            return
+        if self.udp_hello_attempts >= UDP_HELLO_MAX_ATTEMPTS:
+            warnings.warn(
+                "Сервер {} не ответил на {} датаграмм 'udp_hello'. Все "
+                "сообщения будут передаваться по TCP.".format(
+                    self.server_addr, UDP_HELLO_MAX_ATTEMPTS))
+            self.unwatch_socket(self.udp_sock)
+            self.udp_sock.close()
+            self.udp_sock = None
+            return
+        self.udp_hello_attempts += 1
+        self.send_datagram({'type': 'udp_hello', 'token': self.udp_token})
+        self.send_udp_hello_job = self.after(
+            UDP_HELLO_INTERVAL_MS, self.send_udp_hello)
 
     def close_all_sockets(self):
-        self.conn_to_server.close()
+        self.disconnect()
+        if self.udp_sock is not None:
+            self.unwatch_socket(self.udp_sock)
+            self.udp_sock.close()
 
 
 def main():
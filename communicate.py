@@ -1,19 +1,103 @@
+import collections
 import datetime
+import itertools
+import operator
 import os
 import pickle
 import socket
+import struct
 import warnings
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 
 MIN_PORT_NUMBER = 1024
 MAX_PORT_NUMBER = 65535
 DEFAULT_PORT_NUMBER = 50007
 
+MAX_ROOM_NAME_LENGTH = 64
+# Роли участников комнаты. Зрители получают состояние мира, но не могут
+# двигать кубики и не занимают места игроков в комнате.
+ROLES = ['player', 'spectator']
+DEFAULT_ROLE = 'player'
+
 MAX_MSG_SIZE = 2 ** 20
 BUFFER_SIZE = 1024
+# Начальный размер буфера `StreamFramer`. Буфер увеличивается, если в него не
+# помещается одно сообщение, но не более чем до размера максимального
+# сообщения вместе с заголовком.
+INITIAL_RECV_BUFFER_SIZE = 16 * BUFFER_SIZE
 NUM_BYTES_FOR_MSG_LENGTH = 4
 MSG_BYTEORDER = 'big'
 
+# Заголовок сообщения -- длина закодированного сообщения, в старших битах
+# которой записан способ сжатия сообщения. 0 -- сообщение не сжато.
+# Сообщение сжимается, только если его размер не меньше
+# `COMPRESSION_THRESHOLD` и получатель сообщил, что поддерживает выбранный
+# способ сжатия. Сжатое сообщение после распаковки не должно быть больше
+# `MAX_MSG_SIZE`.
+COMPRESSION_SHIFT = 28
+MSG_LENGTH_MASK = (1 << COMPRESSION_SHIFT) - 1
+COMPRESSION_IDS = {'zlib': 1, 'lz4': 2}
+# Способы сжатия, доступные в текущем окружении, в порядке предпочтения.
+COMPRESSIONS = ['zlib'] if lz4 is None else ['lz4', 'zlib']
+COMPRESSION_THRESHOLD = 4096
+# Уровень сжатия zlib. Сжатие с уровнем 1 в несколько раз быстрее, чем с
+# уровнем по умолчанию, и почти не уступает ему в степени сжатия
+# сообщений игры.
+ZLIB_LEVEL = 1
+
+# Первый байт закодированного сообщения -- тег, определяющий способ
+# декодирования остальных байтов. Сообщения с тегом `PICKLE_TAG` закодированы
+# `pickle`, остальные теги соответствуют сообщениям фиксированной формы,
+# перечисленным в `BINARY_FORMATS`.
+PICKLE_TAG = 0
+DEFAULT_CODEC = 'binary'
+
+# В начале соединения клиент может отправить сообщение 'hello' с
+# перечнем поддерживаемых им версий протокола, кодеков и способов сжатия и
+# наибольшим размером сообщения, которое он может принять. Сервер отвечает
+# сообщением 'hello_ack' с выбранными вариантами и частотой тактов. Если
+# 'hello' не было, используются кодек `DEFAULT_CODEC` без сжатия.
+PROTOCOL_VERSIONS = [1]
+# Кодеки в порядке предпочтения: первый самый быстрый.
+CODEC_PREFERENCE = ['binary', 'pickle']
+# Наименьший размер сообщения, который можно согласовать. В сообщение
+# такого размера помещаются сообщения об ошибках и команды игры.
+MIN_NEGOTIATED_MSG_SIZE = 2 ** 16
+
+# Необязательный канал UDP. Если клиент указал в 'hello' ключ 'udp', а
+# сервер запущен с параметром `--udp`, в 'hello_ack' сервер сообщает порт
+# UDP и токен. Клиент отправляет на этот порт датаграммы 'udp_hello' с
+# токеном, пока не получит в ответ датаграмму 'udp_ready'. После этого по
+# UDP передаются координаты кубиков (сообщения 'delta'), подтверждения их
+# получения и перемещения мышки с номерами `seq`, а остальные сообщения
+# по-прежнему передаются по TCP. Датаграмма -- закодированное сообщение с
+# заголовком, как в потоке TCP. Датаграммы больше `MAX_DATAGRAM_SIZE`
+# байт не отправляются, чтобы их не приходилось фрагментировать.
+MAX_DATAGRAM_SIZE = 1200
+
+# Координаты кубиков в сообщениях о перемещении кубиков передаются целыми
+# числами -- координатами, деленными на `COORDS_QUANTUM` и округленными.
+COORDS_QUANTUM = 1
+
+# Максимальное число буферов, передаваемых в один вызов `socket.sendmsg()`.
+# Должно быть не больше IOV_MAX, который в Linux равен 1024.
+MAX_NUM_BUFFERS_PER_SENDMSG = 512
+# Ограничение размера очереди неотправленных сообщений одного соединения и
+# способы обработки ее переполнения. См. `OutboundQueue`.
+DEFAULT_MAX_OUTPUT_BUFFER_SIZE = 4 * MAX_MSG_SIZE
+SLOW_CONSUMER_POLICIES = ['drop', 'disconnect']
+DEFAULT_SLOW_CONSUMER_POLICY = 'drop'
+
+SLOW_CONSUMER_WARNING_TMPL = "Корреспондент {} не успевает принимать " \
+    "данные: размер очереди неотправленных сообщений превысил {} байт. " \
+    "Соединение будет закрыто."
+
 LOGDIR = 'logs'
 CORRUPTED_MESSAGES_DIR = os.path.join(LOGDIR, 'corrupted_messages')
 CORRUPTED_MSG_FILE_TMPL = "{ip}_port{port}_{dt}.bin"
@@ -21,25 +105,18 @@ CORRUPTED_MSG_FILE_TMPL = "{ip}_port{port}_{dt}.bin"
 # одного игрока в одно время. Подобные ситуации при правильной работе
 # программы не должны возникать.
 MAX_NUM_CORRUPTED_MSG_FILES = 5
-OUT_OF_BOUNDS_CORRUPTED_MSG_TMPL = (
-    "Сообщение, начинающееся с байта с индексом {start}, не соответствует " 
-    "протоколу. Длина сообщения, начинающегося с {start}-го байта " 
-    "выходит за границу массива принятых данных. Это может быть связано с "
-    "обрывом связи при передаче сообщения, распределенного по 2м или более "
-    "буферам, а также с ошибочным форматом сообщения. Принятые сообщения "
-    "не будут обработаны. Эта ошибка возникает в том числе, когда клиент "
-    "посылает сообщения при отсутствии соединения с сетью, а затем "
-    "соединение восстанавливается.\n"
-    "len(data) = {data_length}\n"
+TOO_LONG_CORRUPTED_MSG_TMPL = (
+    "Сообщение, начинающееся с байта с индексом {start}, не соответствует "
+    "протоколу. Длина сообщения {length} превышает максимально допустимую "
+    "{max_length}. Вероятно, формат сообщения ошибочен или поток данных был "
+    "поврежден. Принятые, но еще не обработанные данные будут отброшены.\n"
     "отправитель: {addr}\n"
-    "Длина закодированного сообщения: {length}\n"
     "Принятые данные сохранены в файл {dump_fn}'"
 )
-UNPICKLING_CORRUPTED_MSG_TMPL = (
+DECODING_CORRUPTED_MSG_TMPL = (
     "Сообщение, начинающееся с байта с индексом {start}, не соответствует "
-    "протоколу. Невозможно выполнить unpickling данных со {start_pickled}-го "
-    "по {end_pickled}-й байты не включительно. Процесс приема данных "
-    "останавлен.\n"
+    "протоколу. Невозможно декодировать данные со {start_pickled}-го "
+    "по {end_pickled}-й байты не включительно. Сообщение пропущено.\n"
     "отправитель: {addr}\n"
     "Длина закодированного сообщения: {length}\n"
     "Принятые данные сохранены в файл {dump_fn}'"
@@ -53,6 +130,8 @@ CONNECTION_ABORTED_ERROR_WARNING_TMPL = "Произошел обрыв соед
 CONNECTION_RESET_ERROR_WARNING_TMPL = "Произошел брыв соединения с " \
     "корреспондентом {}."
 
+CONNECTION_CLOSED_WARNING_TMPL = "Корреспондент {} закрыл соединение."
+
 
 class CorruptedMessageError(Exception):
     def __init__(self, msg, data, idx, length):
@@ -61,11 +140,22 @@ class CorruptedMessageError(Exception):
         self.idx = idx
         self.length = length
 
+    def get_error_msg(self):
+        return {
+            'type': 'error_msg',
+            'error_class': 'CorruptedMessageError',
+            'msg': self.message,
+            'data': self.data,
+            'i': self.idx,
+            'length': self.length
+        }
+
 
 def get_dump_fn_for_corrupted_data(addr):
+    # Вместо порта у сокета Unix путь, разделители в котором заменяются.
     fn = CORRUPTED_MSG_FILE_TMPL.format(
         ip=addr[0],
-        port=addr[1],
+        port=str(addr[1]).replace(os.sep, '_'),
         dt=datetime.datetime.now().strftime("%Y-%m-%d_%H;%M;%S.%f")
     )
     path = os.path.join(CORRUPTED_MESSAGES_DIR, fn)
@@ -92,91 +182,649 @@ def dump_corrupted_data(data, dump_fn):
         f.write(data)
 
 
-def send_data(conn, data):
-    data = pickle.dumps(data)
+# Сообщение фиксированной формы. Если `inner_type` не `None`, то значения
+# полей хранятся во вложенном словаре:
+# {'type': msg_type, msg_type: {'type': inner_type, <поля>}}.
+# Если `inner_type` равен `None`, то сообщение -- словарь
+# {'type': msg_type, <поля>}.
+class FixedShapeFormat:
+    def __init__(self, tag, msg_type, inner_type, fields, fmt):
+        self.tag = tag
+        self.msg_type = msg_type
+        self.inner_type = inner_type
+        self.fields = fields
+        if not fields:
+            self.get_values = lambda inner: ()
+        elif len(fields) == 1:
+            self.get_values = lambda inner: (inner[fields[0]],)
+        else:
+            self.get_values = operator.itemgetter(*fields)
+        # Первое распакованное значение -- тег. Он записывается в ключ
+        # 'type' и затем заменяется на тип сообщения.
+        self.keys = ('type',) + fields
+        self.struct = struct.Struct('>B' + fmt)
+
+    def encode(self, inner):
+        # Кодирование возможно, только если словарь содержит ровно
+        # перечисленные поля, а значения помещаются в `self.struct`.
+        # Иначе возвращается `None`, и сообщение кодируется `pickle`.
+        if len(inner) != len(self.keys):
+            return None
+        try:
+            return self.struct.pack(self.tag, *self.get_values(inner))
+        except (KeyError, struct.error):
+            return None
+
+    def wrap(self, inner):
+        if self.inner_type is None:
+            inner['type'] = self.msg_type
+            return inner
+        inner['type'] = self.inner_type
+        return {'type': self.msg_type, self.msg_type: inner}
+
+    def decode(self, payload):
+        return self.wrap(dict(zip(self.keys, self.struct.unpack(payload))))
+
+
+# Сообщение фиксированной формы с номером 'seq' во внешнем словаре:
+# {'type': msg_type, 'seq': seq, msg_type: {'type': inner_type, <поля>}}.
+# В отличие от `FixedShapeFormat`, методу `encode()` передается все
+# сообщение.
+class SequencedFormat(FixedShapeFormat):
+    def __init__(self, tag, msg_type, inner_type, fields, fmt):
+        super().__init__(tag, msg_type, inner_type, fields, 'I' + fmt)
+        self.keys = ('type', 'seq') + fields
+
+    def encode(self, data):
+        try:
+            inner = data[self.msg_type]
+            if len(data) != 3 or len(inner) != len(self.keys) - 1:
+                return None
+            return self.struct.pack(
+                self.tag, data['seq'], *self.get_values(inner))
+        except (KeyError, TypeError, struct.error):
+            return None
+
+    def decode(self, payload):
+        inner = dict(zip(self.keys, self.struct.unpack(payload)))
+        seq = inner.pop('seq')
+        msg = self.wrap(inner)
+        msg['seq'] = seq
+        return msg
+
+
+# Сообщение с переменным числом записей одинаковой структуры. Поля `fields`
+# кодируются форматом `fmt` в заголовке сообщения, а записи хранятся в
+# словаре сообщения списком кортежей по ключу `list_field`.
+class RecordListFormat(FixedShapeFormat):
+    def __init__(
+            self, tag, msg_type, inner_type, fields, fmt, list_field,
+            record_fmt
+    ):
+        super().__init__(tag, msg_type, inner_type, fields, fmt)
+        self.keys += (list_field,)
+        self.list_field = list_field
+        self.record_fmt = record_fmt
+        self.record_struct = struct.Struct('>' + record_fmt)
+
+    def encode(self, inner):
+        if len(inner) != len(self.keys):
+            return None
+        try:
+            records = inner[self.list_field]
+            values = [value for record in records for value in record]
+            if len(values) != len(self.record_fmt) * len(records):
+                return None
+            return self.struct.pack(self.tag, *self.get_values(inner)) \
+                + struct.pack('>' + self.record_fmt * len(records), *values)
+        except (KeyError, TypeError, struct.error):
+            return None
+
+    def decode(self, payload):
+        inner = dict(zip(self.keys, self.struct.unpack_from(payload)))
+        inner[self.list_field] = list(
+            self.record_struct.iter_unpack(payload[self.struct.size:]))
+        return self.wrap(inner)
+
+
+BINARY_FORMATS = [
+    FixedShapeFormat(2, 'event', '<B1-Motion>', ('x', 'y'), 'ii'),
+    FixedShapeFormat(3, 'event', '<Button-1>', ('x', 'y'), 'ii'),
+    FixedShapeFormat(4, 'event', '<ButtonRelease-1>', ('x', 'y'), 'ii'),
+    # Записи -- (id, x, y) кубиков, сдвинутых после версии мира 'base'.
+    RecordListFormat(
+        6, 'command', 'delta', ('version', 'base'), 'II', 'cubes', 'Iii'),
+    FixedShapeFormat(7, 'ack', None, ('version',), 'I'),
+    FixedShapeFormat(8, 'viewport', None, ('x1', 'y1', 'x2', 'y2'), 'iiii'),
+    FixedShapeFormat(9, 'command', 'remove_cube', ('id',), 'I'),
+    # Перемещение мышки с номером события 'seq', переданное по UDP.
+    FixedShapeFormat(11, 'motion', None, ('seq', 'x', 'y'), 'Iii'),
+    FixedShapeFormat(12, 'udp_hello', None, ('token',), 'Q'),
+    # Номер последнего обработанного события игрока и координаты кубика,
+    # который он схватил последним ('id' 0 -- щелчок не схватил кубик).
+    FixedShapeFormat(
+        13, 'command', 'input_ack', ('seq', 'version', 'id', 'x', 'y'),
+        'IIIii'
+    ),
+    # События с номерами 'seq', которые клиент отправляет, пока ждет
+    # подтверждений 'input_ack'.
+    SequencedFormat(14, 'event', '<B1-Motion>', ('x', 'y'), 'ii'),
+    SequencedFormat(15, 'event', '<Button-1>', ('x', 'y'), 'ii'),
+    SequencedFormat(16, 'event', '<ButtonRelease-1>', ('x', 'y'), 'ii'),
+    FixedShapeFormat(17, 'udp_ready', None, (), ''),
+]
+BINARY_FORMATS_BY_TAG = {format_.tag: format_ for format_ in BINARY_FORMATS}
+BINARY_FORMATS_BY_TYPE = {
+    (format_.msg_type, format_.inner_type): format_
+    for format_ in BINARY_FORMATS
+    if not isinstance(format_, SequencedFormat)
+}
+SEQUENCED_FORMATS_BY_TYPE = {
+    (format_.msg_type, format_.inner_type): format_
+    for format_ in BINARY_FORMATS
+    if isinstance(format_, SequencedFormat)
+}
+# Теги сообщений, которые клиент и сервер передают друг другу по UDP.
+# Датаграммы с другими тегами, в том числе закодированные `pickle`,
+# отбрасываются без декодирования: их может прислать кто угодно.
+CLIENT_DATAGRAM_TAGS = frozenset(
+    BINARY_FORMATS_BY_TYPE[key].tag
+    for key in [('motion', None), ('ack', None), ('udp_hello', None)]
+)
+SERVER_DATAGRAM_TAGS = frozenset(
+    BINARY_FORMATS_BY_TYPE[key].tag
+    for key in [('command', 'delta'), ('udp_ready', None)]
+)
+# Датаграмма с адреса, еще не привязанного к игроку, может быть только
+# 'udp_hello'.
+UDP_HELLO_TAGS = frozenset([BINARY_FORMATS_BY_TYPE[('udp_hello', None)].tag])
+DECODING_ERRORS = (
+    pickle.UnpicklingError, EOFError, struct.error, KeyError, IndexError,
+    ValueError, zlib.error
+)
+
+
+class PickleCodec:
+    name = 'pickle'
+
+    def encode(self, data):
+        return bytes([PICKLE_TAG]) + pickle.dumps(data)
+
+
+# Сообщения, часто передаваемые во время игры, кодируются `struct`. Все
+# прочие сообщения, например, сообщения об ошибках, кодируются `pickle`.
+class BinaryCodec(PickleCodec):
+    name = 'binary'
+
+    def encode(self, data):
+        try:
+            msg_type = data['type']
+            inner = data.get(msg_type)
+            if inner is None:
+                # Сообщение без вложенного словаря.
+                format_ = BINARY_FORMATS_BY_TYPE[(msg_type, None)]
+                inner = data
+            elif len(data) == 2:
+                format_ = BINARY_FORMATS_BY_TYPE[(msg_type, inner['type'])]
+            elif len(data) == 3 and 'seq' in data:
+                # Сообщение с номером передается формату целиком.
+                format_ = SEQUENCED_FORMATS_BY_TYPE[
+                    (msg_type, inner['type'])]
+                inner = data
+            else:
+                format_ = None
+        except (KeyError, TypeError):
+            format_ = None
+        if format_ is not None:
+            payload = format_.encode(inner)
+            if payload is not None:
+                return payload
+        return super().encode(data)
+
+
+CODECS = {codec.name: codec for codec in [PickleCodec(), BinaryCodec()]}
+
+
+def decode_payload(payload):
+    tag = payload[0]
+    if tag == PICKLE_TAG:
+        return pickle.loads(payload[1:])
+    format_ = BINARY_FORMATS_BY_TAG.get(tag)
+    if format_ is None:
+        raise ValueError("Неизвестный тег сообщения {}".format(tag))
+    return format_.decode(payload)
+
+
+def compress_payload(payload, compression):
+    if compression == 'zlib':
+        return zlib.compress(payload, ZLIB_LEVEL)
+    return lz4.frame.compress(payload)
+
+
+# Распаковка ограничена `MAX_MSG_SIZE` байтами, чтобы небольшое сжатое
+# сообщение не могло занять много памяти.
+def decompress_payload(payload, compression_id):
+    if compression_id == COMPRESSION_IDS['zlib']:
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(payload, MAX_MSG_SIZE)
+        if not decompressor.eof:
+            raise ValueError(
+                "Сжатое сообщение повреждено или после распаковки больше {} "
+                "байт".format(MAX_MSG_SIZE))
+        return data
+    if compression_id == COMPRESSION_IDS['lz4'] and lz4 is not None:
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        try:
+            data = decompressor.decompress(payload, MAX_MSG_SIZE)
+        except RuntimeError as e:
+            raise ValueError(str(e))
+        if not decompressor.eof:
+            raise ValueError(
+                "Сжатое сообщение повреждено или после распаковки больше {} "
+                "байт".format(MAX_MSG_SIZE))
+        return data
+    raise ValueError(
+        "Неизвестный или недоступный способ сжатия {}".format(compression_id))
+
+
+# Способ кодирования сообщений для одного корреспондента.
+FrameEncoding = collections.namedtuple(
+    'FrameEncoding', ['codec', 'compression', 'max_msg_size'])
+DEFAULT_ENCODING = FrameEncoding(DEFAULT_CODEC, None, MAX_MSG_SIZE)
+
+
+# Возвращает первый из вариантов `supported`, который есть в списке
+# `offered`, или `None`.
+def choose_option(offered, supported):
+    for option in supported:
+        if option in offered:
+            return option
+    return None
+
+
+def make_hello_msg():
+    return {
+        'type': 'hello',
+        'protocol_versions': PROTOCOL_VERSIONS,
+        'codecs': CODEC_PREFERENCE,
+        'compression': COMPRESSIONS,
+        'max_msg_size': MAX_MSG_SIZE
+    }
+
+
+# Возвращает ответ на сообщение 'hello' или сообщение об ошибке, если
+# сообщение неверно или общих версий протокола и кодеков нет. `codecs` --
+# кодеки, которые может использовать отвечающая сторона.
+def make_hello_ack_msg(hello, tick_rate, codecs=CODEC_PREFERENCE):
+    keys = ['protocol_versions', 'codecs', 'compression']
+    if not all(isinstance(hello.get(key), list) for key in keys) \
+            or not isinstance(hello.get('max_msg_size'), int):
+        error = "В сообщении 'hello' должны быть списки {} и целое " \
+            "число 'max_msg_size'.\nmsg = {}".format(keys, hello)
+    else:
+        versions = set(hello['protocol_versions']) & set(PROTOCOL_VERSIONS)
+        codec = choose_option(hello['codecs'], codecs)
+        max_msg_size = min(hello['max_msg_size'], MAX_MSG_SIZE)
+        if not versions:
+            error = "Нет общих версий протокола. Поддерживаются версии " \
+                "{}.\nmsg = {}".format(PROTOCOL_VERSIONS, hello)
+        elif codec is None:
+            error = "Нет общих кодеков. Поддерживаются кодеки {}.\n" \
+                "msg = {}".format(codecs, hello)
+        elif max_msg_size < MIN_NEGOTIATED_MSG_SIZE:
+            error = "Наибольший размер сообщения должен быть не меньше " \
+                "{} байт.\nmsg = {}".format(MIN_NEGOTIATED_MSG_SIZE, hello)
+        else:
+            return {
+                'type': 'hello_ack',
+                'protocol_version': max(versions),
+                'codec': codec,
+                'compression': choose_option(
+                    hello['compression'], COMPRESSIONS),
+                'max_msg_size': max_msg_size,
+                'tick_rate': tick_rate
+            }
+    return {
+        'type': 'error_msg',
+        'error_class': 'ValueError',
+        'msg': error
+    }
+
+
+# Возвращает `FrameEncoding`, выбранный в сообщении 'hello_ack' `ack`, или
+# `None`, если выбранные варианты не поддерживаются.
+def get_hello_ack_encoding(ack):
+    if ack.get('protocol_version') in PROTOCOL_VERSIONS \
+            and ack.get('codec') in CODECS \
+            and (
+                ack.get('compression') is None
+                or ack.get('compression') in COMPRESSIONS
+            ) \
+            and isinstance(ack.get('max_msg_size'), int) \
+            and MIN_NEGOTIATED_MSG_SIZE <= ack['max_msg_size'] \
+            <= MAX_MSG_SIZE:
+        return FrameEncoding(
+            ack['codec'], ack['compression'], ack['max_msg_size'])
+    return None
+
+
+def quantize_coord(value):
+    return int(round(value / COORDS_QUANTUM))
+
+
+def dequantize_coord(value):
+    return value * COORDS_QUANTUM
+
+
+# `compression` -- способ сжатия, поддерживаемый получателем, или `None`.
+# Небольшие сообщения и сообщения, которые не удалось уменьшить, не
+# сжимаются. `max_msg_size` -- наибольший размер сообщения, который может
+# принять получатель.
+def encode_frame(
+        data, codec=DEFAULT_CODEC, compression=None,
+        max_msg_size=MAX_MSG_SIZE
+):
+    data = CODECS[codec].encode(data)
     length = len(data)
-    if length > MAX_MSG_SIZE:
+    if length > max_msg_size:
         raise ValueError(
             "Размер закодированного объекта для отправки равен {} байт, в то "
             "время как максимально допустимый размер составляет {}".format(
-                length, MAX_MSG_SIZE))
-    msg = len(data).to_bytes(NUM_BYTES_FOR_MSG_LENGTH, MSG_BYTEORDER)
-    conn.sendall(msg + data)
-
-
-def parse_received(conn, data, addr):
-    msgs = []
-    i = 0
-    error_msg = None
-    while i < len(data):
-        length_encoded = data[i: i + NUM_BYTES_FOR_MSG_LENGTH]
-        length = int.from_bytes(length_encoded, MSG_BYTEORDER)
-        if i + length + NUM_BYTES_FOR_MSG_LENGTH > len(data):
-            dump_fn = get_dump_fn_for_corrupted_data(addr)
-            dump_corrupted_data(data, dump_fn)
-            error_msg = OUT_OF_BOUNDS_CORRUPTED_MSG_TMPL.format(
-                start=i,
-                length_end=i+NUM_BYTES_FOR_MSG_LENGTH,
-                data_length=len(data),
-                addr=addr,
-                length=length,
-                dump_fn=dump_fn,
+                length, max_msg_size))
+    header = length
+    if compression is not None and length >= COMPRESSION_THRESHOLD:
+        compressed = compress_payload(data, compression)
+        if len(compressed) < length:
+            data = compressed
+            header = len(data) \
+                | COMPRESSION_IDS[compression] << COMPRESSION_SHIFT
+    return header.to_bytes(NUM_BYTES_FOR_MSG_LENGTH, MSG_BYTEORDER) + data
+
+
+# Декодирует датаграмму, закодированную `encode_frame()` кодеком
+# 'binary'. В отличие от потока TCP, граница сообщения известна, поэтому
+# длина в заголовке должна совпадать с длиной датаграммы. Декодируются
+# только сообщения с тегами из `tags`. Сжатые датаграммы принимаются, если
+# `compressed_ok` истинно. Исключения `DECODING_ERRORS` обрабатываются
+# вызывающим кодом.
+def decode_datagram(data, tags, compressed_ok=True):
+    header = int.from_bytes(
+        data[:NUM_BYTES_FOR_MSG_LENGTH], MSG_BYTEORDER)
+    length = header & MSG_LENGTH_MASK
+    if length != len(data) - NUM_BYTES_FOR_MSG_LENGTH:
+        raise ValueError(
+            "Длина датаграммы {} не совпадает с длиной сообщения {} в "
+            "заголовке".format(len(data), length))
+    payload = memoryview(data)[NUM_BYTES_FOR_MSG_LENGTH:]
+    compression_id = header >> COMPRESSION_SHIFT
+    if compression_id:
+        if not compressed_ok:
+            raise ValueError("Датаграмма не должна быть сжата")
+        payload = decompress_payload(payload, compression_id)
+    if payload[0] not in tags:
+        raise ValueError(
+            "Сообщение с тегом {} не передается по UDP".format(payload[0]))
+    return decode_payload(payload)
+
+
+def send_data(conn, data, codec=DEFAULT_CODEC, compression=None):
+    conn.sendall(encode_frame(data, codec, compression))
+
+
+# Разбивает поток данных, принимаемых через сокет `conn`, на сообщения.
+# Для каждого соединения создается свой экземпляр. Данные читаются методом
+# `recv_into()` в растущий буфер. Полностью принятые сообщения декодируются
+# без копирования, а начало сообщения, не поместившегося в уже принятые
+# данные, остается в буфере до следующего вызова `receive()`.
+# Если `keep_frames` равен `True`, закодированные сообщения вместе с
+# заголовком сохраняются в списке `self.frames` в том же порядке, что и
+# декодированные. Это позволяет пересылать сообщения без повторного
+# кодирования. Список очищается вызывающим кодом.
+class StreamFramer:
+    def __init__(self, conn, addr, keep_frames=False):
+        self.conn = conn
+        self.addr = addr
+        self.frames = [] if keep_frames else None
+        self.buffer = bytearray(INITIAL_RECV_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        # Принятые, но еще не разобранные данные лежат в
+        # `self.buffer[self.start:self.end]`.
+        self.start = 0
+        self.end = 0
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+
+    def make_room(self):
+        if self.end < len(self.buffer):
+            return
+        pending = self.end - self.start
+        if self.start > 0:
+            # Размер `self.buffer` не меняется, поэтому присваивание срезу
+            # допустимо, несмотря на существование `self.view`.
+            self.buffer[:pending] = self.view[self.start:self.end]
+        else:
+            new_buffer = bytearray(min(
+                2 * len(self.buffer),
+                MAX_MSG_SIZE + NUM_BYTES_FOR_MSG_LENGTH
+            ))
+            new_buffer[:pending] = self.view[:pending]
+            self.view.release()
+            self.buffer = new_buffer
+            self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = pending
+
+    def corrupted_data_error(self, tmpl, length, **kwargs):
+        data = bytes(self.view[self.start:self.end])
+        dump_fn = get_dump_fn_for_corrupted_data(self.addr)
+        dump_corrupted_data(data, dump_fn)
+        error_msg = tmpl.format(
+            start=0,
+            addr=self.addr,
+            length=length,
+            dump_fn=dump_fn,
+            **kwargs
+        )
+        return CorruptedMessageError(error_msg, data, 0, length)
+
+    def parse(self, msgs):
+        while self.end - self.start >= NUM_BYTES_FOR_MSG_LENGTH:
+            header = int.from_bytes(
+                self.view[self.start:self.start + NUM_BYTES_FOR_MSG_LENGTH],
+                MSG_BYTEORDER
             )
-            break
-        i += NUM_BYTES_FOR_MSG_LENGTH
-        try:
-            msg = pickle.loads(data[i: i+length])
-        except pickle.UnpicklingError:
-            dump_fn = get_dump_fn_for_corrupted_data(addr)
-            dump_corrupted_data(data, dump_fn)
-            error_msg = UNPICKLING_CORRUPTED_MSG_TMPL.format(
-                    start=i-NUM_BYTES_FOR_MSG_LENGTH,
-                    start_pickled=i,
-                    end_pickled=i+length,
-                    addr=addr,
-                    length=length,
-                    dump_fn=dump_fn
+            length = header & MSG_LENGTH_MASK
+            compression_id = header >> COMPRESSION_SHIFT
+            if length > MAX_MSG_SIZE:
+                error = self.corrupted_data_error(
+                    TOO_LONG_CORRUPTED_MSG_TMPL,
+                    length,
+                    max_length=MAX_MSG_SIZE
                 )
-            break
-        i += length
-        msgs.append(msg)
-    if error_msg is not None:
-        send_data(
+                # После такой ошибки границы сообщений в потоке неизвестны.
+                self.reset()
+                return error
+            msg_start = self.start + NUM_BYTES_FOR_MSG_LENGTH
+            msg_end = msg_start + length
+            if msg_end > self.end:
+                # Сообщение принято не полностью.
+                break
+            try:
+                payload = self.view[msg_start:msg_end]
+                if compression_id:
+                    payload = decompress_payload(payload, compression_id)
+                msgs.append(decode_payload(payload))
+                if self.frames is not None:
+                    self.frames.append(bytes(self.view[self.start:msg_end]))
+            except DECODING_ERRORS:
+                error = self.corrupted_data_error(
+                    DECODING_CORRUPTED_MSG_TMPL,
+                    length,
+                    start_pickled=NUM_BYTES_FOR_MSG_LENGTH,
+                    end_pickled=NUM_BYTES_FOR_MSG_LENGTH + length
+                )
+                # Границы сообщений не нарушены, поэтому пропускается только
+                # поврежденное сообщение.
+                self.start = msg_end
+                return error
+            self.start = msg_end
+        if self.start == self.end:
+            self.reset()
+        return None
+
+    # Разбирает данные, принятые без участия `self.conn`, например, через
+    # `asyncio.StreamReader`.
+    def feed(self, data):
+        msgs = []
+        error_instance = None
+        data = memoryview(data)
+        while data and error_instance is None:
+            self.make_room()
+            n = min(len(data), len(self.buffer) - self.end)
+            self.view[self.end:self.end + n] = data[:n]
+            self.end += n
+            data = data[n:]
+            error_instance = self.parse(msgs)
+        return msgs, error_instance
+
+    def receive(self):
+        msgs = []
+        error_instance = None
+        while error_instance is None:
+            self.make_room()
+            try:
+                n = self.conn.recv_into(self.view[self.end:])
+            except Exception as e:
+                error_instance = e
+                break
+            if not n:
+                # Корреспондент закрыл соединение.
+                error_instance = ConnectionResetError(
+                    CONNECTION_CLOSED_WARNING_TMPL.format(self.addr))
+                break
+            self.end += n
+            error_instance = self.parse(msgs)
+        return msgs, error_instance
+
+
+# Очередь закодированных сообщений, ожидающих отправки через сокет `conn`.
+# Сообщения накапливаются в течение итерации цикла сервера и отправляются
+# методом `flush()` одним вызовом `socket.sendmsg()`. Одно и то же
+# сообщение, отправляемое всем игрокам, кодируется один раз, а в очереди
+# каждого игрока хранится ссылка на него.
+#
+# Размер очереди ограничен `max_buffered_bytes`. Если корреспондент не
+# успевает принимать данные и очередь переполняется, то при политике
+# 'drop' из очереди удаляются устаревшие сообщения: из сообщений с
+# одинаковым ключом `key` остается только последнее. Если этого
+# недостаточно, или политика 'disconnect', очередь помечается как
+# переполненная (`self.overflowed`), новые сообщения не принимаются, и
+# соединение должно быть закрыто вызывающим кодом.
+class OutboundQueue:
+    def __init__(
+            self,
             conn,
-            {
-                'type': 'error_msg',
-                'error_class': 'CorruptedMessageError',
-                'msg': error_msg,
-                'data': data,
-                'i': i,
-                'length': length
-            }
-        )
-        raise CorruptedMessageError(error_msg, data, i, length)
-    return msgs
+            addr,
+            max_buffered_bytes=DEFAULT_MAX_OUTPUT_BUFFER_SIZE,
+            slow_consumer_policy=DEFAULT_SLOW_CONSUMER_POLICY
+    ):
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(
+                "Неизвестная политика обработки медленных корреспондентов "
+                "{}. Поддерживаются политики {}.".format(
+                    repr(slow_consumer_policy), SLOW_CONSUMER_POLICIES)
+            )
+        self.conn = conn
+        self.addr = addr
+        self.max_buffered_bytes = max_buffered_bytes
+        self.slow_consumer_policy = slow_consumer_policy
+        # Элементы очереди -- пары из закодированного сообщения и ключа.
+        self.frames = collections.deque()
+        self.num_buffered_bytes = 0
+        # Число уже отправленных байтов первого сообщения в очереди.
+        self.offset = 0
+        self.overflowed = False
+        # Способ кодирования сообщений, согласованный с корреспондентом.
+        self.encoding = DEFAULT_ENCODING
 
+    def put(self, frame, key=None):
+        if self.overflowed:
+            return
+        self.frames.append((frame, key))
+        self.num_buffered_bytes += len(frame)
+        if self.num_buffered_bytes > self.max_buffered_bytes:
+            if self.slow_consumer_policy == 'drop':
+                self.drop_stale_frames()
+            if self.num_buffered_bytes > self.max_buffered_bytes:
+                self.overflowed = True
 
-def recv_data(conn, addr):
-    data = b''
-    error_instance = None
-    buffer = b''
-    while True:
-        try:
-            buffer = conn.recv(BUFFER_SIZE)
-        except Exception as e:
-            error_instance = e
-        if buffer is None or not buffer:
-            break
-        data += buffer
-        buffer = b''
-        if error_instance is not None:
-            break
-    return parse_received(conn, data, addr), error_instance
-
-
-def send_data_quite(conn, addr, data):
+    def put_data(self, data, key=None):
+        self.put(encode_frame(data, *self.encoding), key)
+
+    def drop_stale_frames(self):
+        # Первое сообщение могло быть отправлено частично, поэтому оно
+        # всегда остается в очереди.
+        first = self.frames.popleft()
+        kept = collections.deque()
+        seen_keys = set()
+        for frame, key in reversed(self.frames):
+            if key is not None:
+                if key in seen_keys:
+                    self.num_buffered_bytes -= len(frame)
+                    continue
+                seen_keys.add(key)
+            kept.appendleft((frame, key))
+        kept.appendleft(first)
+        self.frames = kept
+
+    def __bool__(self):
+        return bool(self.frames)
+
+    def wants_write(self):
+        return bool(self.frames) and not self.overflowed
+
+    def send_buffers(self, buffers):
+        if hasattr(self.conn, 'sendmsg'):
+            return self.conn.sendmsg(buffers)
+        # В Windows `socket.sendmsg()` нет.
+        return self.conn.send(b''.join(buffers))
+
+    def consume(self, num_bytes):
+        self.num_buffered_bytes -= num_bytes
+        num_bytes += self.offset
+        while self.frames and num_bytes >= len(self.frames[0][0]):
+            num_bytes -= len(self.frames.popleft()[0])
+        self.offset = num_bytes
+
+    # Отправляет столько сообщений, сколько принимает сокет, не блокируя
+    # выполнение программы. Возвращает `True`, если очередь опустела. Если
+    # сокет не может принять все данные, отправка продолжается с того же
+    # байта при следующем вызове, который следует делать, когда сокет будет
+    # готов к записи. Исключения, связанные с обрывом соединения,
+    # обрабатываются вызывающим кодом.
+    def flush(self):
+        while self.frames:
+            buffers = [
+                frame for frame, _ in
+                itertools.islice(self.frames, MAX_NUM_BUFFERS_PER_SENDMSG)
+            ]
+            if self.offset:
+                buffers[0] = memoryview(buffers[0])[self.offset:]
+            try:
+                sent = self.send_buffers(buffers)
+            except BlockingIOError:
+                return False
+            self.consume(sent)
+            if sent < sum(map(len, buffers)):
+                return False
+        return True
+
+
+def send_data_quite(conn, addr, data, codec=DEFAULT_CODEC):
     try:
-        send_data(conn, data)
+        send_data(conn, data, codec)
     except BrokenPipeError as e:
         warnings.warn(e)
         warn_no_msg_was_sent(data, addr)
@@ -0,0 +1,24 @@
+import sys
+
+import pytest
+
+from server import CubeGameServer, get_app_args
+
+
+@pytest.fixture
+def server_config(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['server.py'])
+    config = vars(get_app_args())
+    config.update(
+        address='unix://{}'.format(tmp_path / 'server.sock'),
+        num_cubes=3,
+        engine='polling'
+    )
+    return config
+
+
+@pytest.fixture
+def server(server_config):
+    server = CubeGameServer(server_config)
+    yield server
+    server.close_all_sockets()
@@ -0,0 +1,137 @@
+import random
+from array import array
+
+import colors
+
+
+COLOR_INDICES = {color: i for i, color in enumerate(colors.ALL_COLORS)}
+
+
+def random_column(typecode, num_values, start, stop):
+    # Случайные числа из диапазона [start, stop) для всего столбца
+    # генерируются одним вызовом `random.randbytes()`.
+    raw = array('I', random.randbytes(4 * num_values))
+    span = stop - start
+    return array(typecode, [start + value % span for value in raw])
+
+
+# Хранилище кубиков в виде столбцов (structure of arrays). Свойства кубика с
+# id `id_` хранятся в элементах с индексом `id_ - 1` столбцов `self.x`,
+# `self.y`, `self.size`, `self.color` (индекс цвета в `colors.ALL_COLORS`),
+# `self.grabbed`, `self.alive` и `self.z`. id удаленных кубиков хранятся в
+# `self.free_ids` и выдаются новым кубикам в первую очередь. `self.z` --
+# порядковый номер создания кубика: в клиентской части программы кубики
+# создаются в этом порядке, поэтому кубик с большим `z` рисуется поверх
+# кубиков с меньшим.
+class CubeStore:
+    def __init__(self):
+        self.x = array('i')
+        self.y = array('i')
+        self.size = array('i')
+        self.color = array('H')
+        self.grabbed = array('B')
+        self.alive = array('B')
+        self.z = array('I')
+        self.columns = [
+            self.x, self.y, self.size, self.color, self.grabbed, self.alive,
+            self.z
+        ]
+        self.next_z = 0
+        # Ключи -- id схваченных кубиков, значения -- точки захвата.
+        self.grabbing_points = {}
+        self.free_ids = []
+        self.num_cubes = 0
+
+    def __len__(self):
+        return self.num_cubes
+
+    def __contains__(self, id_):
+        return isinstance(id_, int) and 1 <= id_ <= len(self.alive) \
+            and self.alive[id_ - 1] == 1
+
+    def ids(self):
+        for i, alive in enumerate(self.alive):
+            if alive:
+                yield i + 1
+
+    def allocate_id(self):
+        if self.free_ids:
+            return self.free_ids.pop()
+        for column in self.columns:
+            column.append(0)
+        return len(self.alive)
+
+    def add(self, x, y, size, color):
+        id_ = self.allocate_id()
+        i = id_ - 1
+        self.x[i] = x
+        self.y[i] = y
+        self.size[i] = size
+        self.color[i] = COLOR_INDICES[color]
+        self.grabbed[i] = 0
+        self.alive[i] = 1
+        self.z[i] = self.next_z
+        self.next_z += 1
+        self.num_cubes += 1
+        return id_
+
+    # Добавляет кубики со свойствами из столбцов `x`, `y`, `size` и
+    # `color_idx` (экземпляров `array.array`) и возвращает их id. Если
+    # свободных id нет, столбцы хранилища дополняются целиком.
+    def add_many(self, x, y, size, color_idx):
+        if self.free_ids:
+            return [
+                self.add(*cube[:3], colors.ALL_COLORS[cube[3]])
+                for cube in zip(x, y, size, color_idx)
+            ]
+        start = len(self.alive) + 1
+        self.x.extend(x)
+        self.y.extend(y)
+        self.size.extend(size)
+        self.color.extend(color_idx)
+        self.grabbed.frombytes(bytes(len(x)))
+        self.alive.frombytes(b'\x01' * len(x))
+        self.z.extend(range(self.next_z, self.next_z + len(x)))
+        self.next_z += len(x)
+        self.num_cubes += len(x)
+        return range(start, start + len(x))
+
+    def remove(self, id_):
+        self.alive[id_ - 1] = 0
+        self.grabbed[id_ - 1] = 0
+        self.grabbing_points.pop(id_, None)
+        self.free_ids.append(id_)
+        self.num_cubes -= 1
+
+    def get_grabbing_point(self, id_):
+        return self.grabbing_points.get(id_)
+
+    def set_grabbing_point(self, id_, point):
+        if point is None:
+            self.grabbed[id_ - 1] = 0
+            self.grabbing_points.pop(id_, None)
+        else:
+            self.grabbed[id_ - 1] = 1
+            self.grabbing_points[id_] = point
+
+    def get_rect(self, id_):
+        i = id_ - 1
+        x, y, size = self.x[i], self.y[i], self.size[i]
+        return x, y, x + size, y + size
+
+    def get_color(self, id_):
+        return colors.ALL_COLORS[self.color[id_ - 1]]
+
+    def create_random_cubes(
+            self, num_cubes, xrange, yrange, size_range, color_choices):
+        color_indices = [COLOR_INDICES[color] for color in color_choices]
+        color_idx = array('H', [
+            color_indices[i] for i in random_column(
+                'I', num_cubes, 0, len(color_indices))
+        ])
+        return self.add_many(
+            random_column('i', num_cubes, *xrange),
+            random_column('i', num_cubes, *yrange),
+            random_column('i', num_cubes, *size_range),
+            color_idx
+        )
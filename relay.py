@@ -0,0 +1,556 @@
+import argparse
+import selectors
+import warnings
+
+from communicate import StreamFramer, OutboundQueue, CorruptedMessageError, \
+    encode_frame, dequantize_coord, warn_no_msg_was_sent, \
+    make_hello_msg, make_hello_ack_msg, get_hello_ack_encoding, \
+    FrameEncoding, DEFAULT_ENCODING, \
+    MIN_PORT_NUMBER, MAX_PORT_NUMBER, DEFAULT_PORT_NUMBER, \
+    MAX_ROOM_NAME_LENGTH, DEFAULT_MAX_OUTPUT_BUFFER_SIZE, MAX_MSG_SIZE, \
+    NUM_BYTES_FOR_MSG_LENGTH, SLOW_CONSUMER_WARNING_TMPL, \
+    CONNECTION_ABORTED_ERROR_WARNING_TMPL, \
+    CONNECTION_RESET_ERROR_WARNING_TMPL
+from schema import CLIENT_MSG_TYPES, has_known_type
+from server import create_listener, make_add_cubes_msgs, \
+    get_add_cubes_chunk_size
+from transport import parse_address, make_tcp_address, create_connection, \
+    accept, close_listener, get_addr
+
+
+DEFAULT_RELAY_PORT_NUMBER = DEFAULT_PORT_NUMBER + 1
+DEFAULT_ROOM_NAME = 'default'
+DEFAULT_MAX_NUM_SPECTATORS = 10000
+MAX_NUM_SPECTATORS_LIMIT = 100000
+
+
+def get_app_args():
+    parser = argparse.ArgumentParser(
+        "Это скрипт для запуска ретранслятора игры 'Cube Game'. "
+        "Ретранслятор подключается к комнате сервера как один зритель и "
+        "пересылает принятые от сервера сообщения без повторного "
+        "кодирования всем подключенным к нему зрителям. Сервер при этом "
+        "обслуживает одно соединение независимо от числа зрителей. Чтобы "
+        "наблюдать за игрой, запустите client.py с параметром `--spectator` "
+        "и передайте ip и порт ретранслятора."
+    )
+    parser.add_argument(
+        '--server_ip',
+        '-i',
+        help="IPv4 сервера. Значение по умолчанию 'localhost'.",
+        default='localhost'
+    )
+    parser.add_argument(
+        "--server_port",
+        "-p",
+        help="Порт сервера. Разрешенные значения: {} - {}. Значение по "
+             "умолчанию {}.".format(
+                 MIN_PORT_NUMBER, MAX_PORT_NUMBER, DEFAULT_PORT_NUMBER),
+        type=int,
+        default=DEFAULT_PORT_NUMBER
+    )
+    parser.add_argument(
+        "--server_address",
+        help="Адрес сервера: 'tcp://HOST:PORT' или 'unix://PATH'. Если "
+             "задан, `--server_ip` и `--server_port` не используются.",
+        default=None
+    )
+    parser.add_argument(
+        "--room",
+        "-r",
+        help="Название комнаты на сервере, за которой наблюдают зрители. "
+             "Значение по умолчанию '{}'.".format(DEFAULT_ROOM_NAME),
+        default=DEFAULT_ROOM_NAME
+    )
+    parser.add_argument(
+        "--relay_port",
+        help="Порт, через который к ретранслятору подключаются зрители. "
+             "Разрешенные значения: {} - {}. Значение по умолчанию "
+             "{}.".format(
+                 MIN_PORT_NUMBER, MAX_PORT_NUMBER, DEFAULT_RELAY_PORT_NUMBER),
+        type=int,
+        default=DEFAULT_RELAY_PORT_NUMBER
+    )
+    parser.add_argument(
+        "--relay_address",
+        help="Адрес, на котором ретранслятор принимает подключения "
+             "зрителей: 'tcp://HOST:PORT' или 'unix://PATH'. По умолчанию "
+             "'tcp://:PORT', где PORT -- значение `--relay_port`.",
+        default=None
+    )
+    parser.add_argument(
+        "--max_num_spectators",
+        help="Максимальное число зрителей. Разрешенные значения: 1 - {}. "
+             "Значение по умолчанию {}.".format(
+                 MAX_NUM_SPECTATORS_LIMIT, DEFAULT_MAX_NUM_SPECTATORS),
+        type=int,
+        default=DEFAULT_MAX_NUM_SPECTATORS
+    )
+    parser.add_argument(
+        "--max_output_buffer",
+        help="Максимальный размер в байтах очереди неотправленных "
+             "сообщений одного зрителя. Если зритель не успевает принимать "
+             "данные и очередь переполняется, соединение с ним закрывается. "
+             "Значение должно быть не меньше {}. Значение по умолчанию "
+             "{}.".format(
+                 MAX_MSG_SIZE + NUM_BYTES_FOR_MSG_LENGTH,
+                 DEFAULT_MAX_OUTPUT_BUFFER_SIZE),
+        type=int,
+        default=DEFAULT_MAX_OUTPUT_BUFFER_SIZE
+    )
+    return parser.parse_args()
+
+
+# Ретранслятор подключается к комнате `config['room']` сервера как зритель
+# и пересылает зрителям, подключенным к нему, закодированные сообщения
+# сервера в том виде, в котором они были приняты. Сервер отправляет
+# зрителям координаты всех кубиков, поэтому сообщения годятся для любого
+# зрителя.
+#
+# Чтобы инициализировать зрителей, подключившихся позже ретранслятора, он
+# поддерживает копию мира: размеры мира, кубики с текущими координатами и
+# команду 'bind_all'. Новый зритель получает команды, воспроизводящие эту
+# копию, после чего -- все последующие сообщения сервера. Снимок копии
+# кодируется один раз для всех зрителей, инициализированных между двумя
+# сообщениями сервера. Снимок сжимается для зрителей, поддерживающих
+# сжатие. Сообщения сервера пересылаются без изменений, поэтому
+# ретранслятор не просит сервер сжимать их, а зрители должны поддерживать
+# кодек, выбранный сервером для ретранслятора.
+#
+# Получение сообщений 'delta' подтверждает серверу ретранслятор.
+# Подтверждения зрителей не нужны, так как каждое сообщение 'delta'
+# пересылается всем зрителям. По той же причине сообщения 'delta' нельзя
+# удалять из очереди медленного зрителя, и при переполнении очереди
+# соединение со зрителем закрывается.
+class CubeGameRelay:
+    def __init__(self, config):
+        self.check_config(config)
+
+        server_address = config['server_address']
+        if server_address is None:
+            server_address = make_tcp_address(
+                config['server_ip'], config['server_port'])
+        self.server_addr = get_addr(server_address)
+        self.room = config['room']
+        self.relay_address = config['relay_address']
+        if self.relay_address is None:
+            self.relay_address = make_tcp_address('', config['relay_port'])
+        self.max_num_spectators = config['max_num_spectators']
+        self.max_output_buffer = config['max_output_buffer']
+
+        self.selector = selectors.DefaultSelector()
+
+        self.conn_to_server = create_connection(server_address)
+        self.conn_to_server.settimeout(0)
+        self.framer = StreamFramer(
+            self.conn_to_server, self.server_addr, keep_frames=True)
+        self.outbox = OutboundQueue(self.conn_to_server, self.server_addr)
+        self.selector.register(self.conn_to_server, selectors.EVENT_READ)
+        hello = make_hello_msg()
+        hello['compression'] = []
+        self.send_to_server(hello)
+        self.send_to_server(
+            {'type': 'join', 'room': self.room, 'role': 'spectator'})
+        # Частота тактов сервера, о которой ретранслятор сообщает
+        # зрителям. Становится известна из ответа сервера на 'hello'.
+        self.tick_rate = None
+
+        # Копия мира. `self.cubes` -- словарь, ключи в котором -- id
+        # кубиков, а значения -- списки [id, x, y, size, индекс цвета, z],
+        # как в записях команды 'add_cubes'. `self.version` -- последняя
+        # версия мира, полученная от сервера.
+        self.world_shape_frame = None
+        self.bind_all_frame = None
+        self.cubes = {}
+        self.version = 0
+        # Закодированные команды, воспроизводящие копию мира. Ключи в
+        # словаре -- способы кодирования `FrameEncoding`. Словарь очищается,
+        # когда копия мира изменяется.
+        self.snapshot_frames = {}
+
+        self.listener = create_listener(
+            self.relay_address, self.max_num_spectators)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+
+        # Ключи в словарях -- адреса зрителей.
+        self.conns_to_clients = {}
+        self.framers = {}
+        self.outboxes = {}
+        # Адреса зрителей, приславших сообщение 'join' до того, как
+        # ретранслятор получил копию мира.
+        self.waiting_spectators = set()
+        # Адреса зрителей, которым пересылаются сообщения сервера.
+        self.spectators = set()
+
+    @staticmethod
+    def check_config(config):
+        for key in ['server_port', 'relay_port']:
+            if config[key] > MAX_PORT_NUMBER \
+                    or config[key] < MIN_PORT_NUMBER:
+                raise ValueError(
+                    "Запрещенный номер порта:\n"
+                    "config['{}'] = {}\n"
+                    "Разрещенные порты: {} - {}.".format(
+                        key, config[key], MIN_PORT_NUMBER, MAX_PORT_NUMBER)
+                )
+        if not (1 <= len(config['room']) <= MAX_ROOM_NAME_LENGTH):
+            raise ValueError(
+                "Название комнаты должно содержать от {} до {} символов, в "
+                "то время как\nconfig['room'] = {}".format(
+                    1, MAX_ROOM_NAME_LENGTH, repr(config['room']))
+            )
+        if not (
+                1 <= config['max_num_spectators'] <= MAX_NUM_SPECTATORS_LIMIT
+        ):
+            raise ValueError(
+                "Максимальное число зрителей должно быть в диапазоне от {} "
+                "до {}, в то время как\nconfig['max_num_spectators'] = "
+                "{}".format(
+                    1, MAX_NUM_SPECTATORS_LIMIT, config['max_num_spectators'])
+            )
+        for key in ['server_address', 'relay_address']:
+            if config[key] is not None:
+                parse_address(config[key])
+        if config['max_output_buffer'] \
+                < MAX_MSG_SIZE + NUM_BYTES_FOR_MSG_LENGTH:
+            raise ValueError(
+                "Очередь неотправленных сообщений должна вмещать хотя бы "
+                "одно сообщение максимального размера {} байт, в то время "
+                "как\nconfig['max_output_buffer'] = {}".format(
+                    MAX_MSG_SIZE + NUM_BYTES_FOR_MSG_LENGTH,
+                    config['max_output_buffer'])
+            )
+
+    def mainloop(self):
+        while True:
+            for key, mask in self.selector.select():
+                if key.fileobj is self.listener:
+                    self.connect_to_clients()
+                    continue
+                if key.fileobj is self.conn_to_server:
+                    if mask & selectors.EVENT_READ:
+                        self.receive_from_server()
+                    if mask & selectors.EVENT_WRITE:
+                        self.flush_to_server()
+                    continue
+                addr = key.data
+                if mask & selectors.EVENT_READ \
+                        and addr in self.conns_to_clients:
+                    self.receive_from_client(addr)
+                if mask & selectors.EVENT_WRITE \
+                        and addr in self.conns_to_clients:
+                    self.flush_outbox(addr)
+            self.flush_to_server()
+            self.flush_outboxes()
+
+    def send_to_server(self, msg, key=None):
+        try:
+            self.outbox.put_data(msg, key=key)
+        except ValueError as e:
+            warnings.warn(e)
+            warn_no_msg_was_sent(msg, self.server_addr)
+
+    def flush_to_server(self):
+        if self.outbox:
+            self.outbox.flush()
+        events = selectors.EVENT_READ
+        if self.outbox.wants_write():
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(self.conn_to_server).events != events:
+            self.selector.modify(self.conn_to_server, events)
+
+    # Обрыв соединения с сервером завершает работу ретранслятора.
+    def receive_from_server(self):
+        try:
+            msgs, e = self.framer.receive()
+            frames = self.framer.frames
+            self.framer.frames = []
+            for msg, frame in zip(msgs, frames):
+                self.process_server_msg(msg, frame)
+            if e is not None:
+                raise e
+        except CorruptedMessageError as e:
+            warnings.warn(e.message)
+            self.send_to_server(e.get_error_msg())
+        except BlockingIOError:
+            pass
+
+    def process_server_msg(self, msg, frame):
+        if msg['type'] == 'error_msg':
+            warnings.warn(
+                'Пришло сообщение об ошибке от сервера\n'
+                'Сообщение:\n' +
+                msg['msg']
+            )
+            return
+        if msg['type'] == 'hello_ack':
+            encoding = get_hello_ack_encoding(msg)
+            if encoding is None:
+                warnings.warn(
+                    "Сервер выбрал неподдерживаемый способ кодирования "
+                    "сообщений.\nmsg = {}".format(msg))
+            else:
+                self.outbox.encoding = encoding
+                self.tick_rate = msg['tick_rate']
+            return
+        if msg['type'] != 'command':
+            warnings.warn(
+                "Сообщение неизвестного типа {} пришло от сервера.".format(
+                    repr(msg['type'])))
+            return
+        command = msg['command']
+        if command['type'] == 'world_shape':
+            self.world_shape_frame = frame
+        elif command['type'] == 'add_cubes':
+            for cube in command['cubes']:
+                self.cubes[cube[0]] = list(cube)
+            self.version = command['version']
+        elif command['type'] == 'remove_cube':
+            self.cubes.pop(command['id'], None)
+        elif command['type'] == 'delta':
+            for id_, x, y in command['cubes']:
+                cube = self.cubes[id_]
+                cube[1] = dequantize_coord(x)
+                cube[2] = dequantize_coord(y)
+            self.version = command['version']
+            self.send_to_server(
+                {'type': 'ack', 'version': command['version']}, key='ack')
+        elif command['type'] == 'bind_all':
+            self.bind_all_frame = frame
+        self.snapshot_frames.clear()
+        for addr in self.spectators:
+            self.outboxes[addr].put(frame)
+        if self.is_initialized():
+            for addr in self.waiting_spectators:
+                self.init_spectator(addr)
+            self.waiting_spectators.clear()
+
+    def is_initialized(self):
+        return self.bind_all_frame is not None
+
+    # Команды, воспроизводящие копию мира. Кубики создаются в порядке 'z'.
+    def get_snapshot_frames(self, encoding=DEFAULT_ENCODING):
+        if encoding not in self.snapshot_frames:
+            records = sorted(
+                map(tuple, self.cubes.values()), key=lambda cube: cube[5])
+            msgs = make_add_cubes_msgs(
+                self.version, records, get_add_cubes_chunk_size(encoding))
+            self.snapshot_frames[encoding] = [self.world_shape_frame] + [
+                encode_frame(msg, *encoding) for msg in msgs
+            ] + [self.bind_all_frame]
+        return self.snapshot_frames[encoding]
+
+    def init_spectator(self, addr):
+        outbox = self.outboxes[addr]
+        for frame in self.get_snapshot_frames(outbox.encoding):
+            outbox.put(frame)
+        self.spectators.add(addr)
+
+    def connect_to_clients(self):
+        while len(self.conns_to_clients) < self.max_num_spectators:
+            try:
+                conn, addr = accept(self.listener)
+            except BlockingIOError:
+                return
+            self.add_spectator(conn, addr)
+        self.selector.unregister(self.listener)
+
+    def add_spectator(self, conn, addr):
+        conn.settimeout(0)
+        self.conns_to_clients[addr] = conn
+        self.framers[addr] = StreamFramer(conn, addr)
+        self.outboxes[addr] = OutboundQueue(
+            conn, addr, self.max_output_buffer, 'disconnect')
+        self.selector.register(conn, selectors.EVENT_READ, addr)
+
+    def receive_from_client(self, addr):
+        try:
+            msgs, e = self.framers[addr].receive()
+            for msg in msgs:
+                if addr not in self.conns_to_clients:
+                    return
+                self.process_client_msg(addr, msg)
+            if e is not None:
+                raise e
+        except CorruptedMessageError as e:
+            warnings.warn(e.message)
+            self.send_to_spectator(addr, e.get_error_msg())
+        except BlockingIOError:
+            pass
+        except (ConnectionResetError, ConnectionAbortedError) as e:
+            warnings.warn(e)
+            self.disconnect_spectator(addr)
+        except Exception as e:
+            self.handle_unexpected_error(addr, e)
+
+    # Исключение `e`, для которого нет обработчика, возникло при обработке
+    # сообщения зрителя `addr`. Соединение закрывается только с этим
+    # зрителем, остальные зрители продолжают получать сообщения сервера.
+    def handle_unexpected_error(self, addr, e):
+        warnings.warn(e)
+        warnings.warn(
+            "Для исключения типа {} не был написан обработчик. Возможно, "
+            "стоит это сделать. Соединение со зрителем {} будет "
+            "закрыто.".format(type(e), addr)
+        )
+        if addr in self.conns_to_clients:
+            self.disconnect_spectator(addr)
+
+    # Зрители могут только войти в комнату ретранслятора. Подтверждения,
+    # видимая область и 'heartbeat' не нужны и пропускаются.
+    def process_client_msg(self, addr, msg):
+        if not has_known_type(msg, CLIENT_MSG_TYPES):
+            self.warn_spectator(
+                addr,
+                "Сообщение неизвестного типа пришло от зрителя {}. "
+                "Сообщение должно быть словарем со значением 'type' из "
+                "{}.\nmsg = {}".format(
+                    addr, sorted(CLIENT_MSG_TYPES), repr(msg))
+            )
+        elif msg['type'] == 'join':
+            self.join(addr, msg)
+        elif msg['type'] == 'hello':
+            self.negotiate(addr, msg)
+        elif msg['type'] == 'error_msg':
+            warnings.warn(
+                'Пришло сообщение об ошибке от зрителя {}\n'
+                'Сообщение:\n{}'.format(addr, msg.get('msg'))
+            )
+        elif msg['type'] in ['ack', 'viewport', 'heartbeat']:
+            pass
+        else:
+            self.warn_spectator(
+                addr,
+                "Сообщение типа {} пришло от зрителя {}. Зрители не могут "
+                "двигать кубики.".format(repr(msg['type']), addr)
+            )
+
+    def join(self, addr, msg):
+        if addr in self.spectators or addr in self.waiting_spectators:
+            self.warn_spectator(
+                addr, "Зритель {} уже вошел в комнату.".format(addr))
+        elif msg.get('room') != self.room \
+                or msg.get('role') != 'spectator':
+            self.warn_spectator(
+                addr,
+                "Ретранслятор принимает только зрителей комнаты {}, в то "
+                "время как зритель {} прислал\nmsg = {}".format(
+                    repr(self.room), addr, msg)
+            )
+        elif self.is_initialized():
+            self.init_spectator(addr)
+        else:
+            self.waiting_spectators.add(addr)
+
+    # Зрителю можно выбрать только кодек, выбранный сервером для
+    # ретранслятора, и наибольший размер сообщения не меньше согласованного
+    # с сервером, так как сообщения сервера пересылаются без изменений.
+    def negotiate(self, addr, hello):
+        if addr in self.spectators or addr in self.waiting_spectators:
+            self.warn_spectator(
+                addr,
+                "Зритель {} прислал сообщение 'hello' после входа в "
+                "комнату.".format(addr)
+            )
+            return
+        upstream_encoding = self.outbox.encoding
+        msg = make_hello_ack_msg(
+            hello, self.tick_rate, codecs=[upstream_encoding.codec])
+        if msg['type'] == 'hello_ack' \
+                and msg['max_msg_size'] < upstream_encoding.max_msg_size:
+            msg = {
+                'type': 'error_msg',
+                'error_class': 'ValueError',
+                'msg': "Наибольший размер сообщения должен быть не "
+                       "меньше {} байт.\nmsg = {}".format(
+                           upstream_encoding.max_msg_size, hello)
+            }
+        if msg['type'] == 'error_msg':
+            self.warn_spectator(addr, msg['msg'])
+            return
+        self.send_to_spectator(addr, msg)
+        self.outboxes[addr].encoding = FrameEncoding(
+            msg['codec'], msg['compression'], msg['max_msg_size'])
+
+    def warn_spectator(self, addr, warning_msg):
+        warnings.warn(warning_msg)
+        msg = {
+            'type': 'error_msg',
+            'error_class': 'ValueError',
+            'addr': addr,
+            'msg': warning_msg,
+        }
+        self.send_to_spectator(addr, msg)
+
+    def send_to_spectator(self, addr, msg):
+        try:
+            self.outboxes[addr].put_data(msg)
+        except ValueError as e:
+            warnings.warn(e)
+            warn_no_msg_was_sent(msg, addr)
+
+    def disconnect_spectator(self, addr):
+        conn = self.conns_to_clients.pop(addr)
+        self.selector.unregister(conn)
+        conn.close()
+        del self.framers[addr]
+        del self.outboxes[addr]
+        self.spectators.discard(addr)
+        self.waiting_spectators.discard(addr)
+        if self.listener not in self.selector.get_map():
+            self.selector.register(self.listener, selectors.EVENT_READ)
+
+    def flush_outboxes(self):
+        for addr in list(self.outboxes):
+            outbox = self.outboxes[addr]
+            if outbox.overflowed:
+                warnings.warn(SLOW_CONSUMER_WARNING_TMPL.format(
+                    addr, self.max_output_buffer))
+                self.disconnect_spectator(addr)
+                continue
+            if outbox:
+                self.flush_outbox(addr)
+            if addr in self.outboxes:
+                events = selectors.EVENT_READ
+                if outbox.wants_write():
+                    events |= selectors.EVENT_WRITE
+                conn = self.conns_to_clients[addr]
+                if self.selector.get_key(conn).events != events:
+                    self.selector.modify(conn, events, addr)
+
+    def flush_outbox(self, addr):
+        try:
+            self.outboxes[addr].flush()
+        except (BrokenPipeError, ConnectionResetError) as e:
+            warnings.warn(e)
+            warnings.warn(CONNECTION_RESET_ERROR_WARNING_TMPL.format(addr))
+            self.disconnect_spectator(addr)
+        except ConnectionAbortedError as e:
+            warnings.warn(e)
+            warnings.warn(CONNECTION_ABORTED_ERROR_WARNING_TMPL.format(addr))
+            self.disconnect_spectator(addr)
+
+    def close_all_sockets(self):
+        self.selector.close()
+        close_listener(self.listener)
+        self.conn_to_server.close()
+        for conn in self.conns_to_clients.values():
+            conn.close()
+
+
+def main():
+    args = get_app_args()
+    app = CubeGameRelay(vars(args))
+    try:
+        app.mainloop()
+    except KeyboardInterrupt as e:
+        app.close_all_sockets()
+        raise e
+    except ConnectionError as e:
+        # Сервер закрыл соединение, и пересылать зрителям больше нечего.
+        warnings.warn(e)
+        app.close_all_sockets()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+# Схемы сообщений, которыми обмениваются клиент и сервер. Схема описывает
+# ключи словаря сообщения и типы их значений. При импорте модуля каждая
+# схема компилируется в функцию `MessageSchema.is_valid()`, которая для
+# правильного сообщения вычисляет одно выражение без построения
+# промежуточных множеств и словарей: число ключей сравнивается с числом
+# полей схемы, а отсутствие ключа обнаруживается по `KeyError` при
+# обращении к полю. Описание ошибки строится методом
+# `MessageSchema.explain()` только для неправильных сообщений. Проверки,
+# зависящие от состояния игры (например, известен ли клиенту кубик с
+# данным id), выполняются вызывающим кодом после проверки схемы.
+
+# Допустимые типы значений полей.
+INT = (int,)
+NUMBER = (int, float)
+STR = (str,)
+
+# Числовые значения полей по умолчанию должны помещаться в 32-битные целые
+# со знаком: в таких столбцах `CubeStore` хранит кубики, и такими полями
+# форматов `struct` они передаются.
+INT32_RANGE = (-2 ** 31, 2 ** 31 - 1)
+# Координаты событий ограничены сильнее: схваченный кубик сдвигается
+# вместе с точкой захвата и может выступать за нее на свой размер.
+COORD_RANGE = (-2 ** 30, 2 ** 30)
+
+
+# Компилирует функцию одного аргумента `arg`, возвращающую значение
+# выражения `expression`. Объекты, на которые ссылается выражение, берутся
+# из словаря `namespace`. Если `catch_key_error` истинно, функция
+# возвращает `False`, когда при вычислении выражения возбуждается
+# `KeyError`.
+def compile_function(name, arg, expression, namespace,
+                     catch_key_error=False):
+    if catch_key_error:
+        body = '    try:\n        return {}\n' \
+            '    except KeyError:\n        return False\n'.format(expression)
+    else:
+        body = '    return {}\n'.format(expression)
+    exec('def {}({}):\n{}'.format(name, arg, body), namespace)
+    return namespace[name]
+
+
+# Поле, значение которого -- экземпляр одного из типов `types`. Числа
+# должны лежать в диапазоне `value_range` -- кортеже (наименьшее,
+# наибольшее значение).
+class Value:
+    def __init__(self, types, value_range=INT32_RANGE):
+        self.types = types
+        self.value_range = value_range
+
+    # Возвращает выражение, проверяющее значение выражения `expr`, и
+    # добавляет в `namespace` объекты, на которые оно ссылается.
+    def get_condition(self, expr, namespace):
+        name = 'types_{}'.format(len(namespace))
+        # `isinstance()` с одним типом быстрее, чем с кортежем.
+        namespace[name] = \
+            self.types[0] if len(self.types) == 1 else self.types
+        condition = 'isinstance({}, {})'.format(expr, name)
+        if int in self.types:
+            condition += ' and {} <= {} <= {}'.format(
+                self.value_range[0], expr, self.value_range[1])
+        return condition
+
+
+# Поле, значение которого -- список кортежей. i-й элемент кортежа --
+# экземпляр одного из типов `fields[i]`.
+class Records:
+    def __init__(self, *fields):
+        self.fields = [Value(types) for types in fields]
+        namespace = {}
+        conditions = [
+            'type(record) is tuple',
+            'len(record) == {}'.format(len(self.fields))
+        ]
+        for i, field in enumerate(self.fields):
+            conditions.append(
+                field.get_condition('record[{}]'.format(i), namespace))
+        self.is_record_valid = compile_function(
+            'is_record_valid', 'record', ' and '.join(conditions), namespace)
+
+    def get_condition(self, expr, namespace):
+        name = 'is_record_valid_{}'.format(len(namespace))
+        namespace[name] = self.is_record_valid
+        return 'type({0}) is list and all(map({1}, {0}))'.format(expr, name)
+
+
+# Схема сообщения `name` -- словаря, ключи которого совпадают с ключами
+# `fields`, а значения -- поля `Value` или `Records`. Ключ 'type' с
+# названием сообщения добавляется в схему автоматически. `is_valid()`
+# вызывается для сообщений, выбранных по значению 'type' (например,
+# функцией `find_schema()`), поэтому значение 'type' не проверяется.
+class MessageSchema:
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = dict(fields, type=Value(STR))
+        self.keys = frozenset(self.fields)
+        namespace = {}
+        conditions = [
+            'type(msg) is dict',
+            'len(msg) == {}'.format(len(self.fields))
+        ]
+        for key, field in fields.items():
+            conditions.append(
+                field.get_condition('msg[{!r}]'.format(key), namespace))
+        self.is_valid = compile_function(
+            'is_valid', 'msg', ' and '.join(conditions), namespace,
+            catch_key_error=True)
+        # Проверки отдельных полей нужны только для описания ошибок.
+        self.field_checks = {}
+        for key, field in self.fields.items():
+            namespace = {}
+            self.field_checks[key] = compile_function(
+                'is_field_valid', 'value',
+                field.get_condition('value', namespace), namespace)
+
+    def explain(self, msg):
+        if not isinstance(msg, dict):
+            return "Сообщение {} должно быть словарем, в то время как " \
+                "msg = {}".format(repr(self.name), repr(msg))
+        wrong_keys = [
+            key for key, check in self.field_checks.items()
+            if key in msg and not check(msg[key])
+        ]
+        return "Сообщение не соответствует схеме {}.\n" \
+            "Лишние ключи: {}\n" \
+            "Недостающие ключи: {}\n" \
+            "Ключи с неверными типами или значениями: {}\n" \
+            "msg = {}".format(
+                repr(self.name),
+                sorted(set(msg) - self.keys, key=repr),
+                sorted(self.keys - set(msg)),
+                wrong_keys,
+                msg
+            )
+
+
+def compile_schemas(descriptions):
+    return {
+        name: MessageSchema(name, fields)
+        for name, fields in descriptions.items()
+    }
+
+
+# Возвращает схему из словаря `schemas` для сообщения `msg` по значению
+# ключа 'type' или `None`, если схемы для сообщения нет.
+def find_schema(schemas, msg):
+    if not isinstance(msg, dict):
+        return None
+    try:
+        return schemas.get(msg.get('type'))
+    except TypeError:
+        # Значение 'type' нехешируемое.
+        return None
+
+
+# Возвращает `True`, если сообщение `msg` -- словарь, а значение ключа
+# 'type' в нем -- один из типов `types`. Остальные поля таких сообщений
+# проверяют обработчики сообщений.
+def has_known_type(msg, types):
+    return isinstance(msg, dict) and isinstance(msg.get('type'), str) \
+        and msg['type'] in types
+
+
+# Команды, которые сервер отправляет клиенту.
+COMMAND_SCHEMAS = compile_schemas({
+    # Значение по ключу 'cubes' -- список кортежей (id, x, y, size, индекс
+    # цвета в `colors.ALL_COLORS`, z), упорядоченный по 'z'.
+    'add_cubes': {
+        'version': Value(INT),
+        'cubes': Records(INT, NUMBER, NUMBER, NUMBER, INT, INT)
+    },
+    'remove_cube': {'id': Value(INT)},
+    # Координаты кубиков, сдвинутых после версии мира 'base'. Значение по
+    # ключу 'cubes' -- список кортежей (id, x, y).
+    'delta': {
+        'version': Value(INT), 'base': Value(INT),
+        'cubes': Records(INT, NUMBER, NUMBER)
+    },
+    'world_shape': {'width': Value(INT), 'height': Value(INT)},
+    'bind_all': {},
+    # Номер последнего обработанного сервером события игрока и координаты
+    # кубика, схваченного последним щелчком, в версии мира 'version'. 'id'
+    # 0 -- щелчок не схватил кубик.
+    'input_ack': {
+        'seq': Value(INT), 'version': Value(INT), 'id': Value(INT),
+        'x': Value(INT), 'y': Value(INT)
+    },
+})
+
+# События, которые клиент отправляет серверу. Какой кубик схвачен,
+# определяет сервер по координатам щелчка, поэтому id кубика в событиях
+# нет.
+EVENT_SCHEMAS = compile_schemas({
+    '<Button-1>': {
+        'x': Value(INT, COORD_RANGE), 'y': Value(INT, COORD_RANGE)},
+    '<ButtonRelease-1>': {
+        'x': Value(INT, COORD_RANGE), 'y': Value(INT, COORD_RANGE)},
+    '<B1-Motion>': {
+        'x': Value(INT, COORD_RANGE), 'y': Value(INT, COORD_RANGE)},
+})
+
+# Типы сообщений, которые клиент отправляет серверу по TCP.
+CLIENT_MSG_TYPES = frozenset([
+    'error_msg', 'event', 'ack', 'heartbeat', 'viewport', 'join', 'hello'
+])
+
+# Сообщения клиента серверу, значения полей которых проверяются.
+MESSAGE_SCHEMAS = compile_schemas({
+    'viewport': {
+        'x1': Value(INT), 'y1': Value(INT), 'x2': Value(INT),
+        'y2': Value(INT)
+    },
+    # Перемещение мышки, переданное по UDP.
+    'motion': {
+        'seq': Value(INT), 'x': Value(INT, COORD_RANGE),
+        'y': Value(INT, COORD_RANGE)
+    },
+})
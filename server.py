@@ -1,24 +1,123 @@
 import argparse
+import asyncio
 import copy
+import multiprocessing
+import pickle
+import secrets
+import select
+import selectors
+import signal
 import socket
 import time
 import warnings
-from random import randrange as rnd, choice
 
 import colors
 
-from communicate import send_data_quite, recv_data, CorruptedMessageError, \
-    get_ip_address, MIN_PORT_NUMBER, MAX_PORT_NUMBER, DEFAULT_PORT_NUMBER, \
-    CONNECTION_ABORTED_ERROR_WARNING_TMPL, CONNECTION_RESET_ERROR_WARNING_TMPL
+from communicate import StreamFramer, OutboundQueue, CorruptedMessageError, \
+    encode_frame, quantize_coord, warn_no_msg_was_sent, get_ip_address, \
+    make_hello_ack_msg, FrameEncoding, DEFAULT_ENCODING, decode_datagram, \
+    DECODING_ERRORS, MAX_DATAGRAM_SIZE, CLIENT_DATAGRAM_TAGS, UDP_HELLO_TAGS, \
+    MIN_PORT_NUMBER, MAX_PORT_NUMBER, DEFAULT_PORT_NUMBER, \
+    MAX_ROOM_NAME_LENGTH, ROLES, DEFAULT_ROLE, \
+    DEFAULT_MAX_OUTPUT_BUFFER_SIZE, MAX_MSG_SIZE, \
+    NUM_BYTES_FOR_MSG_LENGTH, SLOW_CONSUMER_POLICIES, \
+    DEFAULT_SLOW_CONSUMER_POLICY, \
+    SLOW_CONSUMER_WARNING_TMPL, INITIAL_RECV_BUFFER_SIZE, \
+    CONNECTION_ABORTED_ERROR_WARNING_TMPL, \
+    CONNECTION_RESET_ERROR_WARNING_TMPL, CONNECTION_CLOSED_WARNING_TMPL
+from cube_store import CubeStore
+from schema import EVENT_SCHEMAS, MESSAGE_SCHEMAS, CLIENT_MSG_TYPES, \
+    find_schema, has_known_type
+from shared_world import SharedWorldPublisher, get_shm_block_name, \
+    MAX_SHM_NAME_LENGTH
+from spatial import UniformGrid
+from transport import parse_address, make_tcp_address, listen, accept, \
+    close_listener, get_peer_addr
 
 
 DT_SECONDS = 0.001
 WINDOW_SHAPE = (800, 600)
 
+# Если мир больше окна клиента, игрок видит только часть мира и может
+# прокручивать холст.
+DEFAULT_WORLD_SHAPE = WINDOW_SHAPE
+MAX_WORLD_SIZE = 10 ** 6
+# Игроку отправляются только кубики, пересекающие видимую им область мира,
+# расширенную на `VIEWPORT_MARGIN` с каждой стороны. Запас позволяет
+# прокручивать холст без задержки появления кубиков.
+VIEWPORT_MARGIN = 100
+# Наибольшие размеры видимой области, которую может сообщить игрок.
+MAX_VIEWPORT_SHAPE = (4096, 4096)
+
 MAX_NUM_PLAYERS = 10
+# Предельное число игроков, которое можно задать параметром
+# `--max_num_players`. Большое число игроков имеет смысл только для движка
+# 'asyncio'.
+MAX_NUM_PLAYERS_LIMIT = 10000
+
+# Максимальное число игроков в одной комнате. Все комнаты обслуживаются
+# одним процессом сервера.
+MAX_ROOM_PLAYERS = MAX_NUM_PLAYERS
+DEFAULT_MAX_NUM_ROOMS = 100
+MAX_NUM_ROOMS_LIMIT = 10000
 
-MAX_NUM_CUBES = 20
+MAX_NUM_CUBES = 10 ** 6
 DEFAULT_NUM_CUBES = 5
+# Число кубиков в одном сообщении 'add_cubes'. Сообщения 'add_cubes'
+# кодируются `pickle` при любом кодеке: записи с небольшими значениями
+# получаются у него не длиннее, чем в формате `struct`, а снимок мира
+# все равно сжимается. Запись об одном кубике занимает около 20 байт,
+# поэтому сообщение заметно меньше `MAX_MSG_SIZE`. Если игрок согласовал
+# меньший размер сообщений, число кубиков в сообщении уменьшается из
+# расчета `ADD_CUBES_MAX_RECORD_SIZE` байт на кубик -- размера записи с
+# наибольшими значениями полей и запасом на остальную часть сообщения.
+ADD_CUBES_CHUNK_SIZE = 10000
+ADD_CUBES_MAX_RECORD_SIZE = 34
+
+# Частота тактов сервера в Гц. Координаты кубиков, сдвинутых в течение
+# такта, рассылаются игрокам одним сообщением в конце такта.
+DEFAULT_TICK_RATE = 60
+MAX_TICK_RATE = 1000
+# Если игрок не подтвердил получение датаграммы с координатами кубиков за
+# это время в секундах, все изменения после подтвержденной им версии мира
+# отправляются по TCP. Так последние координаты доходят до игрока, даже
+# если датаграммы теряются или не доходят совсем.
+UDP_ACK_TIMEOUT = 0.1
+
+# Способы организации главного цикла сервера. 'polling' -- опрос всех
+# сокетов с паузой `DT_SECONDS`, 'selectors' -- ожидание готовности сокетов
+# с помощью модуля `selectors` (epoll в Linux).
+# 'asyncio' -- соединения обслуживаются задачами `asyncio`.
+ENGINES = ['polling', 'selectors', 'asyncio']
+DEFAULT_ENGINE = 'selectors'
+
+# Если размер буфера `asyncio.Transport` игрока больше этого значения,
+# сообщения остаются в `OutboundQueue` игрока, где к ним применяется
+# политика обработки медленных игроков.
+ASYNCIO_WRITE_BUFFER_LIMIT = 2 ** 16
+# Интервал в секундах между повторными попытками отправить данные игрокам,
+# не успевающим их принимать.
+ASYNCIO_RETRY_SEND_INTERVAL = 0.01
+
+# В режиме супервизора (`--num_workers` больше 0) комнаты обслуживаются
+# процессами-исполнителями. Супервизор принимает подключения, дожидается
+# сообщения 'join' и передает сокет игрока исполнителю, в котором
+# находится комната.
+MAX_NUM_WORKERS = 256
+# Интервал в секундах между отчетами исполнителей о нагрузке.
+HEALTH_REPORT_INTERVAL = 1.0
+# Наибольший объем данных, который супервизор принимает от игрока до
+# сообщения 'join'. Все принятые данные передаются исполнителю.
+FRONT_DOOR_MAX_BUFFER_SIZE = 2 ** 16
+# Наибольший размер сообщения между супервизором и исполнителем.
+CONTROL_MSG_MAX_SIZE = 2 * FRONT_DOOR_MAX_BUFFER_SIZE
+# Время в секундах, в течение которого супервизор ждет, пока исполнитель
+# примет сообщение.
+CONTROL_SEND_TIMEOUT = 1.0
+
+# Получатель, которым обозначается в предупреждениях сообщение для
+# нескольких игроков, если его не удалось закодировать.
+BROADCAST_ADDR = 'broadcast'
 
 
 def get_app_args():
@@ -45,6 +144,15 @@ def get_app_args():
         type=int,
         default=DEFAULT_PORT_NUMBER
     )
+    parser.add_argument(
+        "--address",
+        help="Адрес, на котором сервер принимает подключения: "
+             "'tcp://HOST:PORT' или 'unix://PATH'. Сокет Unix быстрее TCP "
+             "для ботов, ретрансляторов и тестов на той же машине. По "
+             "умолчанию 'tcp://:PORT', где PORT -- значение "
+             "`--server_port`.",
+        default=None
+    )
     parser.add_argument(
         "--num_cubes",
         "-n",
@@ -54,23 +162,240 @@ def get_app_args():
         type=int,
         default=DEFAULT_NUM_CUBES
     )
+    parser.add_argument(
+        "--world_shape",
+        help="Ширина и высота мира. Если мир больше окна клиента, игрок "
+             "видит только часть мира и получает только видимые ему "
+             "кубики. Каждый размер должен быть не меньше размера окна {} и "
+             "не больше {}. Значение по умолчанию {} {}.".format(
+                 WINDOW_SHAPE, MAX_WORLD_SIZE, *DEFAULT_WORLD_SHAPE),
+        nargs=2,
+        metavar=('WIDTH', 'HEIGHT'),
+        type=int,
+        default=list(DEFAULT_WORLD_SHAPE)
+    )
+    parser.add_argument(
+        "--tick_rate",
+        "-t",
+        help="Частота тактов сервера в Гц. Координаты кубиков, сдвинутых в "
+             "течение такта, рассылаются игрокам один раз в конце такта. "
+             "Разрешенные значения: 1 - {}. Значение по умолчанию "
+             "{}.".format(MAX_TICK_RATE, DEFAULT_TICK_RATE),
+        type=int,
+        default=DEFAULT_TICK_RATE
+    )
+    parser.add_argument(
+        "--max_output_buffer",
+        help="Максимальный размер в байтах очереди неотправленных "
+             "сообщений одного игрока. Значение должно быть не меньше {}. "
+             "Значение по умолчанию {}.".format(
+                 MAX_MSG_SIZE + NUM_BYTES_FOR_MSG_LENGTH,
+                 DEFAULT_MAX_OUTPUT_BUFFER_SIZE),
+        type=int,
+        default=DEFAULT_MAX_OUTPUT_BUFFER_SIZE
+    )
+    parser.add_argument(
+        "--slow_consumer_policy",
+        help="Что делать, если игрок не успевает принимать данные и очередь "
+             "неотправленных сообщений переполнена. 'drop' -- удалять из "
+             "очереди устаревшие координаты кубиков и закрывать соединение, "
+             "только если этого недостаточно. 'disconnect' -- сразу "
+             "закрывать соединение. Значение по умолчанию '{}'.".format(
+                 DEFAULT_SLOW_CONSUMER_POLICY),
+        choices=SLOW_CONSUMER_POLICIES,
+        default=DEFAULT_SLOW_CONSUMER_POLICY
+    )
+    parser.add_argument(
+        "--engine",
+        "-e",
+        help="Способ организации главного цикла сервера. 'polling' -- "
+             "опрос всех сокетов каждые {} с, 'selectors' -- ожидание "
+             "готовности сокетов к чтению или записи, 'asyncio' -- "
+             "обслуживание соединений задачами `asyncio`. Значение по "
+             "умолчанию '{}'.".format(DT_SECONDS, DEFAULT_ENGINE),
+        choices=ENGINES,
+        default=DEFAULT_ENGINE
+    )
+    parser.add_argument(
+        "--max_num_players",
+        help="Максимальное число игроков. Разрешенные значения: 1 - {}. "
+             "Значение по умолчанию {}.".format(
+                 MAX_NUM_PLAYERS_LIMIT, MAX_NUM_PLAYERS),
+        type=int,
+        default=MAX_NUM_PLAYERS
+    )
+    parser.add_argument(
+        "--max_room_players",
+        help="Максимальное число игроков в одной комнате. Разрешенные "
+             "значения: 1 - {}. Значение по умолчанию {}.".format(
+                 MAX_NUM_PLAYERS_LIMIT, MAX_ROOM_PLAYERS),
+        type=int,
+        default=MAX_ROOM_PLAYERS
+    )
+    parser.add_argument(
+        "--max_num_rooms",
+        help="Максимальное число комнат. В каждой комнате свой мир "
+             "кубиков из `--num_cubes` кубиков. Разрешенные значения: 1 - "
+             "{}. Значение по умолчанию {}.".format(
+                 MAX_NUM_ROOMS_LIMIT, DEFAULT_MAX_NUM_ROOMS),
+        type=int,
+        default=DEFAULT_MAX_NUM_ROOMS
+    )
+    parser.add_argument(
+        "--shm_name",
+        help="Если задан, состояние кубиков каждой комнаты публикуется в "
+             "блок разделяемой памяти, из которого его могут читать "
+             "процессы на той же машине без подключения к серверу (см. "
+             "shared_world.py). Имя блока составляется из значения "
+             "параметра и названия комнаты. По умолчанию состояние не "
+             "публикуется.",
+        default=None
+    )
+    parser.add_argument(
+        "--num_workers",
+        "-w",
+        help="Число процессов-исполнителей. Если больше 0, сервер работает "
+             "в режиме супервизора: принимает подключения и передает "
+             "сокеты игроков исполнителям, в каждом из которых свои "
+             "комнаты. Новые комнаты создаются в наименее загруженном "
+             "исполнителе. `--max_num_players` и `--max_num_rooms` задают "
+             "ограничения для одного исполнителя. Режим доступен только в "
+             "Unix и только с движком 'selectors'. Разрешенные значения: "
+             "0 - {}. Значение по умолчанию 0.".format(MAX_NUM_WORKERS),
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        "--udp",
+        help="Передавать координаты кубиков и перемещения мышки по UDP "
+             "игрокам, которые это поддерживают. Потеря пакета UDP не "
+             "задерживает последующие координаты, как это происходит в "
+             "TCP. Остальные сообщения передаются по TCP. Сервер принимает "
+             "датаграммы на порту `--server_port`, а исполнители в режиме "
+             "супервизора -- на свободных портах, которые сообщаются "
+             "игрокам при подключении.",
+        action='store_true'
+    )
+    parser.add_argument(
+        "--idle_timeout",
+        help="Время в секундах, по истечении которого соединение с "
+             "игроком, не приславшим за это время ни одного сообщения, "
+             "закрывается. Поддерживается только движком 'asyncio'. По "
+             "умолчанию соединения не закрываются.",
+        type=float,
+        default=None
+    )
     return parser.parse_args()
 
 
+# Адрес сервера из параметров `--address` и `--server_port`.
+def get_server_address(config):
+    if config['address'] is not None:
+        return config['address']
+    return make_tcp_address('', config['server_port'])
+
+
+# Сокет, принимающий подключения по адресу `address`. ip машины
+# определяется и печатается, только если сервер принимает подключения TCP
+# на всех интерфейсах.
+def create_listener(address, backlog):
+    listener = listen(address, backlog)
+    family, sockaddr = parse_address(address)
+    if family == socket.AF_INET and not sockaddr[0]:
+        print(get_ip_address(), sockaddr[1])
+    else:
+        print(address)
+    return listener
+
+
+def create_udp_socket(host, port):
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_sock.settimeout(0)
+    udp_sock.bind((host, port))
+    return udp_sock
+
+
+# Сокеты из `conns`, готовые принять данные, без ожидания. `select.select()`
+# не принимает дескрипторы с номерами от FD_SETSIZE (1024 в Linux), поэтому
+# используется `select.poll()`. В Windows `select.poll()` нет, а
+# `select.select()` ограничивает число сокетов, а не их номера. Сокеты с
+# ошибками тоже считаются готовыми: ошибку сообщит запись в сокет.
+def get_writable_conns(conns):
+    if not hasattr(select, 'poll'):
+        return select.select([], conns, [], 0)[1]
+    poller = select.poll()
+    conns_by_fd = {}
+    for conn in conns:
+        conns_by_fd[conn.fileno()] = conn
+        poller.register(conn, select.POLLOUT)
+    return [conns_by_fd[fd] for fd, _ in poller.poll(0)]
+
+
+# Сообщения 'add_cubes' с записями `records` -- кортежами (id, x, y, size,
+# индекс цвета в `colors.ALL_COLORS`, z). Записи разбиваются на сообщения
+# по `chunk_size`. `version` -- версия мира, которой соответствуют
+# координаты кубиков.
+def make_add_cubes_msgs(version, records, chunk_size=ADD_CUBES_CHUNK_SIZE):
+    return [
+        {
+            'type': 'command',
+            'command': {
+                'type': 'add_cubes',
+                'version': version,
+                'cubes': records[start:start + chunk_size]
+            }
+        }
+        for start in range(0, len(records), chunk_size)
+    ]
+
+
+def get_add_cubes_chunk_size(encoding):
+    return min(
+        ADD_CUBES_CHUNK_SIZE,
+        encoding.max_msg_size // ADD_CUBES_MAX_RECORD_SIZE
+    )
+
+
 class PlayerScenario:
     def __init__(self, game, player_addr):
         self.game = game
         self.player_addr = player_addr
 
         self.player_states = {
+            'waiting_for_join': {
+                "act": {
+                    "game_method": None,
+                    "change_state": None
+                },
+                "event": {
+                    "game_method": self.game.warn_events_before_init,
+                    "change_state": None
+                },
+                "join": {
+                    "game_method": self.game.join_room,
+                    "change_state": self.change_state_to_waiting_for_init
+                },
+                "hello": {
+                    "game_method": self.game.negotiate,
+                    "change_state": None
+                }
+            },
             'waiting_for_init': {
                 "act": {
                     "game_method": self.game.init_player,
                     "change_state": self.change_state_to_grab_move,
                 },
-                'process_event': {
+                "event": {
                     "game_method": self.game.warn_events_before_init,
                     "change_state": None
+                },
+                "join": {
+                    "game_method": self.game.warn_repeated_join,
+                    "change_state": None
+                },
+                "hello": {
+                    "game_method": self.game.warn_late_hello,
+                    "change_state": None
                 }
             },
             'grab_move': {
@@ -81,11 +406,37 @@ class PlayerScenario:
                 "event": {
                     "game_method": self.game.process_event,
                     "change_state": None
+                },
+                "join": {
+                    "game_method": self.game.warn_repeated_join,
+                    "change_state": None
+                },
+                "hello": {
+                    "game_method": self.game.warn_late_hello,
+                    "change_state": None
+                }
+            },
+            'spectate': {
+                "act": {
+                    "game_method": None,
+                    "change_state": None
+                },
+                "event": {
+                    "game_method": self.game.warn_spectator_event,
+                    "change_state": None
+                },
+                "join": {
+                    "game_method": self.game.warn_repeated_join,
+                    "change_state": None
+                },
+                "hello": {
+                    "game_method": self.game.warn_late_hello,
+                    "change_state": None
                 }
             }
         }
 
-        self.current_state = "waiting_for_init"
+        self.current_state = "waiting_for_join"
 
     def act(self):
         act_description = self.player_states[self.current_state]['act']
@@ -111,102 +462,109 @@ class PlayerScenario:
         if change_state_method is not None:
             change_state_method(result)
 
+    def process_join(self, addr, room_name, role):
+        assert addr == self.player_addr
+        process_join_description = \
+            self.player_states[self.current_state]['join']
+        game_method = process_join_description['game_method']
+        if game_method is None:
+            result = None
+        else:
+            result = game_method(addr, room_name, role)
+        change_state_method = process_join_description['change_state']
+        if change_state_method is not None:
+            change_state_method(result)
+
+    def process_hello(self, addr, msg):
+        assert addr == self.player_addr
+        process_hello_description = \
+            self.player_states[self.current_state]['hello']
+        game_method = process_hello_description['game_method']
+        if game_method is None:
+            result = None
+        else:
+            result = game_method(addr, msg)
+        change_state_method = process_hello_description['change_state']
+        if change_state_method is not None:
+            change_state_method(result)
+
+    def change_state_to_waiting_for_init(self, game_method_result):
+        # Если войти в комнату не удалось, игрок может попробовать войти в
+        # другую.
+        if game_method_result:
+            self.current_state = 'waiting_for_init'
+
+    # Зрители не могут двигать кубики и только наблюдают за игрой.
     def change_state_to_grab_move(self, game_method_result):
-        self.current_state = 'grab_move'
+        if self.game.is_spectator(self.player_addr):
+            self.current_state = 'spectate'
+        else:
+            self.current_state = 'grab_move'
 
 
+# Представление кубика, свойства которого хранятся в `CubeStore`
+# `cube_canvas.cubes`. Экземпляры создаются методом
+# `CubeCanvasServer.get_cube()` на время обработки события.
 class CubeServer:
-    def __init__(self, cube_canvas, id_, x, y, size, color):
+    def __init__(self, cube_canvas, id_):
         self.cube_canvas = cube_canvas
+        self.store = cube_canvas.cubes
         self.id = id_
-        self.x = x
-        self.y = y
-        self.size = size
-        self.color = color
+        self.idx = id_ - 1
 
-        self.grabbing_point = None
+    @property
+    def x(self):
+        return self.store.x[self.idx]
 
-    def is_coord_missing(self, addr, event):
-        missing_coords = []
-        if 'x' not in event:
-            missing_coords.append('x')
-        if 'y' not in event:
-            missing_coords.append('y')
-        if missing_coords:
-            warning_msg = "В описании события не хватает {}." \
-                "Захват кубика не будет осуществлен.".format(
-                    ' и '.join(map(repr, missing_coords))
-                )
-            warnings.warn(warning_msg)
-            conn = self.cube_canvas.get_root().conns_to_clients[addr]
-            msg = {
-                'type': 'error_msg',
-                'error_class': 'ValueError',
-                'addr': addr,
-                'msg': warning_msg,
-                'event': event
-            }
-            send_data_quite(conn, addr, msg)
-        return bool(missing_coords)
-
-    def are_x_and_y_ok(self, addr, event):
-        ok = not self.is_coord_missing(addr, event)
-        if not (self.x <= event['x'] <= self.x + self.size
-                and self.y <= event['y'] <= self.y + self.size):
-            ok = False
-            warning_msg = "У кубика с id {} разные координаты или размер " \
-                "в клиентской и серверной частях программы. В результате " \
-                "мышка не попадает по кубику из серверной части программы. " \
-                "Захват кубика не будет осуществлен.".format(self.id)
-            warnings.warn(warning_msg)
-            conn = self.cube_canvas.get_root().conns_to_clients[addr]
-            msg = {
-                'type': 'error_msg',
-                'error_class': 'ValueError',
-                'addr': addr,
-                'msg': warning_msg,
-                'event': event,
-                'cube_coords_on_server': (self.x, self.y),
-                'cube_size_on_server': self.size
-            }
-            send_data_quite(conn, addr, msg)
-        return ok
+    @x.setter
+    def x(self, value):
+        self.store.x[self.idx] = value
+
+    @property
+    def y(self):
+        return self.store.y[self.idx]
+
+    @y.setter
+    def y(self, value):
+        self.store.y[self.idx] = value
+
+    @property
+    def size(self):
+        return self.store.size[self.idx]
+
+    @property
+    def color(self):
+        return self.store.get_color(self.id)
+
+    @property
+    def grabbing_point(self):
+        return self.store.get_grabbing_point(self.id)
+
+    @grabbing_point.setter
+    def grabbing_point(self, value):
+        self.store.set_grabbing_point(self.id, value)
 
     def move_by_grabbing_point(self, addr, x, y):
-        root = self.cube_canvas.get_root()
         assert self.grabbing_point is not None, "Метод " \
             "`CubeServer.move_by_grabbing_point` может вызываться, если " \
             "`self.grabbing_point` не `None`. В программе ошибка."
+        old_rect = self.store.get_rect(self.id)
         self.x += x - self.grabbing_point[0]
         self.y += y - self.grabbing_point[1]
         self.grabbing_point = (x, y)
-        msg = {
-            'type': 'command',
-            'command': {
-                'type': 'coords',
-                'id': self.id,
-                'x1': self.x,
-                'x2': self.x + self.size,
-                'y1': self.y,
-                'y2': self.y + self.size
-            }
-        }
-        root.send_to_all_players(msg)
+        self.cube_canvas.spatial_index.move(
+            self.id, old_rect, self.store.get_rect(self.id))
+        # Новые координаты будут разосланы игрокам в конце такта сервера.
+        self.cube_canvas.dirty_cubes_ids.add(self.id)
 
     def process_button_release_1(self, addr, event):
-        if self.is_coord_missing(addr, event):
-            return
         self.move_by_grabbing_point(addr, event['x'], event['y'])
         self.grabbing_point = None
 
     def process_b1_motion(self, addr, event):
-        if self.is_coord_missing(addr, event):
-            return
         self.move_by_grabbing_point(addr, event['x'], event['y'])
 
     def process_button_1(self, addr, event):
-        if not self.are_x_and_y_ok(addr, event):
-            return
         assert self.grabbing_point is None, \
             "Кубик по-прежнему кто-то удерживает. В программе ошибка, так " \
             "как проверка того, что кубик свободен должна выполняться в " \
@@ -218,30 +576,59 @@ class CubeServer:
 
 
 class CubeCanvasServer:
-    def __init__(self, master, num_cubes):
+    def __init__(self, master, num_cubes, world_shape, shm_name=None):
         self.master = master
-        self.supported_incoming_event_types = \
-            ['<Button-1>', '<ButtonRelease-1>', '<B1-Motion>']
-        # Кубики располагаются внутри экземпляра `CubeCanvas` случайным
-        # образом, но не ближе, чем `self.margin` к границе экземпляра
-        # `CubeCanvas`.
+        self.world_shape = tuple(world_shape)
+        # Кубики располагаются внутри мира случайным образом, но не ближе,
+        # чем `self.margin` к границе мира.
         self.margin = 100
         self.cube_init_xrange = [
             self.margin,
-            WINDOW_SHAPE[0] - self.margin
+            self.world_shape[0] - self.margin
         ]
         self.cube_init_yrange = [
             self.margin,
-            WINDOW_SHAPE[1] - self.margin
+            self.world_shape[1] - self.margin
         ]
         self.cube_size_range = [15, 75]
 
         self.num_cubes = num_cubes
-        # Ключи в словаре -- id объектов.
-        self.cubes = {}
+        self.cubes = CubeStore()
+        # Сторона ячейки индекса равна наибольшему размеру кубика, поэтому
+        # кубик пересекает не больше 4 ячеек.
+        self.spatial_index = UniformGrid(
+            self.cube_size_range[1], self.cubes.get_rect)
+        # Закодированные сообщения 'add_cubes' со всеми кубиками мира и
+        # версия мира, при которой они были закодированы. Снимок мира
+        # кодируется заново, только если мир изменился. Ключи в словаре
+        # `self.snapshot_frames` -- способы кодирования `FrameEncoding`.
+        self.snapshot_frames = {}
+        self.snapshot_version = None
         self.create_cubes()
 
         self.grabbed_cubes_ids = {}
+        # Ключи -- адреса игроков, значения -- id кубика, схваченного
+        # последним щелчком игрока, или `None`, если щелчок не схватил
+        # кубик. Кубик остается в словаре и после того, как игрок его
+        # отпустил.
+        self.last_grabbed_ids = {}
+        # id кубиков, сдвинутых с начала текущего такта сервера.
+        self.dirty_cubes_ids = set()
+        # Версия мира увеличивается в конце каждого такта, в течение
+        # которого сдвинулся хотя бы один кубик.
+        self.version = 0
+        # Ключи -- id кубиков, значения -- версия мира, в которой кубик
+        # сдвинулся последний раз. Ключи упорядочены по возрастанию версий.
+        self.cubes_versions = {}
+
+        # Если задано имя блока разделяемой памяти `shm_name`, в конце
+        # каждого такта, в течение которого сдвинулись кубики, их
+        # координаты записываются в этот блок.
+        self.publisher = None
+        if shm_name is not None:
+            self.publisher = SharedWorldPublisher(
+                shm_name, len(self.cubes.alive))
+            self.publisher.publish_all(self.cubes, self.version)
 
     def get_root(self):
         root = self.master
@@ -252,169 +639,628 @@ class CubeCanvasServer:
     def get_mode(self):
         return self.get_root().mode
 
-    def get_free_id(self):
-        id_ = 1
-        taken_ids = list(self.cubes.keys())
-        while id_ in taken_ids:
-            id_ += 1
-        return id_
+    def get_cube(self, id_):
+        return CubeServer(self, id_)
 
     def create_cubes(self):
-        for _ in range(self.num_cubes):
-            x = rnd(*self.cube_init_xrange)
-            y = rnd(*self.cube_init_yrange)
-            size = rnd(*self.cube_size_range)
-            color = choice(colors.INTENSIVE_RAINBOW)
-            id_ = self.get_free_id()
-            self.cubes[id_] = CubeServer(self, id_, x, y, size, color)
+        ids = self.cubes.create_random_cubes(
+            self.num_cubes,
+            self.cube_init_xrange,
+            self.cube_init_yrange,
+            self.cube_size_range,
+            colors.INTENSIVE_RAINBOW
+        )
+        for id_ in ids:
+            self.spatial_index.insert(id_, *self.cubes.get_rect(id_))
+        self.snapshot_frames.clear()
 
-    def is_id_address_eventtype_ok(self, addr, event):
-        ok = True
-        conn = self.get_root().conns_to_clients[addr]
-        oblig_part = {
+    # Возвращает id верхнего из кубиков, на которые попадает точка (x, y),
+    # или `None`, если точка не попадает ни на один кубик.
+    def pick_cube(self, x, y):
+        ids = self.spatial_index.query_point(x, y)
+        if not ids:
+            return None
+        z = self.cubes.z
+        return max(ids, key=lambda id_: z[id_ - 1])
+
+    def warn_bad_event(self, addr, event, warning_msg, **details):
+        warnings.warn(warning_msg)
+        msg = {
             'type': 'error_msg',
             'error_class': 'ValueError',
             'addr': addr,
-            'event': event
+            'msg': warning_msg,
+            'event': event,
+            **details
         }
+        self.get_root().send_to_player(addr, msg)
+
+    # Структура события и типы координат проверяются по схеме из
+    # `schema.EVENT_SCHEMAS`. Описание ошибки строится, только если событие
+    # неверно.
+    def is_id_address_eventtype_ok(self, addr, event):
+        schema = find_schema(EVENT_SCHEMAS, event)
+        if schema is None:
+            self.warn_bad_event(
+                addr,
+                event,
+                "Только события типов {} поддерживаются, в то время как "
+                "было принято событие {}. Вероятно, в клиентской части "
+                "программы допущена ошибка.".format(
+                    list(EVENT_SCHEMAS), repr(event)),
+                supported_event_types=list(EVENT_SCHEMAS)
+            )
+            return False
+        if not schema.is_valid(event):
+            self.warn_bad_event(addr, event, schema.explain(event))
+            return False
         if event['type'] == '<Button-1>':
-            if 'id' not in event:
-                ok = False
-                warning_msg = "Без ключа 'id' могут быть только словари " \
-                    "с описаниями событий типа <ButtonRelease-1> и " \
-                    "<B1-Motion>. В то время как у данного события тип " \
-                    "{}".format(event['type'])
-                warnings.warn(warning_msg)
-                msg = dict(**oblig_part, msg=warning_msg)
-                send_data_quite(conn, addr, msg)
-            if 'id' in event and addr in self.grabbed_cubes_ids:
-                ok = False
-                warning_msg = "Игрок {} не может схватить кубик с id " \
-                    "{}, пока не отпустит кубик с id {}. Вероятно, или в " \
-                    "или в серверной части программы ошибка. Такие ситуации " \
-                    "не должны возникать".format(
-                        addr, event['id'], self.grabbed_cubes_ids[addr]
-                    )
-                warnings.warn(warning_msg)
-                msg = dict(
-                    **oblig_part,
-                    msg=warning_msg,
+            if addr in self.grabbed_cubes_ids:
+                self.warn_bad_event(
+                    addr,
+                    event,
+                    "Игрок {} не может схватить кубик, пока не отпустит "
+                    "кубик с id {}. Вероятно, или в клиентской, или в "
+                    "серверной части программы ошибка. Такие ситуации не "
+                    "должны возникать".format(
+                        addr, self.grabbed_cubes_ids[addr]),
                     grabbed_id=self.grabbed_cubes_ids[addr]
                 )
-                send_data_quite(conn, addr, msg)
-            if 'id' in event and event['id'] not in self.cubes:
-                ok = False
-                present_ids = list(self.cubes.keys())
-                warning_msg = "В canvas нет элемента с id {}. Или в " \
-                    "клиентской, или в серверной части программы ошибка. \n" \
-                    "id в наличии: {}\n".format(event['id'], present_ids)
-                warnings.warn(warning_msg)
-                msg = dict(**oblig_part, msg=warning_msg)
-                send_data_quite(conn, addr, msg)
-        elif event['type'] in ['<ButtonRelease-1>', '<B1-Motion>']:
-            if 'id' in event:
-                ok = False
-                warning_msg = "Ключ id может быть только в словарях с " \
-                    "описаниями событий типа <Button-1>. В то время как" \
-                    "у данного события тип {}. Вероятно, в клиентской " \
-                    "части программы неправильно реализовано составление " \
-                    "сообщений данного типа".format(event['type'])
-                warnings.warn(warning_msg)
-                msg = dict(**oblig_part, msg=warning_msg)
-                send_data_quite(conn, addr, msg)
-            if addr not in self.grabbed_cubes_ids:
-                ok = False
-                warning_msg = "Адрес клиента, отправившего описание события " \
-                    "типа <ButtonRelease-1> или <B1-Motion>, должен быть " \
-                    "ключом словаря `self.grabbed_cubes_ids`."
-                warnings.warn(warning_msg)
-                msg = dict(**oblig_part, msg=warning_msg)
-                send_data_quite(conn, addr, msg)
-        else:
-            ok = False
-            warning_msg = "Только события типов {} поддерживаются, в то " \
-                "время как было принято описание события типа {}. Вероятно, " \
-                "в клиентской части программы допущена ошибка.".format(
-                    self.supported_incoming_event_types, event['type'])
-            warnings.warn(warning_msg)
-            msg = dict(
-                **oblig_part,
-                msg=warning_msg,
-                supported_event_types=self.supported_incoming_event_types
-            )
-            send_data_quite(conn, addr, msg)
-        return ok
+                return False
+            return True
+        # Клиент не знает, схватил ли игрок кубик, и сообщает о
+        # перемещениях мышки и после щелчка мимо кубиков. Такие события
+        # пропускаются без предупреждений.
+        return addr in self.grabbed_cubes_ids
 
     def process_event(self, addr, event):
         if not self.is_id_address_eventtype_ok(addr, event):
             return
         if event['type'] == '<Button-1>':
-            if self.cubes[event['id']].grabbing_point is None:
-                assert event['id'] not in \
-                    list(self.grabbed_cubes_ids.values()), \
+            self.last_grabbed_ids[addr] = None
+            id_ = self.pick_cube(event['x'], event['y'])
+            if id_ is None:
+                return
+            # Если верхний кубик в точке щелчка удерживает другой игрок,
+            # захват не осуществляется, как и в случае, когда id кубика
+            # определял клиент.
+            if self.get_cube(id_).grabbing_point is None:
+                assert id_ not in list(self.grabbed_cubes_ids.values()), \
                     "Если кубик свободен, id этого кубика не должно быть " \
                     "среди значений `self.grabbed_cubes_ids`. В серверной " \
                     "части программы ошибка."
-                self.cubes[event['id']].process_button_1(addr, event)
-                self.grabbed_cubes_ids[addr] = event['id']
+                self.get_cube(id_).process_button_1(addr, event)
+                self.grabbed_cubes_ids[addr] = id_
+                self.last_grabbed_ids[addr] = id_
         elif event['type'] in ['<ButtonRelease-1>', '<B1-Motion>']:
             event = copy.deepcopy(event)
             event['id'] = self.grabbed_cubes_ids[addr]
+            cube = self.get_cube(event['id'])
             if event['type'] == '<ButtonRelease-1>':
-                self.cubes[event['id']].process_button_release_1(addr, event)
+                cube.process_button_release_1(addr, event)
                 del self.grabbed_cubes_ids[addr]
             elif event['type'] == '<B1-Motion>':
-                self.cubes[event['id']].process_b1_motion(addr, event)
+                cube.process_b1_motion(addr, event)
             else:
                 assert False
         else:
             assert False
 
+    # Увеличивает версию мира, если с начала такта сдвинулся хотя бы один
+    # кубик. Возвращает `True`, если версия изменилась.
+    def advance_version(self):
+        if not self.dirty_cubes_ids:
+            return False
+        self.version += 1
+        for id_ in sorted(self.dirty_cubes_ids):
+            self.cubes_versions.pop(id_, None)
+            self.cubes_versions[id_] = self.version
+        if self.publisher is not None:
+            self.publisher.publish_moved(
+                self.cubes, self.version, self.dirty_cubes_ids)
+        self.dirty_cubes_ids.clear()
+        return True
+
+    def close(self):
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
+
+    # Возвращает сообщение с координатами кубиков, сдвинутых после версии
+    # мира `base`. Благодаря порядку ключей в `self.cubes_versions`
+    # просматриваются только такие кубики. Если задано множество `ids`, в
+    # сообщение попадают только кубики из него.
+    def make_delta_msg(self, base, ids=None):
+        cubes = []
+        for id_, version in reversed(self.cubes_versions.items()):
+            if version <= base:
+                break
+            if ids is not None and id_ not in ids:
+                continue
+            cubes.append((
+                id_,
+                quantize_coord(self.cubes.x[id_ - 1]),
+                quantize_coord(self.cubes.y[id_ - 1])
+            ))
+        return {
+            'type': 'command',
+            'command': {
+                'type': 'delta',
+                'version': self.version,
+                'base': base,
+                'cubes': cubes
+            }
+        }
+
+    # Возвращает сообщения 'add_cubes' с кубиками `ids` в порядке 'z'.
+    def make_add_cubes_msgs(self, ids, chunk_size=ADD_CUBES_CHUNK_SIZE):
+        store = self.cubes
+        ids = sorted(ids, key=lambda id_: store.z[id_ - 1])
+        records = [
+            (
+                id_, store.x[id_ - 1], store.y[id_ - 1],
+                store.size[id_ - 1], store.color[id_ - 1], store.z[id_ - 1]
+            )
+            for id_ in ids
+        ]
+        return make_add_cubes_msgs(self.version, records, chunk_size)
+
+    # Возвращает закодированные сообщения 'add_cubes' со всеми кубиками
+    # мира. Координаты кубиков в снимке могут отставать от текущих не
+    # больше чем на один такт: кубики, сдвинутые после версии
+    # `self.version`, игрок получит в сообщении 'delta' в конце такта.
+    # `encoding` -- способ кодирования сообщений `FrameEncoding`.
+    def get_snapshot_frames(self, encoding=DEFAULT_ENCODING):
+        if self.snapshot_version != self.version:
+            self.snapshot_frames.clear()
+            self.snapshot_version = self.version
+        if encoding not in self.snapshot_frames:
+            msgs = self.make_add_cubes_msgs(
+                self.cubes.ids(), get_add_cubes_chunk_size(encoding))
+            self.snapshot_frames[encoding] = [
+                encode_frame(msg, *encoding) for msg in msgs]
+        return self.snapshot_frames[encoding]
+
+    # Возвращает id кубиков, пересекающих прямоугольник `rect`.
+    def find_cubes_in_rect(self, rect):
+        return self.spatial_index.query_rect(*rect)
+
+    def is_cube_in_rect(self, id_, rect):
+        x1, y1, x2, y2 = self.cubes.get_rect(id_)
+        return x1 <= rect[2] and rect[0] <= x2 \
+            and y1 <= rect[3] and rect[1] <= y2
+
     def release_player_cube(self, addr):
+        self.last_grabbed_ids.pop(addr, None)
         if addr in self.grabbed_cubes_ids:
-            cube = self.cubes[self.grabbed_cubes_ids[addr]]
-            cube.grabbing_point = None
+            self.cubes.set_grabbing_point(
+                self.grabbed_cubes_ids[addr], None)
             del self.grabbed_cubes_ids[addr]
 
 
 class MainFrameServer:
-    def __init__(self, master, num_cubes):
+    def __init__(self, master, num_cubes, world_shape, shm_name=None):
         self.master = master
-        self.cube_canvas = CubeCanvasServer(self, num_cubes)
+        self.cube_canvas = CubeCanvasServer(
+            self, num_cubes, world_shape, shm_name)
 
     def process_event(self, addr, event):
         self.cube_canvas.process_event(addr, event)
 
 
+# Комната -- независимый мир кубиков со своими игроками. Все комнаты
+# обслуживаются одним экземпляром `CubeGameServer`: у них общие сокет для
+# подключения игроков и главный цикл. Комната создается, когда в нее входит
+# первый игрок, и удаляется, когда ее покидает последний. У комнаты нет
+# атрибута `master`, поэтому для `CubeCanvasServer` она является корнем
+# иерархии, и сообщения игрокам отправляются методами комнаты.
+#
+# Кроме игроков, в комнату могут входить зрители. Зрители не занимают мест
+# игроков, видят весь мир независимо от сообщенной видимой области и не
+# могут двигать кубики. Всем зрителям, подтвердившим одну и ту же версию
+# мира, отправляется одно и то же закодированное сообщение, поэтому
+# ретранслятор (relay.py) может подключиться к комнате как один зритель и
+# пересылать принятые сообщения без изменений любому числу своих зрителей.
+class Room:
+    def __init__(self, server, name):
+        self.server = server
+        self.name = name
+        self.max_num_players = server.max_room_players
+        self.tick_period = server.tick_period
+        self.next_tick_time = time.monotonic()
+
+        shm_name = None
+        if server.shm_name is not None:
+            shm_name = get_shm_block_name(server.shm_name, name)
+        self.main_frame = MainFrameServer(
+            self, server.num_cubes, server.world_shape, shm_name)
+
+        # Адреса игроков и зрителей, вошедших в комнату.
+        self.players = set()
+        self.spectators = set()
+        # Ключи в словарях -- адреса инициализированных игроков, значения --
+        # последняя версия мира, получение которой подтвердил игрок, и
+        # последняя версия мира, отправленная игроку.
+        self.acked_versions = {}
+        self.sent_versions = {}
+        # Ключи в словаре -- адреса игроков, значения -- видимые игрокам
+        # области мира (x1, y1, x2, y2).
+        self.viewports = {}
+        # Ключи в словаре -- адреса инициализированных игроков, значения --
+        # множества id кубиков, отправленных игроку и не удаленных у него.
+        self.known_cubes = {}
+        # Ключи в словаре -- адреса игроков, которым координаты кубиков
+        # отправлены по UDP и не подтверждены, значения -- пары из времени,
+        # когда координаты нужно отправить по TCP, и версии мира в первой
+        # неподтвержденной датаграмме.
+        self.unacked_datagrams = {}
+        # Адреса игроков, события которых обработаны после последнего
+        # сообщения 'input_ack'.
+        self.pending_input_acks = set()
+
+    def is_full(self):
+        return len(self.players) >= self.max_num_players
+
+    def is_empty(self):
+        return not self.players and not self.spectators
+
+    def close(self):
+        self.main_frame.cube_canvas.close()
+
+    def add_player(self, addr, role=DEFAULT_ROLE):
+        if role == 'spectator':
+            self.spectators.add(addr)
+        else:
+            self.players.add(addr)
+
+    def remove_player(self, addr):
+        self.players.discard(addr)
+        self.spectators.discard(addr)
+        self.acked_versions.pop(addr, None)
+        self.sent_versions.pop(addr, None)
+        self.viewports.pop(addr, None)
+        self.known_cubes.pop(addr, None)
+        self.unacked_datagrams.pop(addr, None)
+        self.pending_input_acks.discard(addr)
+        self.main_frame.cube_canvas.release_player_cube(addr)
+
+    # Время в секундах до конца текущего такта или `None`, если рассылать
+    # в конце такта нечего и ждать его не нужно. Если кубики не двигались,
+    # такт нужен только для отправки по TCP координат из неподтвержденных
+    # датаграмм.
+    def get_time_to_tick(self):
+        if self.main_frame.cube_canvas.dirty_cubes_ids \
+                or self.pending_input_acks:
+            tick_time = self.next_tick_time
+        elif self.unacked_datagrams:
+            tick_time = max(
+                self.next_tick_time,
+                min(time_ for time_, _ in self.unacked_datagrams.values())
+            )
+        else:
+            return None
+        return max(0, tick_time - time.monotonic())
+
+    def tick_if_due(self):
+        if self.get_time_to_tick() == 0:
+            self.tick()
+            self.next_tick_time = time.monotonic() + self.tick_period
+
+    def tick(self):
+        cube_canvas = self.main_frame.cube_canvas
+        moved_ids = list(cube_canvas.dirty_cubes_ids)
+        if cube_canvas.advance_version() or self.unacked_datagrams:
+            self.send_deltas(moved_ids)
+        self.send_input_acks()
+
+    # Каждому игроку отправляются координаты кубиков, сдвинутых после
+    # последней версии мира, получение которой игрок подтвердил. Если игрок
+    # отстал, он получает одно сообщение со всеми изменениями вместо всех
+    # пропущенных сообщений. Сообщение кодируется один раз для всех игроков
+    # с одинаковой подтвержденной версией, которым известны все кубики.
+    # Остальным игрокам отправляются только координаты известных им
+    # кубиков. Игрокам с каналом UDP сообщение отправляется датаграммой,
+    # если помещается в нее и игрок вовремя подтверждает получение
+    # датаграмм. Иначе сообщение отправляется по TCP.
+    def send_deltas(self, moved_ids):
+        cube_canvas = self.main_frame.cube_canvas
+        now = time.monotonic()
+        # Ключи в словаре -- пары из подтвержденной версии мира и способа
+        # кодирования сообщений.
+        frames = {}
+        for addr, acked_version in self.acked_versions.items():
+            is_ack_overdue = addr in self.unacked_datagrams \
+                and self.unacked_datagrams[addr][0] <= now
+            if self.sent_versions[addr] < cube_canvas.version:
+                self.update_known_cubes(addr, moved_ids)
+            elif not is_ack_overdue:
+                continue
+            known_cubes = self.known_cubes[addr]
+            encoding = self.server.outboxes[addr].encoding
+            if len(known_cubes) == len(cube_canvas.cubes):
+                frame_key = (acked_version, encoding)
+                if frame_key not in frames:
+                    frames[frame_key] = self.server.encode_quite(
+                        addr,
+                        cube_canvas.make_delta_msg(acked_version),
+                        encoding
+                    )
+                frame = frames[frame_key]
+            else:
+                msg = cube_canvas.make_delta_msg(acked_version, known_cubes)
+                if not msg['command']['cubes']:
+                    # Видимые игроку кубики не сдвигались после
+                    # подтвержденной версии, поэтому мир игрока уже
+                    # соответствует текущей версии. Базовая версия
+                    # сдвигается без подтверждения, иначе каждое следующее
+                    # сообщение 'delta' строилось бы по все более длинной
+                    # истории.
+                    self.acked_versions[addr] = cube_canvas.version
+                    self.sent_versions[addr] = cube_canvas.version
+                    self.unacked_datagrams.pop(addr, None)
+                    continue
+                frame = self.server.encode_quite(addr, msg, encoding)
+            if frame is None:
+                pass
+            elif addr in self.server.udp_addrs and not is_ack_overdue \
+                    and len(frame) <= MAX_DATAGRAM_SIZE:
+                self.server.send_datagram(addr, frame)
+                self.unacked_datagrams.setdefault(
+                    addr, (now + UDP_ACK_TIMEOUT, cube_canvas.version))
+            else:
+                # Новое сообщение содержит все изменения из предыдущих
+                # неотправленных сообщений, поэтому они устаревают.
+                self.server.outboxes[addr].put(frame, 'delta')
+                self.unacked_datagrams.pop(addr, None)
+            self.sent_versions[addr] = cube_canvas.version
+
+    # Игроку, запросившему подтверждения событий в 'hello', в конце такта
+    # отправляются номер последнего обработанного события и координаты
+    # схваченного кубика после его обработки. По ним клиент исправляет
+    # положение кубика, которое он предсказал, не дожидаясь сервера.
+    def send_input_acks(self):
+        cube_canvas = self.main_frame.cube_canvas
+        for addr in self.pending_input_acks:
+            id_ = cube_canvas.last_grabbed_ids.get(addr)
+            command = {
+                'type': 'input_ack',
+                'seq': self.server.event_seqs[addr],
+                'version': cube_canvas.version,
+                'id': 0,
+                'x': 0,
+                'y': 0
+            }
+            if id_ is not None:
+                command['id'] = id_
+                command['x'] = quantize_coord(cube_canvas.cubes.x[id_ - 1])
+                command['y'] = quantize_coord(cube_canvas.cubes.y[id_ - 1])
+            msg = {'type': 'command', 'command': command}
+            self.send_to_player(addr, msg, key='input_ack')
+        self.pending_input_acks.clear()
+
+    # Прямоугольник, кубики внутри которого отправляются игроку, или
+    # `None`, если игроку отправляются все кубики.
+    def get_interest_rect(self, addr):
+        if addr in self.spectators:
+            return None
+        x1, y1, x2, y2 = self.viewports.get(
+            addr, (0, 0) + WINDOW_SHAPE)
+        return (
+            x1 - VIEWPORT_MARGIN,
+            y1 - VIEWPORT_MARGIN,
+            x2 + VIEWPORT_MARGIN,
+            y2 + VIEWPORT_MARGIN
+        )
+
+    # Отправляет игроку команды создания кубиков, попавших в его область
+    # интереса, и удаления кубиков, покинувших ее. Если задан список
+    # `moved_ids`, проверяются только эти кубики, иначе кубики в области
+    # интереса ищутся с помощью пространственного индекса. Кубик, который
+    # держит игрок, остается ему известен, даже если вышел из области.
+    def update_known_cubes(self, addr, moved_ids=None):
+        cube_canvas = self.main_frame.cube_canvas
+        rect = self.get_interest_rect(addr)
+        grabbed_id = cube_canvas.grabbed_cubes_ids.get(addr)
+        known_cubes = self.known_cubes[addr]
+        if moved_ids is None:
+            if rect is None:
+                visible = set(cube_canvas.cubes.ids())
+            else:
+                visible = set(cube_canvas.find_cubes_in_rect(rect))
+            if grabbed_id is not None:
+                visible.add(grabbed_id)
+            entering = visible - known_cubes
+            leaving = known_cubes - visible
+        else:
+            entering, leaving = [], []
+            for id_ in moved_ids:
+                is_visible = rect is None or id_ == grabbed_id \
+                    or cube_canvas.is_cube_in_rect(id_, rect)
+                if is_visible and id_ not in known_cubes:
+                    entering.append(id_)
+                elif not is_visible and id_ in known_cubes:
+                    leaving.append(id_)
+        for id_ in leaving:
+            known_cubes.discard(id_)
+            msg = {
+                'type': 'command',
+                'command': {'type': 'remove_cube', 'id': id_}
+            }
+            self.send_to_player(addr, msg)
+        known_cubes.update(entering)
+        chunk_size = get_add_cubes_chunk_size(
+            self.server.outboxes[addr].encoding)
+        for msg in cube_canvas.make_add_cubes_msgs(entering, chunk_size):
+            self.send_to_player(addr, msg)
+
+    def is_viewport_ok(self, addr, msg):
+        if MESSAGE_SCHEMAS['viewport'].is_valid(msg) \
+                and 0 <= msg['x2'] - msg['x1'] <= MAX_VIEWPORT_SHAPE[0] \
+                and 0 <= msg['y2'] - msg['y1'] <= MAX_VIEWPORT_SHAPE[1]:
+            return True
+        warning_msg = "Игрок {} сообщил неверную видимую область мира. " \
+            "Координаты должны быть целыми числами, а размеры области -- " \
+            "не больше {}.\nmsg = {}".format(addr, MAX_VIEWPORT_SHAPE, msg)
+        warnings.warn(warning_msg)
+        msg = {
+            'type': 'error_msg',
+            'error_class': 'ValueError',
+            'addr': addr,
+            'msg': warning_msg,
+        }
+        self.send_to_player(addr, msg)
+        return False
+
+    def set_viewport(self, addr, msg):
+        if not self.is_viewport_ok(addr, msg):
+            return
+        self.viewports[addr] = (msg['x1'], msg['y1'], msg['x2'], msg['y2'])
+        # До инициализации игрока видимая область только запоминается.
+        if addr in self.known_cubes:
+            self.update_known_cubes(addr)
+
+    def acknowledge(self, addr, version):
+        if addr not in self.acked_versions \
+                or not isinstance(version, int) \
+                or not (0 <= version <= self.sent_versions[addr]):
+            warning_msg = "Игрок {} подтвердил получение версии мира {}, " \
+                "которая ему не отправлялась.".format(addr, version)
+            warnings.warn(warning_msg)
+            msg = {
+                'type': 'error_msg',
+                'error_class': 'ValueError',
+                'addr': addr,
+                'msg': warning_msg,
+            }
+            self.send_to_player(addr, msg)
+            return
+        self.acked_versions[addr] = max(self.acked_versions[addr], version)
+        if addr in self.unacked_datagrams \
+                and version >= self.unacked_datagrams[addr][1]:
+            del self.unacked_datagrams[addr]
+
+    def process_event(self, addr, event):
+        self.main_frame.process_event(addr, event)
+        if addr in self.server.input_ack_players \
+                and addr in self.server.event_seqs:
+            self.pending_input_acks.add(addr)
+
+    def init_player(self, addr):
+        cube_canvas = self.main_frame.cube_canvas
+        msg = {
+            'type': 'command',
+            'command': {
+                "type": 'world_shape',
+                "width": cube_canvas.world_shape[0],
+                "height": cube_canvas.world_shape[1]
+            }
+        }
+        self.send_to_player(addr, msg)
+        # Игроку отправляются только кубики в его области интереса.
+        # Кубики создаются в клиентской части программы в порядке `z`, чтобы
+        # порядок их отрисовки совпадал с порядком, в котором сервер
+        # определяет, по какому кубику попала мышка. Если в область
+        # интереса попадает весь мир, игрок получает общий для всех игроков
+        # снимок мира.
+        rect = self.get_interest_rect(addr)
+        if rect is None or cube_canvas.spatial_index.is_covered_by(*rect):
+            outbox = self.server.outboxes[addr]
+            for frame in cube_canvas.get_snapshot_frames(outbox.encoding):
+                outbox.put(frame)
+            self.known_cubes[addr] = set(cube_canvas.cubes.ids())
+        else:
+            self.known_cubes[addr] = set()
+            self.update_known_cubes(addr)
+        msg = {
+            'type': 'command',
+            'command': {
+                "type": 'bind_all'
+            }
+        }
+        self.send_to_player(addr, msg)
+        # Соединение надежное, поэтому игрок получит видимые кубики в
+        # текущем состоянии мира, и подтверждения не требуется.
+        self.acked_versions[addr] = self.main_frame.cube_canvas.version
+        self.sent_versions[addr] = self.main_frame.cube_canvas.version
+
+    def send_to_player(self, addr, msg, key=None):
+        self.server.send_to_player(addr, msg, key)
+
+    def send_to_all_players(self, msg, key=None):
+        self.server.send_to_all_players(
+            msg, key, addrs=list(self.players | self.spectators))
+
+
 class CubeGameServer:
     def __init__(self, config):
         self.check_config(config)
 
-        self.server_port = config['server_port']
-
-        self.msg_types = ['error_msg', 'event']
+        self.address = get_server_address(config)
+        self.max_output_buffer = config['max_output_buffer']
+        self.slow_consumer_policy = config['slow_consumer_policy']
+        self.max_num_players = config['max_num_players']
+        self.max_room_players = config['max_room_players']
+        self.max_num_rooms = config['max_num_rooms']
+        self.num_cubes = config['num_cubes']
+        self.world_shape = config['world_shape']
+        self.shm_name = config['shm_name']
+        self.tick_rate = config['tick_rate']
+        self.tick_period = 1 / config['tick_rate']
 
-        self.main_frame = MainFrameServer(self, config['num_cubes'])
+        # Ключи в словаре -- названия комнат, значения -- экземпляры `Room`.
+        self.rooms = {}
+        # Ключи в словаре -- адреса игроков, вошедших в комнаты, значения --
+        # экземпляры `Room`.
+        self.players_rooms = {}
 
         # `self.listener` -- сокет для установления соединения с клиентами.
-        self.listener = socket.socket()
-        self.listener.settimeout(0)
-        self.listener.bind(('', self.server_port))
-        self.listener.listen(MAX_NUM_PLAYERS)
-        print(get_ip_address(), self.server_port)
+        self.listener = self.create_listener()
 
         # Словарь сокетов для обмена данными с клиентами.
         # Ключи в словаре -- адреса игроков, значения -- сокеты.
         # Адрес -- кортеж из 2-х элементов ip и номера порта.
         self.conns_to_clients = {}
+        # Ключи в словаре -- адреса игроков, значения -- экземпляры
+        # `StreamFramer`, хранящие не полностью принятые сообщения.
+        self.framers = {}
+        # Ключи в словаре -- адреса игроков, значения -- экземпляры
+        # `OutboundQueue` с сообщениями, ожидающими отправки.
+        self.outboxes = {}
 
         self.players_scenarios = {}
 
+        # Сокет канала UDP или `None`, если сервер запущен без параметра
+        # `--udp`. Ключи в словарях -- токены, выданные игрокам в
+        # 'hello_ack', адреса игроков, установивших канал UDP, и адреса, с
+        # которых игроки присылают датаграммы. Значения -- адреса игроков,
+        # адреса UDP игроков, токены игроков и адреса игроков.
+        self.udp_sock = self.create_udp_socket() if config['udp'] else None
+        self.udp_tokens = {}
+        self.udp_addrs = {}
+        self.players_udp_tokens = {}
+        self.udp_players = {}
+        # Ключи в словаре -- адреса игроков, значения -- номер последнего
+        # обработанного события. Перемещения мышки, пришедшие по UDP с
+        # меньшим номером, устарели и пропускаются.
+        self.event_seqs = {}
+        # Адреса игроков, запросивших в 'hello' сообщения 'input_ack' (см.
+        # `Room.send_input_acks()`).
+        self.input_ack_players = set()
+
+    def create_listener(self):
+        return create_listener(self.address, self.max_num_players)
+
+    def create_udp_socket(self):
+        return create_udp_socket(*parse_address(self.address)[1])
+
     def mainloop(self):
         while True:
             self.connect_to_clients()
             self.guide_players()
             self.receive_from_clients()
+            self.receive_datagrams()
+            self.tick_if_due()
+            self.flush_outboxes()
             if DT_SECONDS > 0:
                 time.sleep(DT_SECONDS)
 
@@ -435,52 +1281,182 @@ class CubeGameServer:
                 "config['num_cubes'] = {}".format(
                     0, MAX_NUM_CUBES, config['num_cubes'])
             )
+        if not all(
+                window_size <= size <= MAX_WORLD_SIZE
+                for window_size, size in zip(
+                    WINDOW_SHAPE, config['world_shape'])
+        ):
+            raise ValueError(
+                "Размеры мира должны быть не меньше размеров окна {} и не "
+                "больше {}, в то время как\nconfig['world_shape'] = "
+                "{}".format(
+                    WINDOW_SHAPE, MAX_WORLD_SIZE, config['world_shape'])
+            )
+        if not (1 <= config['tick_rate'] <= MAX_TICK_RATE):
+            raise ValueError(
+                "Частота тактов сервера должна быть в диапазоне от {} до {} "
+                "Гц, в то время как\nconfig['tick_rate'] = {}".format(
+                    1, MAX_TICK_RATE, config['tick_rate'])
+            )
+        if not (1 <= config['max_num_players'] <= MAX_NUM_PLAYERS_LIMIT):
+            raise ValueError(
+                "Максимальное число игроков должно быть в диапазоне от {} до "
+                "{}, в то время как\nconfig['max_num_players'] = {}".format(
+                    1, MAX_NUM_PLAYERS_LIMIT, config['max_num_players'])
+            )
+        if not (1 <= config['max_room_players'] <= MAX_NUM_PLAYERS_LIMIT):
+            raise ValueError(
+                "Максимальное число игроков в комнате должно быть в "
+                "диапазоне от {} до {}, в то время как\n"
+                "config['max_room_players'] = {}".format(
+                    1, MAX_NUM_PLAYERS_LIMIT, config['max_room_players'])
+            )
+        if not (1 <= config['max_num_rooms'] <= MAX_NUM_ROOMS_LIMIT):
+            raise ValueError(
+                "Максимальное число комнат должно быть в диапазоне от {} до "
+                "{}, в то время как\nconfig['max_num_rooms'] = {}".format(
+                    1, MAX_NUM_ROOMS_LIMIT, config['max_num_rooms'])
+            )
+        if not (0 <= config['num_workers'] <= MAX_NUM_WORKERS):
+            raise ValueError(
+                "Число исполнителей должно быть в диапазоне от {} до {}, в "
+                "то время как\nconfig['num_workers'] = {}".format(
+                    0, MAX_NUM_WORKERS, config['num_workers'])
+            )
+        if config['shm_name'] is not None \
+                and not (1 <= len(config['shm_name']) <= MAX_SHM_NAME_LENGTH):
+            raise ValueError(
+                "Имя блока разделяемой памяти должно содержать от {} до {} "
+                "символов, в то время как\nconfig['shm_name'] = {}".format(
+                    1, MAX_SHM_NAME_LENGTH, repr(config['shm_name']))
+            )
+        if config['num_workers'] > 0 and config['engine'] != 'selectors':
+            raise ValueError(
+                "Исполнители работают только с движком 'selectors', в то "
+                "время как\nconfig['engine'] = {}".format(
+                    repr(config['engine']))
+            )
+        if config['max_output_buffer'] \
+                < MAX_MSG_SIZE + NUM_BYTES_FOR_MSG_LENGTH:
+            raise ValueError(
+                "Очередь неотправленных сообщений должна вмещать хотя бы "
+                "одно сообщение максимального размера {} байт, в то время "
+                "как\nconfig['max_output_buffer'] = {}".format(
+                    MAX_MSG_SIZE + NUM_BYTES_FOR_MSG_LENGTH,
+                    config['max_output_buffer'])
+            )
+        family, _ = parse_address(get_server_address(config))
+        if config['udp'] and family != socket.AF_INET:
+            raise ValueError(
+                "Канал UDP доступен, только если сервер принимает "
+                "подключения TCP, в то время как\nconfig['address'] = "
+                "{}".format(repr(config['address']))
+            )
 
     def connect_to_clients(self):
-        if len(self.conns_to_clients) < MAX_NUM_PLAYERS:
+        if len(self.conns_to_clients) < self.max_num_players:
             try:
-                conn, addr = self.listener.accept()
-                conn.settimeout(0)
-                self.conns_to_clients[addr] = conn
-                self.players_scenarios[addr] = PlayerScenario(self, addr)
+                conn, addr = accept(self.listener)
+                self.add_player(conn, addr)
             except BlockingIOError:
                 pass
 
+    def add_player(self, conn, addr):
+        conn.settimeout(0)
+        self.conns_to_clients[addr] = conn
+        self.framers[addr] = StreamFramer(conn, addr)
+        self.outboxes[addr] = OutboundQueue(
+            conn,
+            addr,
+            self.max_output_buffer,
+            self.slow_consumer_policy
+        )
+        self.players_scenarios[addr] = PlayerScenario(self, addr)
+
+    # Подключает к серверу игрока из того же процесса, например, бота или
+    # тест, через `socket.socketpair()`. Возвращает сокет игрока. Вызывается
+    # до запуска главного цикла или из того же потока, что и он.
+    def connect_local_player(self):
+        if len(self.conns_to_clients) >= self.max_num_players:
+            raise ConnectionRefusedError(
+                "Превышено максимальное число игроков {}.".format(
+                    self.max_num_players))
+        conn, player_conn = socket.socketpair()
+        self.add_player(conn, get_peer_addr(conn.getpeername()))
+        return player_conn
+
     def receive_from_clients(self):
         # Возможен обрыв соединения соединения и удаление элемента словаря.
         # Менять ключи элемента словаря в процессе итерации по нему запрещено.
         for addr in list(self.conns_to_clients):
             self.receive_from_client(addr)
 
+    def process_msgs(self, addr, msgs):
+        for msg in msgs:
+            if addr not in self.conns_to_clients:
+                # Соединение было закрыто при обработке предыдущего
+                # сообщения.
+                return
+            if not has_known_type(msg, CLIENT_MSG_TYPES):
+                warning_msg = "Сообщение неизвестного типа пришло от " \
+                    "игрока {}. Сообщение должно быть словарем со значением " \
+                    "'type' из {}.\nmsg = {}".format(
+                        repr(addr), sorted(CLIENT_MSG_TYPES), repr(msg))
+                warnings.warn(warning_msg)
+                msg = {
+                    'type': 'error_msg',
+                    'error_class': 'ValueError',
+                    'addr': addr,
+                    'msg': warning_msg,
+                }
+                self.send_to_player(addr, msg)
+            elif msg['type'] == 'error_msg':
+                warnings.warn(
+                    'Пришло сообщение об ошибке от игрока {}\n'
+                    'Сообщение:\n'.format(addr) +
+                    msg['msg']
+                )
+            elif msg['type'] == 'event':
+                # Номер есть только у событий игроков с каналом UDP или
+                # запросивших сообщения 'input_ack'.
+                if isinstance(msg.get('seq'), int):
+                    self.event_seqs[addr] = max(
+                        self.event_seqs.get(addr, msg['seq']), msg['seq'])
+                self.players_scenarios[addr].process_event(
+                    addr, msg['event'])
+            elif msg['type'] == 'hello':
+                self.players_scenarios[addr].process_hello(addr, msg)
+            elif msg['type'] == 'join':
+                self.players_scenarios[addr].process_join(
+                    addr, msg.get('room'), msg.get('role', DEFAULT_ROLE))
+            elif msg['type'] == 'ack':
+                room = self.get_player_room(addr, msg)
+                if room is not None:
+                    room.acknowledge(addr, msg.get('version'))
+            elif msg['type'] == 'viewport':
+                room = self.get_player_room(addr, msg)
+                if room is not None:
+                    room.set_viewport(addr, msg)
+            elif msg['type'] == 'heartbeat':
+                pass
+
     def receive_from_client(self, addr):
+        self.handle_received(addr, self.framers[addr].receive)
+
+    # Принимает сообщения игрока `addr` методом `StreamFramer` `receive`
+    # с аргументами `args` и обрабатывает их. Ошибка при обработке
+    # сообщений одного игрока не должна останавливать сервер, поэтому
+    # соединение с игроком, сообщения которого не удалось обработать,
+    # закрывается.
+    def handle_received(self, addr, receive, *args):
         try:
-            msgs, e = recv_data(self.conns_to_clients[addr], addr)
-            for msg in msgs:
-                if msg['type'] == 'error_msg':
-                    warnings.warn(
-                        'Пришло сообщение об ошибке от игрока {}\n'
-                        'Сообщение:\n'.format(addr) +
-                        msg['msg']
-                    )
-                elif msg['type'] == 'event':
-                    self.players_scenarios[addr].process_event(
-                        addr, msg['event'])
-                else:
-                    warning_msg = "Сообщение неизвестного типа {} пришло "\
-                        "от игрока {}.".format(repr(msg['type']), repr(addr))
-                    warnings.warn(warning_msg)
-                    msg = {
-                        'type': 'error_msg',
-                        'error_class': 'ValueError',
-                        'addr': addr,
-                        'msg': warning_msg,
-                        'event': msg['event'],
-                    }
-                    send_data_quite(self.conns_to_clients[addr], addr, msg)
+            msgs, e = receive(*args)
+            self.process_msgs(addr, msgs)
             if e is not None:
                 raise e
         except CorruptedMessageError as e:
             warnings.warn(e.message)
+            self.send_to_player(addr, e.get_error_msg())
         except BlockingIOError:
             pass
         except ConnectionResetError as e:
@@ -489,10 +1465,7 @@ class CubeGameServer:
             # FIXME
             # Непонятно когда возникает ошибка и потому не ясно следует ли
             # закрывать и удалять socket.
-            self.conns_to_clients[addr].close()
-            del self.conns_to_clients[addr]
-            del self.players_scenarios[addr]
-            self.main_frame.cube_canvas.release_player_cube(addr)
+            self.disconnect_player(addr)
         except ConnectionAbortedError as e:
             warnings.warn(e)
             warnings.warn(CONNECTION_ABORTED_ERROR_WARNING_TMPL.format(addr))
@@ -503,46 +1476,222 @@ class CubeGameServer:
             # ошибку временном отключении wifi. В последнем случаем удаление
             # сокета приводит к необходимости перезапуска клиентской части
             # приложения.
-            self.conns_to_clients[addr].close()
-            del self.conns_to_clients[addr]
-            del self.players_scenarios[addr]
-            self.main_frame.cube_canvas.release_player_cube(addr)
+            self.disconnect_player(addr)
         except Exception as e:
+            self.handle_unexpected_error(addr, e)
+
+    # Исключение `e`, для которого нет обработчика, возникло при обработке
+    # сообщения игрока `addr`. Соединение с игроком закрывается, чтобы
+    # ошибка не остановила сервер.
+    def handle_unexpected_error(self, addr, e):
+        warnings.warn(e)
+        warnings.warn(
+            "Для исключения типа {} не был написан обработчик. Возможно, "
+            "стоит это сделать. Соединение с игроком {} будет "
+            "закрыто.".format(type(e), addr)
+        )
+        if addr in self.conns_to_clients:
+            self.disconnect_player(addr)
+
+    def disconnect_player(self, addr):
+        self.conns_to_clients[addr].close()
+        del self.conns_to_clients[addr]
+        del self.framers[addr]
+        del self.outboxes[addr]
+        del self.players_scenarios[addr]
+        self.udp_tokens.pop(self.players_udp_tokens.pop(addr, None), None)
+        self.udp_players.pop(self.udp_addrs.pop(addr, None), None)
+        self.event_seqs.pop(addr, None)
+        self.input_ack_players.discard(addr)
+        room = self.players_rooms.pop(addr, None)
+        if room is not None:
+            room.remove_player(addr)
+            if room.is_empty():
+                room.close()
+                del self.rooms[room.name]
+
+    def flush_outboxes(self):
+        for addr in list(self.outboxes):
+            if self.outboxes[addr].overflowed:
+                warnings.warn(SLOW_CONSUMER_WARNING_TMPL.format(
+                    addr, self.max_output_buffer))
+                self.disconnect_player(addr)
+        waiting = {
+            outbox.conn: addr for addr, outbox in self.outboxes.items()
+            if outbox.wants_write()
+        }
+        if not waiting:
+            return
+        # Запись выполняется только в сокеты, готовые ее принять.
+        for conn in get_writable_conns(list(waiting)):
+            self.flush_outbox(waiting[conn])
+
+    def flush_outbox(self, addr):
+        try:
+            self.outboxes[addr].flush()
+        except (BrokenPipeError, ConnectionResetError) as e:
             warnings.warn(e)
-            warnings.warn(
-                "Для исключения типа {} не был написан обработчик. Возможно, "
-                "стоит это сделать.".format(type(e))
-            )
+            warnings.warn(CONNECTION_RESET_ERROR_WARNING_TMPL.format(addr))
+            self.disconnect_player(addr)
+        except ConnectionAbortedError as e:
+            warnings.warn(e)
+            warnings.warn(CONNECTION_ABORTED_ERROR_WARNING_TMPL.format(addr))
+            self.disconnect_player(addr)
+
+    # Время в секундах до конца ближайшего такта, в конце которого есть что
+    # рассылать, или `None`, если ждать конца такта не нужно ни в одной
+    # комнате.
+    def get_time_to_tick(self):
+        times = [room.get_time_to_tick() for room in self.rooms.values()]
+        return min(
+            (time_to_tick for time_to_tick in times
+             if time_to_tick is not None),
+            default=None
+        )
+
+    def tick_if_due(self):
+        for room in self.rooms.values():
+            room.tick_if_due()
+
+    def get_player_room(self, addr, msg):
+        if addr in self.players_rooms:
+            return self.players_rooms[addr]
+        warning_msg = "Игрок {} прислал сообщение типа {}, не войдя в " \
+            "комнату.".format(addr, repr(msg['type']))
+        warnings.warn(warning_msg)
+        msg = {
+            'type': 'error_msg',
+            'error_class': 'ValueError',
+            'addr': addr,
+            'msg': warning_msg,
+        }
+        self.send_to_player(addr, msg)
+        return None
+
+    # Помещает игрока в комнату `room_name` в роли `role`, создавая
+    # комнату при необходимости. Возвращает `True`, если игрок вошел в
+    # комнату. Зрители могут войти в комнату, даже если она заполнена.
+    def join_room(self, addr, room_name, role=DEFAULT_ROLE):
+        if not (
+                isinstance(room_name, str)
+                and 1 <= len(room_name) <= MAX_ROOM_NAME_LENGTH
+        ):
+            warning_msg = "Название комнаты должно быть непустой строкой " \
+                "длиной не больше {} символов, в то время как игрок {} " \
+                "прислал {}.".format(
+                    MAX_ROOM_NAME_LENGTH, addr, repr(room_name))
+        elif role not in ROLES:
+            warning_msg = "Игрок {} выбрал неизвестную роль {}. " \
+                "Поддерживаются роли {}.".format(addr, repr(role), ROLES)
+        elif room_name not in self.rooms \
+                and len(self.rooms) >= self.max_num_rooms:
+            warning_msg = "Превышено максимальное число комнат {}. Игрок " \
+                "{} не может создать комнату {}.".format(
+                    self.max_num_rooms, addr, repr(room_name))
+        elif role == 'player' and room_name in self.rooms \
+                and self.rooms[room_name].is_full():
+            warning_msg = "В комнате {} уже {} игроков. Игрок {} не может " \
+                "в нее войти.".format(
+                    repr(room_name), self.max_room_players, addr)
+        else:
+            if room_name not in self.rooms:
+                self.rooms[room_name] = Room(self, room_name)
+            self.rooms[room_name].add_player(addr, role)
+            self.players_rooms[addr] = self.rooms[room_name]
+            return True
+        warnings.warn(warning_msg)
+        msg = {
+            'type': 'error_msg',
+            'error_class': 'ValueError',
+            'addr': addr,
+            'msg': warning_msg,
+            'room': room_name
+        }
+        self.send_to_player(addr, msg)
+        return False
+
+    # Выбирает версию протокола и способ кодирования сообщений игроку.
+    # Ответ 'hello_ack' кодируется прежним способом, так как игрок узнает о
+    # новом только из ответа. Если игрок поддерживает канал UDP, в ответ
+    # добавляются порт UDP сервера и токен, по которому сервер узнает
+    # датаграммы игрока.
+    def negotiate(self, addr, hello):
+        msg = make_hello_ack_msg(hello, self.tick_rate)
+        if msg['type'] == 'error_msg':
+            msg['addr'] = addr
+            warnings.warn(msg['msg'])
+            self.send_to_player(addr, msg)
+            return
+        # По UDP передаются только сообщения, закодированные `struct`.
+        if hello.get('udp') is True and self.udp_sock is not None \
+                and msg['codec'] == 'binary':
+            token = self.players_udp_tokens.get(addr)
+            if token is None:
+                token = secrets.randbits(64)
+                self.udp_tokens[token] = addr
+                self.players_udp_tokens[addr] = token
+            msg['udp_port'] = self.udp_sock.getsockname()[1]
+            msg['udp_token'] = token
+        if hello.get('input_acks') is True:
+            self.input_ack_players.add(addr)
+            msg['input_acks'] = True
+        self.send_to_player(addr, msg)
+        self.outboxes[addr].encoding = FrameEncoding(
+            msg['codec'], msg['compression'], msg['max_msg_size'])
+
+    def warn_late_hello(self, addr, hello):
+        warning_msg = "Игрок {} прислал сообщение 'hello' после входа в " \
+            "комнату. Способ кодирования сообщений не изменится.".format(
+                addr)
+        warnings.warn(warning_msg)
+        msg = {
+            'type': 'error_msg',
+            'error_class': 'ValueError',
+            'addr': addr,
+            'msg': warning_msg,
+        }
+        self.send_to_player(addr, msg)
+
+    def warn_repeated_join(self, addr, room_name, role):
+        warning_msg = "Игрок {} уже находится в комнате {} и не может " \
+            "войти в комнату {}.".format(
+                addr, repr(self.players_rooms[addr].name), repr(room_name))
+        warnings.warn(warning_msg)
+        msg = {
+            'type': 'error_msg',
+            'error_class': 'ValueError',
+            'addr': addr,
+            'msg': warning_msg,
+            'room': room_name
+        }
+        self.send_to_player(addr, msg)
 
     def guide_players(self):
         for addr in self.conns_to_clients:
             self.players_scenarios[addr].act()
 
     def process_event(self, addr, event):
-        self.main_frame.process_event(addr, event)
+        self.players_rooms[addr].process_event(addr, event)
 
     def init_player(self, addr):
-        cubes = self.main_frame.cube_canvas.cubes
-        for cube in cubes.values():
-            msg = {
-                'type': 'command',
-                'command': {
-                    "type": 'add_cube',
-                    "id": cube.id,
-                    "x": cube.x,
-                    "y": cube.y,
-                    "size": cube.size,
-                    "color": cube.color
-                }
-            }
-            send_data_quite(self.conns_to_clients[addr], addr, msg)
+        self.players_rooms[addr].init_player(addr)
+
+    def is_spectator(self, addr):
+        room = self.players_rooms.get(addr)
+        return room is not None and addr in room.spectators
+
+    def warn_spectator_event(self, addr, event):
+        warning_msg = "На сервер пришло событие от зрителя {}. Зрители " \
+            "не могут двигать кубики.\nevent = {}".format(repr(addr), event)
+        warnings.warn(warning_msg)
         msg = {
-            'type': 'command',
-            'command': {
-                "type": 'bind_all'
-            }
+            'type': 'error_msg',
+            'error_class': 'ValueError',
+            'addr': addr,
+            'msg': warning_msg,
+            'event': event,
         }
-        send_data_quite(self.conns_to_clients[addr], addr, msg)
+        self.send_to_player(addr, msg)
 
     def warn_events_before_init(self, addr, event):
         warning_msg = "На сервер от игрока {} пришло сообщение до " \
@@ -555,22 +1704,733 @@ class CubeGameServer:
             'msg': warning_msg,
             'event': event,
         }
-        send_data_quite(self.conns_to_clients[addr], addr, msg)
+        self.send_to_player(addr, msg)
+
+    def receive_datagrams(self):
+        if self.udp_sock is None:
+            return
+        while True:
+            try:
+                data, udp_addr = self.udp_sock.recvfrom(MAX_DATAGRAM_SIZE)
+            except BlockingIOError:
+                return
+            except ConnectionResetError:
+                # В Windows так сообщается о недоставленной датаграмме.
+                continue
+            # С адреса, не привязанного к игроку, принимается только
+            # 'udp_hello'. Клиент не сжимает датаграммы.
+            addr = self.udp_players.get(udp_addr)
+            try:
+                msg = decode_datagram(
+                    data,
+                    UDP_HELLO_TAGS if addr is None else CLIENT_DATAGRAM_TAGS,
+                    compressed_ok=False
+                )
+            except DECODING_ERRORS as e:
+                warnings.warn(
+                    "Не удалось декодировать датаграмму от {}: "
+                    "{}".format(udp_addr, e))
+                continue
+            try:
+                self.process_datagram(udp_addr, msg)
+            except Exception as e:
+                self.handle_unexpected_error(
+                    self.udp_players.get(udp_addr, udp_addr), e)
+
+    # Датаграммы с неизвестных адресов, кроме 'udp_hello' с выданным
+    # токеном, пропускаются без ответа: их мог отправить кто угодно.
+    def process_datagram(self, udp_addr, msg):
+        if msg.get('type') == 'udp_hello':
+            token = msg.get('token')
+            if not isinstance(token, int) or token not in self.udp_tokens:
+                return
+            addr = self.udp_tokens[token]
+            self.udp_players.pop(self.udp_addrs.get(addr), None)
+            self.udp_addrs[addr] = udp_addr
+            self.udp_players[udp_addr] = addr
+            frame = self.encode_quite(
+                addr, {'type': 'udp_ready'}, self.outboxes[addr].encoding)
+            self.send_datagram(addr, frame)
+            return
+        addr = self.udp_players.get(udp_addr)
+        if addr is None:
+            return
+        if msg.get('type') == 'motion':
+            if not MESSAGE_SCHEMAS['motion'].is_valid(msg) \
+                    or msg['seq'] <= self.event_seqs.get(addr, -1):
+                return
+            self.event_seqs[addr] = msg['seq']
+            event = {'type': '<B1-Motion>', 'x': msg['x'], 'y': msg['y']}
+            self.players_scenarios[addr].process_event(addr, event)
+        elif msg.get('type') == 'ack':
+            room = self.get_player_room(addr, msg)
+            if room is not None:
+                room.acknowledge(addr, msg.get('version'))
+        else:
+            warnings.warn(
+                "Датаграмма неизвестного типа {} пришла от игрока "
+                "{}.".format(repr(msg.get('type')), addr))
+
+    # Ошибки отправки не обрабатываются: датаграмма теряется так же, как
+    # если бы ее потеряла сеть.
+    def send_datagram(self, addr, frame):
+        try:
+            self.udp_sock.sendto(frame, self.udp_addrs[addr])
+        except OSError:
+            pass
 
     def close_all_sockets(self):
-        self.listener.close()
+        close_listener(self.listener)
+        if self.udp_sock is not None:
+            self.udp_sock.close()
         for conn in self.conns_to_clients.values():
             conn.close()
+        # Вместе с сокетами удаляются блоки разделяемой памяти комнат.
+        for room in self.rooms.values():
+            room.close()
+
+    @staticmethod
+    def encode_quite(addr, msg, encoding=DEFAULT_ENCODING):
+        try:
+            return encode_frame(msg, *encoding)
+        except ValueError as e:
+            warnings.warn(e)
+            warn_no_msg_was_sent(msg, addr)
+            return None
+
+    # `key` -- ключ, по которому определяется, какие сообщения устаревают
+    # при получении новых. См. `OutboundQueue`.
+    def send_to_player(self, addr, msg, key=None):
+        outbox = self.outboxes[addr]
+        frame = self.encode_quite(addr, msg, outbox.encoding)
+        if frame is not None:
+            outbox.put(frame, key)
+
+    # `addrs` -- адреса получателей. По умолчанию сообщение отправляется
+    # всем подключенным игрокам.
+    def send_to_all_players(self, msg, key=None, addrs=None):
+        if addrs is None:
+            addrs = list(self.outboxes)
+        # Сообщение кодируется один раз для всех игроков с одинаковым
+        # способом кодирования.
+        frames = {}
+        for addr in addrs:
+            outbox = self.outboxes[addr]
+            if outbox.encoding not in frames:
+                frames[outbox.encoding] = self.encode_quite(
+                    BROADCAST_ADDR, msg, outbox.encoding)
+            if frames[outbox.encoding] is not None:
+                outbox.put(frames[outbox.encoding], key)
 
-    def send_to_all_players(self, msg):
-        for addr, conn in self.conns_to_clients.items():
-            send_data_quite(conn, addr, msg)
+
+# Главный цикл ожидает готовности сокетов с помощью `selectors` вместо
+# периодического опроса. Сервер просыпается, только когда от игроков пришли
+# данные, можно продолжить отправку данных, отложенную из-за переполнения
+# буфера сокета, или подключается новый игрок.
+class SelectorCubeGameServer(CubeGameServer):
+    def __init__(self, config):
+        super().__init__(config)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        if self.udp_sock is not None:
+            self.selector.register(self.udp_sock, selectors.EVENT_READ)
+
+    def mainloop(self):
+        while True:
+            for key, mask in self.selector.select(self.get_timeout()):
+                if key.fileobj is self.listener:
+                    self.connect_to_clients()
+                    continue
+                if key.fileobj is self.udp_sock:
+                    self.receive_datagrams()
+                    continue
+                addr = key.data
+                if mask & selectors.EVENT_READ \
+                        and addr in self.conns_to_clients:
+                    self.receive_from_client(addr)
+                if mask & selectors.EVENT_WRITE \
+                        and addr in self.conns_to_clients:
+                    self.flush_outbox(addr)
+            self.guide_players()
+            self.tick_if_due()
+            self.flush_outboxes()
+
+    # Время в секундах, в течение которого `self.selector` ожидает
+    # готовности сокетов. `None` -- ждать без ограничения по времени.
+    def get_timeout(self):
+        return self.get_time_to_tick()
+
+    def connect_to_clients(self):
+        # Принимаются все ожидающие подключения.
+        while len(self.conns_to_clients) < self.max_num_players:
+            try:
+                conn, addr = accept(self.listener)
+            except BlockingIOError:
+                return
+            self.add_player(conn, addr)
+        # Пока число игроков максимально, новые подключения не принимаются
+        # и не должны будить сервер.
+        self.selector.unregister(self.listener)
+
+    def add_player(self, conn, addr):
+        super().add_player(conn, addr)
+        self.selector.register(conn, selectors.EVENT_READ, addr)
+
+    def disconnect_player(self, addr):
+        self.selector.unregister(self.conns_to_clients[addr])
+        super().disconnect_player(addr)
+        if self.listener not in self.selector.get_map():
+            self.selector.register(self.listener, selectors.EVENT_READ)
+
+    def flush_outboxes(self):
+        for addr in list(self.outboxes):
+            if self.outboxes[addr].overflowed:
+                warnings.warn(SLOW_CONSUMER_WARNING_TMPL.format(
+                    addr, self.max_output_buffer))
+                self.disconnect_player(addr)
+                continue
+            if self.outboxes[addr]:
+                self.flush_outbox(addr)
+            if addr in self.outboxes:
+                # Готовность к записи отслеживается, только пока есть
+                # неотправленные данные.
+                events = selectors.EVENT_READ
+                if self.outboxes[addr].wants_write():
+                    events |= selectors.EVENT_WRITE
+                conn = self.conns_to_clients[addr]
+                if self.selector.get_key(conn).events != events:
+                    self.selector.modify(conn, events, addr)
+
+    def close_all_sockets(self):
+        self.selector.close()
+        super().close_all_sockets()
+
+
+# Позволяет `OutboundQueue` передавать данные в `asyncio.StreamWriter`.
+# Пока буфер транспорта заполнен, данные не принимаются, и сообщения
+# остаются в очереди игрока.
+class StreamWriterAdapter:
+    def __init__(self, writer):
+        self.writer = writer
+
+    def sendmsg(self, buffers):
+        if self.writer.is_closing():
+            raise ConnectionResetError(
+                CONNECTION_RESET_ERROR_WARNING_TMPL.format(
+                    self.writer.get_extra_info('peername')))
+        if self.writer.transport.get_write_buffer_size() \
+                > ASYNCIO_WRITE_BUFFER_LIMIT:
+            raise BlockingIOError
+        self.writer.writelines(buffers)
+        return sum(map(len, buffers))
+
+    def close(self):
+        self.writer.close()
+
+
+# Соединения с игроками обслуживаются `asyncio`. Для каждого игрока
+# запускается задача, читающая его сообщения, а отправка сообщений всем
+# игрокам выполняется одной задачей `self.broadcast()`. Модель игры та же,
+# что и у остальных движков.
+class AsyncioCubeGameServer(CubeGameServer):
+    def __init__(self, config):
+        super().__init__(config)
+        self.idle_timeout = config['idle_timeout']
+        self.outboxes_ready = None
+        self.reader_tasks = set()
+        # Сокеты игроков из того же процесса, подключенных до запуска
+        # главного цикла.
+        self.local_conns = []
+
+    def mainloop(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.outboxes_ready = asyncio.Event()
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, stop.set)
+        except (NotImplementedError, AttributeError):
+            # В Windows обработчики сигналов не поддерживаются.
+            pass
+        # `asyncio` закрывает переданный сокет вместе с сервером, поэтому
+        # ему передается копия: `close_all_sockets()` закрывает исходный
+        # сокет и удаляет файл сокета Unix.
+        server = await asyncio.start_server(
+            self.handle_connection, sock=self.listener.dup())
+        for conn in self.local_conns:
+            reader, writer = await asyncio.open_connection(sock=conn)
+            asyncio.create_task(self.handle_connection(reader, writer))
+        self.local_conns.clear()
+        if self.udp_sock is not None:
+            loop.add_reader(self.udp_sock, self.receive_datagrams)
+        broadcast_task = asyncio.create_task(self.broadcast())
+        try:
+            await stop.wait()
+        finally:
+            await self.shutdown(server, broadcast_task)
+
+    async def shutdown(self, server, broadcast_task):
+        server.close()
+        if self.udp_sock is not None:
+            asyncio.get_running_loop().remove_reader(self.udp_sock)
+        broadcast_task.cancel()
+        await asyncio.gather(broadcast_task, return_exceptions=True)
+        # Игрокам отправляется все, что успело накопиться в очередях.
+        for addr in list(self.outboxes):
+            self.flush_outbox(addr)
+        # После закрытия соединений задачи, читающие сообщения игроков,
+        # завершаются сами.
+        for addr in list(self.conns_to_clients):
+            self.disconnect_player(addr)
+        await asyncio.gather(*self.reader_tasks, return_exceptions=True)
+
+    # Игроки из того же процесса обслуживаются так же, как остальные, после
+    # запуска главного цикла.
+    def connect_local_player(self):
+        if len(self.conns_to_clients) + len(self.local_conns) \
+                >= self.max_num_players:
+            raise ConnectionRefusedError(
+                "Превышено максимальное число игроков {}.".format(
+                    self.max_num_players))
+        conn, player_conn = socket.socketpair()
+        self.local_conns.append(conn)
+        return player_conn
+
+    async def handle_connection(self, reader, writer):
+        addr = get_peer_addr(writer.get_extra_info('peername'))
+        if len(self.conns_to_clients) >= self.max_num_players:
+            warnings.warn(
+                "Превышено максимальное число игроков {}. Игрок {} не будет "
+                "подключен.".format(self.max_num_players, addr))
+            writer.close()
+            return
+        self.reader_tasks.add(asyncio.current_task())
+        self.add_stream_player(addr, writer)
+        try:
+            await self.read_from_player(addr, reader)
+        finally:
+            self.reader_tasks.discard(asyncio.current_task())
+            if addr in self.conns_to_clients:
+                self.disconnect_player(addr)
+                self.outboxes_ready.set()
+
+    def add_stream_player(self, addr, writer):
+        self.conns_to_clients[addr] = StreamWriterAdapter(writer)
+        self.framers[addr] = StreamFramer(None, addr)
+        self.outboxes[addr] = OutboundQueue(
+            self.conns_to_clients[addr],
+            addr,
+            self.max_output_buffer,
+            self.slow_consumer_policy
+        )
+        self.players_scenarios[addr] = PlayerScenario(self, addr)
+        self.guide_players()
+
+    async def read_from_player(self, addr, reader):
+        while addr in self.conns_to_clients:
+            try:
+                data = await asyncio.wait_for(
+                    reader.read(INITIAL_RECV_BUFFER_SIZE), self.idle_timeout)
+            except asyncio.TimeoutError:
+                warnings.warn(
+                    "От игрока {} не поступало сообщений в течение {} с. "
+                    "Соединение будет закрыто.".format(
+                        addr, self.idle_timeout))
+                return
+            except ConnectionError as e:
+                warnings.warn(e)
+                warnings.warn(
+                    CONNECTION_RESET_ERROR_WARNING_TMPL.format(addr))
+                return
+            if addr not in self.conns_to_clients:
+                return
+            if not data:
+                warnings.warn(CONNECTION_CLOSED_WARNING_TMPL.format(addr))
+                return
+            self.handle_received(addr, self.framers[addr].feed, data)
+            self.guide_players()
+            # Сообщения игрока могли сдвинуть кубики, и задаче
+            # `self.broadcast()` нужно пересчитать время ожидания.
+            self.outboxes_ready.set()
+
+    # Датаграммы могли сдвинуть кубики или подтвердить получение
+    # координат, и задаче `self.broadcast()` нужно пересчитать время
+    # ожидания.
+    def receive_datagrams(self):
+        super().receive_datagrams()
+        self.outboxes_ready.set()
+
+    async def broadcast(self):
+        while True:
+            timeout = self.get_time_to_tick()
+            if any(outbox for outbox in self.outboxes.values()):
+                timeout = ASYNCIO_RETRY_SEND_INTERVAL if timeout is None \
+                    else min(timeout, ASYNCIO_RETRY_SEND_INTERVAL)
+            try:
+                await asyncio.wait_for(self.outboxes_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.outboxes_ready.clear()
+            self.tick_if_due()
+            self.flush_outboxes()
+
+    def flush_outboxes(self):
+        for addr in list(self.outboxes):
+            if self.outboxes[addr].overflowed:
+                warnings.warn(SLOW_CONSUMER_WARNING_TMPL.format(
+                    addr, self.max_output_buffer))
+                self.disconnect_player(addr)
+            elif self.outboxes[addr]:
+                self.flush_outbox(addr)
+
+    def send_to_player(self, addr, msg, key=None):
+        super().send_to_player(addr, msg, key)
+        self.outboxes_ready.set()
+
+    def send_to_all_players(self, msg, key=None, addrs=None):
+        super().send_to_all_players(msg, key, addrs)
+        self.outboxes_ready.set()
+
+
+# Исполнитель в режиме супервизора. Вместо сокета для подключения игроков
+# главный цикл ожидает сообщений супервизора на сокете `control_conn`
+# (socketpair типа SOCK_SEQPACKET). Супервизор передает сокеты игроков
+# вместе с данными, принятыми им до сообщения 'join' включительно.
+# Исполнитель раз в `HEALTH_REPORT_INTERVAL` секунд сообщает супервизору
+# число игроков и список комнат.
+class WorkerCubeGameServer(SelectorCubeGameServer):
+    def __init__(self, config, control_conn):
+        self.control_conn = control_conn
+        super().__init__(config)
+        # Число сокетов игроков, полученных от супервизора. По нему
+        # супервизор определяет, учтены ли в отчете все переданные сокеты.
+        self.num_handoffs = 0
+        self.next_report_time = time.monotonic()
+
+    def create_listener(self):
+        self.control_conn.settimeout(0)
+        return self.control_conn
+
+    # У каждого исполнителя свой порт UDP, который игроки узнают из
+    # 'hello_ack'.
+    def create_udp_socket(self):
+        return create_udp_socket(parse_address(self.address)[1][0], 0)
+
+    def get_timeout(self):
+        time_to_report = max(0, self.next_report_time - time.monotonic())
+        timeout = self.get_time_to_tick()
+        return time_to_report if timeout is None \
+            else min(timeout, time_to_report)
+
+    def connect_to_clients(self):
+        while True:
+            try:
+                data, fds, _, _ = socket.recv_fds(
+                    self.control_conn, CONTROL_MSG_MAX_SIZE, 1)
+            except BlockingIOError:
+                return
+            if not data:
+                # Супервизор завершил работу.
+                raise SystemExit(0)
+            msg = pickle.loads(data)
+            if msg['type'] == 'handoff':
+                self.num_handoffs += 1
+                conn = socket.socket(fileno=fds[0])
+                if len(self.conns_to_clients) >= self.max_num_players:
+                    warnings.warn(
+                        "Превышено максимальное число игроков {}. Игрок {} "
+                        "не будет подключен.".format(
+                            self.max_num_players, msg['addr']))
+                    conn.close()
+                    continue
+                self.add_handed_off_player(conn, msg['addr'], msg['data'])
+
+    def add_handed_off_player(self, conn, addr, data):
+        self.add_player(conn, addr)
+        self.handle_received(addr, self.framers[addr].feed, data)
+
+    # Кроме рассылки в конце такта, исполнитель периодически отправляет
+    # отчет супервизору.
+    def tick_if_due(self):
+        super().tick_if_due()
+        if time.monotonic() >= self.next_report_time:
+            self.report_health()
+            self.next_report_time = \
+                time.monotonic() + HEALTH_REPORT_INTERVAL
+
+    def report_health(self):
+        msg = {
+            'type': 'health',
+            'num_players': len(self.conns_to_clients),
+            'rooms': list(self.rooms),
+            'num_handoffs': self.num_handoffs
+        }
+        try:
+            self.control_conn.send(pickle.dumps(msg))
+        except BlockingIOError:
+            # Супервизор не успевает принимать отчеты. Следующий отчет
+            # будет отправлен через `HEALTH_REPORT_INTERVAL` секунд.
+            pass
+
+
+# Супервизор принимает подключения игроков, дожидается от каждого игрока
+# сообщения 'join' и передает сокет игрока исполнителю, в котором
+# находится комната. Новая комната создается в исполнителе с наименьшим
+# числом игроков. Исполнитель, процесс которого завершился, перезапускается.
+# Если игроку не удалось войти в комнату, повторные сообщения 'join'
+# обрабатывает тот же исполнитель.
+class CubeGameSupervisor:
+    def __init__(self, config):
+        CubeGameServer.check_config(config)
+        self.config = config
+        self.num_workers = config['num_workers']
+        self.max_num_players = config['max_num_players']
+
+        self.selector = selectors.DefaultSelector()
+        # Ключи в словарях -- номера исполнителей, значения -- процессы,
+        # сокеты для обмена сообщениями с ними, число игроков по последнему
+        # отчету, число сокетов игроков, переданных исполнителю, и число
+        # переданных сокетов, учтенных в последнем отчете.
+        self.workers_processes = {}
+        self.workers_conns = {}
+        self.workers_num_players = {}
+        self.num_handoffs_sent = {}
+        self.num_handoffs_reported = {}
+        # Ключи в словаре -- названия комнат, значения -- номера
+        # исполнителей, в которых находятся комнаты.
+        self.rooms_workers = {}
+        # Ключи в словарях -- адреса игроков, еще не переданных
+        # исполнителям, значения -- сокеты, принятые от игроков данные и
+        # экземпляры `StreamFramer`, с помощью которых в данных ищется
+        # сообщение 'join'.
+        self.pending_conns = {}
+        self.pending_data = {}
+        self.pending_framers = {}
+
+        # Исполнители создаются до сокета для подключения игроков, чтобы не
+        # получить его копию.
+        self.listener = None
+        for index in range(self.num_workers):
+            self.start_worker(index)
+        self.listener = create_listener(
+            get_server_address(config),
+            self.max_num_players * self.num_workers
+        )
+        self.selector.register(self.listener, selectors.EVENT_READ)
+
+    def start_worker(self, index):
+        conn, worker_conn = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        process = multiprocessing.get_context('fork').Process(
+            target=self.run_worker, args=(worker_conn, conn), daemon=True)
+        process.start()
+        worker_conn.close()
+        conn.settimeout(CONTROL_SEND_TIMEOUT)
+        self.workers_processes[index] = process
+        self.workers_conns[index] = conn
+        self.workers_num_players[index] = 0
+        self.num_handoffs_sent[index] = 0
+        self.num_handoffs_reported[index] = 0
+        self.selector.register(conn, selectors.EVENT_READ, ('worker', index))
+
+    # Выполняется в процессе исполнителя. Процесс получает копии всех
+    # сокетов супервизора. Они закрываются, чтобы исполнитель обнаружил
+    # завершение супервизора по закрытию `control_conn`.
+    def run_worker(self, control_conn, supervisor_conn):
+        supervisor_conn.close()
+        self.close_all_sockets(remove_socket_file=False)
+        app = WorkerCubeGameServer(self.config, control_conn)
+        try:
+            app.mainloop()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            app.close_all_sockets()
+
+    def mainloop(self):
+        while True:
+            for key, mask in self.selector.select():
+                if key.fileobj is self.listener:
+                    self.connect_to_clients()
+                elif key.data[0] == 'worker':
+                    self.receive_from_worker(key.data[1])
+                else:
+                    self.receive_from_client(key.data[1])
+
+    def connect_to_clients(self):
+        while True:
+            try:
+                conn, addr = accept(self.listener)
+            except BlockingIOError:
+                return
+            conn.settimeout(0)
+            self.pending_conns[addr] = conn
+            self.pending_data[addr] = bytearray()
+            self.pending_framers[addr] = StreamFramer(None, addr)
+            self.selector.register(
+                conn, selectors.EVENT_READ, ('client', addr))
+
+    def receive_from_client(self, addr):
+        try:
+            data = self.pending_conns[addr].recv(INITIAL_RECV_BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            warnings.warn(e)
+            self.drop_pending_client(addr)
+            return
+        if not data:
+            warnings.warn(CONNECTION_CLOSED_WARNING_TMPL.format(addr))
+            self.drop_pending_client(addr)
+            return
+        self.pending_data[addr] += data
+        # Данные, не соответствующие протоколу, не должны останавливать
+        # супервизор, поэтому соединение с их отправителем закрывается.
+        try:
+            msgs, e = self.pending_framers[addr].feed(data)
+            for msg in msgs:
+                if not has_known_type(msg, CLIENT_MSG_TYPES):
+                    warnings.warn(
+                        "Игрок {} прислал сообщение неизвестного типа. "
+                        "Сообщение должно быть словарем со значением 'type' "
+                        "из {}. Соединение будет закрыто.\nmsg = {}".format(
+                            addr, sorted(CLIENT_MSG_TYPES), repr(msg)))
+                    self.drop_pending_client(addr)
+                    return
+                if msg['type'] == 'join':
+                    self.hand_off(addr, msg.get('room'))
+                    return
+        except (TypeError, KeyError, ValueError, OSError) as e:
+            warnings.warn(e)
+            warnings.warn(
+                "Не удалось обработать данные игрока {}. Соединение будет "
+                "закрыто.".format(addr))
+            if addr in self.pending_conns:
+                self.drop_pending_client(addr)
+            return
+        if isinstance(e, CorruptedMessageError):
+            warnings.warn(e.message)
+        if e is not None \
+                or len(self.pending_data[addr]) > FRONT_DOOR_MAX_BUFFER_SIZE:
+            warnings.warn(
+                "Игрок {} не прислал сообщение 'join' в первых {} байтах. "
+                "Соединение будет закрыто.".format(
+                    addr, len(self.pending_data[addr])))
+            self.drop_pending_client(addr)
+
+    def drop_pending_client(self, addr):
+        conn = self.pending_conns.pop(addr)
+        self.selector.unregister(conn)
+        conn.close()
+        del self.pending_data[addr]
+        del self.pending_framers[addr]
+
+    # Оценка числа игроков в исполнителе: к числу из последнего отчета
+    # добавляются сокеты, переданные после отчета.
+    def get_worker_load(self, index):
+        return self.workers_num_players[index] \
+            + self.num_handoffs_sent[index] \
+            - self.num_handoffs_reported[index]
+
+    # Неверное название комнаты (например, не строку) исполнитель
+    # отвергнет, поэтому такие названия не запоминаются.
+    def choose_worker(self, room_name):
+        if not isinstance(room_name, str):
+            return min(self.workers_conns, key=self.get_worker_load)
+        index = self.rooms_workers.get(room_name)
+        if index is None:
+            index = min(self.workers_conns, key=self.get_worker_load)
+            self.rooms_workers[room_name] = index
+        return index
+
+    def hand_off(self, addr, room_name):
+        index = self.choose_worker(room_name)
+        conn = self.pending_conns[addr]
+        data = bytes(self.pending_data[addr])
+        if self.get_worker_load(index) >= self.max_num_players:
+            warnings.warn(
+                "Исполнитель {} обслуживает максимальное число игроков {}. "
+                "Игрок {} не будет подключен.".format(
+                    index, self.max_num_players, addr))
+        else:
+            msg = {'type': 'handoff', 'addr': addr, 'data': data}
+            try:
+                socket.send_fds(
+                    self.workers_conns[index],
+                    [pickle.dumps(msg)],
+                    [conn.fileno()]
+                )
+            except OSError as e:
+                warnings.warn(e)
+                warnings.warn(
+                    "Не удалось передать сокет игрока {} исполнителю "
+                    "{}.".format(addr, index))
+            else:
+                self.num_handoffs_sent[index] += 1
+        # У исполнителя своя копия сокета.
+        self.drop_pending_client(addr)
+
+    def receive_from_worker(self, index):
+        try:
+            data = self.workers_conns[index].recv(CONTROL_MSG_MAX_SIZE)
+        except OSError as e:
+            warnings.warn(e)
+            data = b''
+        if not data:
+            warnings.warn(
+                "Процесс исполнителя {} завершился. Исполнитель будет "
+                "перезапущен.".format(index))
+            self.restart_worker(index)
+            return
+        msg = pickle.loads(data)
+        if msg['type'] == 'health':
+            self.workers_num_players[index] = msg['num_players']
+            self.num_handoffs_reported[index] = msg['num_handoffs']
+            # Комнаты, удаленные исполнителем, забываются, только если
+            # исполнитель получил все переданные ему сокеты. Иначе комната
+            # могла быть назначена исполнителю и еще не создана.
+            if msg['num_handoffs'] == self.num_handoffs_sent[index]:
+                rooms = set(msg['rooms'])
+                for room_name, room_index in list(self.rooms_workers.items()):
+                    if room_index == index and room_name not in rooms:
+                        del self.rooms_workers[room_name]
+
+    def restart_worker(self, index):
+        conn = self.workers_conns.pop(index)
+        self.selector.unregister(conn)
+        conn.close()
+        self.workers_processes.pop(index).join()
+        for room_name, room_index in list(self.rooms_workers.items()):
+            if room_index == index:
+                del self.rooms_workers[room_name]
+        self.start_worker(index)
+
+    # Файл сокета Unix удаляет только процесс супервизора, а не копии
+    # супервизора в процессах исполнителей.
+    def close_all_sockets(self, remove_socket_file=True):
+        self.selector.close()
+        if self.listener is not None:
+            close_listener(self.listener, remove_socket_file)
+        for conn in self.workers_conns.values():
+            conn.close()
+        for conn in self.pending_conns.values():
+            conn.close()
 
 
 def main():
     try:
         args = get_app_args()
-        app = CubeGameServer(vars(args))
+        engines = {
+            'polling': CubeGameServer,
+            'selectors': SelectorCubeGameServer,
+            'asyncio': AsyncioCubeGameServer,
+        }
+        if args.num_workers > 0:
+            app = CubeGameSupervisor(vars(args))
+        else:
+            app = engines[args.engine](vars(args))
         app.mainloop()
     except KeyboardInterrupt as e:
         app.close_all_sockets()
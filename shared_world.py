@@ -0,0 +1,208 @@
+import argparse
+import hashlib
+import struct
+import time
+from array import array
+from multiprocessing import resource_tracker, shared_memory
+
+
+# Расположение данных в блоке разделяемой памяти. Заголовок: метка
+# `SHM_MAGIC`, версия расположения, число элементов в столбцах, затем
+# счетчик seqlock и версия мира. За заголовком следуют столбцы (structure
+# of arrays) с порядком байтов текущей машины. Кубику с id `id_`
+# соответствуют элементы с индексом `id_ - 1`. Порядок и типы столбцов
+# совпадают с `cube_store.CubeStore`.
+SHM_MAGIC = b'CUBE'
+SHM_LAYOUT_VERSION = 1
+HEADER = struct.Struct('=4sII')
+SEQ_OFFSET = 16
+VERSION_OFFSET = 24
+HEADER_SIZE = 32
+COLUMNS = [
+    ('x', 'i'), ('y', 'i'), ('size', 'i'), ('z', 'I'), ('color', 'H'),
+    ('alive', 'B')
+]
+# Интервал в секундах между попытками прочитать снимок, пока сервер
+# записывает данные.
+READ_RETRY_INTERVAL = 0.0001
+DEFAULT_POLL_INTERVAL = 1.0
+# Имя блока не длиннее NAME_MAX символов. Название комнаты заменяется в
+# имени блока хешем фиксированной длины.
+MAX_SHM_BLOCK_NAME_LENGTH = 255
+ROOM_NAME_DIGEST_SIZE = 16
+MAX_SHM_NAME_LENGTH = \
+    MAX_SHM_BLOCK_NAME_LENGTH - 1 - 2 * ROOM_NAME_DIGEST_SIZE
+
+
+# Имя блока разделяемой памяти комнаты `room_name` сервера, запущенного с
+# параметром `--shm_name shm_name`. Вместо названия комнаты в имя входит
+# его хеш в шестнадцатеричном виде: название может содержать символы,
+# недопустимые в именах блоков, а в кодировке UTF-8 -- превышать
+# допустимую длину имени.
+def get_shm_block_name(shm_name, room_name):
+    digest = hashlib.blake2b(
+        room_name.encode('utf-8'), digest_size=ROOM_NAME_DIGEST_SIZE)
+    return '{}-{}'.format(shm_name, digest.hexdigest())
+
+
+def get_block_size(capacity):
+    return HEADER_SIZE + sum(
+        array(typecode).itemsize * capacity for _, typecode in COLUMNS)
+
+
+def map_columns(buf, capacity):
+    columns = {}
+    offset = HEADER_SIZE
+    for name, typecode in COLUMNS:
+        size = array(typecode).itemsize * capacity
+        columns[name] = buf[offset:offset + size].cast(typecode)
+        offset += size
+    return columns
+
+
+# Публикует состояние кубиков `CubeStore` в блок разделяемой памяти.
+# Запись защищена seqlock: перед записью счетчик становится нечетным,
+# после записи -- четным. Читатели повторяют чтение, если счетчик был
+# нечетным или изменился за время чтения. Число кубиков в хранилище не
+# должно превышать `capacity`.
+class SharedWorldPublisher:
+    def __init__(self, name, capacity):
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(
+            name, create=True, size=get_block_size(capacity))
+        buf = self.shm.buf
+        HEADER.pack_into(buf, 0, SHM_MAGIC, SHM_LAYOUT_VERSION, capacity)
+        self.seq = buf[SEQ_OFFSET:SEQ_OFFSET + 8].cast('Q')
+        self.version = buf[VERSION_OFFSET:VERSION_OFFSET + 8].cast('Q')
+        self.columns = map_columns(buf, capacity)
+
+    def begin_write(self):
+        self.seq[0] += 1
+
+    def end_write(self, version):
+        self.version[0] = version
+        self.seq[0] += 1
+
+    def publish_all(self, store, version):
+        n = len(store.alive)
+        self.begin_write()
+        for name, _ in COLUMNS:
+            self.columns[name][:n] = memoryview(getattr(store, name))
+        self.end_write(version)
+
+    # Публикует координаты кубиков `ids`, сдвинутых в течение такта.
+    def publish_moved(self, store, version, ids):
+        x, y = self.columns['x'], self.columns['y']
+        self.begin_write()
+        for id_ in ids:
+            x[id_ - 1] = store.x[id_ - 1]
+            y[id_ - 1] = store.y[id_ - 1]
+        self.end_write(version)
+
+    def close(self):
+        self.seq.release()
+        self.version.release()
+        for column in self.columns.values():
+            column.release()
+        self.shm.close()
+        self.shm.unlink()
+
+
+# Читает снимки состояния кубиков из блока, созданного
+# `SharedWorldPublisher`. Столбцы `self.columns` отображены в разделяемую
+# память без копирования. Данные, прочитанные из них между вызовами
+# `self.begin_read()` и `self.is_consistent()`, согласованы, только если
+# последний вернул `True`.
+class SharedWorldReader:
+    def __init__(self, name):
+        self.shm = shared_memory.SharedMemory(name)
+        # В Python до 3.13 подключение к блоку регистрирует его в
+        # `resource_tracker`, который удаляет блок при завершении читателя.
+        # Блоком владеет сервер.
+        resource_tracker.unregister(self.shm._name, 'shared_memory')
+        buf = self.shm.buf
+        magic, layout_version, self.capacity = HEADER.unpack_from(buf, 0)
+        if magic != SHM_MAGIC or layout_version != SHM_LAYOUT_VERSION:
+            self.shm.close()
+            raise ValueError(
+                "Блок разделяемой памяти {} не содержит состояния кубиков "
+                "или записан другой версией сервера.".format(repr(name)))
+        self.seq = buf[SEQ_OFFSET:SEQ_OFFSET + 8].cast('Q')
+        self.version = buf[VERSION_OFFSET:VERSION_OFFSET + 8].cast('Q')
+        self.columns = map_columns(buf, self.capacity)
+
+    def begin_read(self):
+        while True:
+            seq = self.seq[0]
+            if seq % 2 == 0:
+                return seq
+            time.sleep(READ_RETRY_INTERVAL)
+
+    def is_consistent(self, seq):
+        return self.seq[0] == seq
+
+    # Возвращает версию мира и копии столбцов в виде словаря экземпляров
+    # `array.array`.
+    def read_snapshot(self):
+        while True:
+            seq = self.begin_read()
+            version = self.version[0]
+            snapshot = {}
+            for name, typecode in COLUMNS:
+                column = array(typecode)
+                column.frombytes(self.columns[name].cast('B'))
+                snapshot[name] = column
+            if self.is_consistent(seq):
+                return version, snapshot
+
+    def close(self):
+        self.seq.release()
+        self.version.release()
+        for column in self.columns.values():
+            column.release()
+        self.shm.close()
+
+
+def get_app_args():
+    parser = argparse.ArgumentParser(
+        "Печатает версию мира и число кубиков комнаты сервера 'Cube Game', "
+        "запущенного с параметром `--shm_name`. Состояние кубиков читается "
+        "из разделяемой памяти без подключения к серверу."
+    )
+    parser.add_argument(
+        "--shm_name",
+        help="Значение параметра `--shm_name` сервера.",
+        required=True
+    )
+    parser.add_argument(
+        "--room",
+        "-r",
+        help="Название комнаты. Значение по умолчанию 'default'.",
+        default='default'
+    )
+    parser.add_argument(
+        "--interval",
+        help="Интервал в секундах между снимками. Значение по умолчанию "
+             "{}.".format(DEFAULT_POLL_INTERVAL),
+        type=float,
+        default=DEFAULT_POLL_INTERVAL
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_app_args()
+    reader = SharedWorldReader(get_shm_block_name(args.shm_name, args.room))
+    try:
+        while True:
+            version, snapshot = reader.read_snapshot()
+            print(version, sum(snapshot['alive']))
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    main()
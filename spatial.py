@@ -0,0 +1,166 @@
+import math
+
+
+# Пространственный индекс прямоугольников на основе равномерной сетки.
+# Плоскость разбита на квадратные ячейки со стороной `cell_size`. Для
+# каждой ячейки хранится множество id прямоугольников, пересекающих ее.
+# Сами координаты прямоугольников индекс не хранит: они запрашиваются
+# функцией `get_rect(id_)`, возвращающей кортеж (x1, y1, x2, y2).
+# Прямоугольники считаются замкнутыми, т.е. точки на границе принадлежат
+# прямоугольнику.
+class UniformGrid:
+    def __init__(self, cell_size, get_rect):
+        self.cell_size = cell_size
+        self.get_rect = get_rect
+        # Ключи -- номера ячеек (i, j), значения -- множества id.
+        self.cells = {}
+        # Номера крайних ячеек, в которые когда-либо добавлялись
+        # прямоугольники: [min_i, min_j, max_i, max_j]. При удалении
+        # прямоугольников границы не сужаются.
+        self.bounds = None
+
+    def get_cells(self, x1, y1, x2, y2):
+        c = self.cell_size
+        return [
+            (i, j)
+            for i in range(int(x1 // c), int(x2 // c) + 1)
+            for j in range(int(y1 // c), int(y2 // c) + 1)
+        ]
+
+    def insert(self, id_, x1, y1, x2, y2):
+        c = self.cell_size
+        i1, j1 = int(x1 // c), int(y1 // c)
+        i2, j2 = int(x2 // c), int(y2 // c)
+        cells = self.cells
+        for i in range(i1, i2 + 1):
+            for j in range(j1, j2 + 1):
+                ids = cells.get((i, j))
+                if ids is None:
+                    cells[i, j] = {id_}
+                else:
+                    ids.add(id_)
+        bounds = self.bounds
+        if bounds is None:
+            self.bounds = [i1, j1, i2, j2]
+        else:
+            if i1 < bounds[0]:
+                bounds[0] = i1
+            if j1 < bounds[1]:
+                bounds[1] = j1
+            if i2 > bounds[2]:
+                bounds[2] = i2
+            if j2 > bounds[3]:
+                bounds[3] = j2
+
+    def remove(self, id_, x1, y1, x2, y2):
+        for cell in self.get_cells(x1, y1, x2, y2):
+            ids = self.cells[cell]
+            ids.discard(id_)
+            if not ids:
+                del self.cells[cell]
+
+    # `old_rect` -- координаты прямоугольника, переданные в `self.insert()`
+    # или в предыдущий вызов `self.move()`.
+    def move(self, id_, old_rect, new_rect):
+        c = self.cell_size
+        if all(
+                old // c == new // c
+                for old, new in zip(old_rect, new_rect)
+        ):
+            return
+        self.remove(id_, *old_rect)
+        self.insert(id_, *new_rect)
+
+    # Возвращает `True`, если прямоугольник (x1, y1, x2, y2) содержит все
+    # ячейки в границах `self.bounds`, а значит, и все прямоугольники.
+    def is_covered_by(self, x1, y1, x2, y2):
+        if self.bounds is None:
+            return True
+        c = self.cell_size
+        min_i, min_j, max_i, max_j = self.bounds
+        return x1 <= min_i * c and y1 <= min_j * c \
+            and (max_i + 1) * c <= x2 and (max_j + 1) * c <= y2
+
+    def query_point(self, x, y):
+        c = self.cell_size
+        result = []
+        for id_ in self.cells.get((int(x // c), int(y // c)), ()):
+            x1, y1, x2, y2 = self.get_rect(id_)
+            if x1 <= x <= x2 and y1 <= y <= y2:
+                result.append(id_)
+        return result
+
+    def query_rect(self, x1, y1, x2, y2):
+        candidates = set()
+        for cell in self.get_cells(x1, y1, x2, y2):
+            candidates.update(self.cells.get(cell, ()))
+        result = []
+        for id_ in candidates:
+            rx1, ry1, rx2, ry2 = self.get_rect(id_)
+            if rx1 <= x2 and x1 <= rx2 and ry1 <= y2 and y1 <= ry2:
+                result.append(id_)
+        return result
+
+    # Возвращает id прямоугольника, ближайшего к точке (x, y), или `None`,
+    # если на расстоянии не больше `max_distance` прямоугольников нет.
+    # Ячейки просматриваются кольцами вокруг ячейки, содержащей точку, пока
+    # кольца могут содержать прямоугольники ближе уже найденного.
+    def nearest(self, x, y, max_distance=math.inf):
+        c = self.cell_size
+        ci, cj = int(x // c), int(y // c)
+        if not self.cells:
+            return None
+        min_i, min_j, max_i, max_j = self.bounds
+        # Кольца с номерами меньше `radius` и больше `max_radius` лежат
+        # вне границ `self.bounds`.
+        radius = max(min_i - ci, ci - max_i, min_j - cj, cj - max_j, 0)
+        max_radius = max(ci - min_i, max_i - ci, cj - min_j, max_j - cj)
+        best_id = None
+        best_distance = max_distance
+        while radius <= max_radius:
+            ring_distance = self.get_ring_distance(x, y, radius)
+            if ring_distance > best_distance \
+                    or ring_distance == best_distance and best_id is not None:
+                break
+            for cell in self.get_ring(ci, cj, radius):
+                for id_ in self.cells.get(cell, ()):
+                    distance = self.get_distance(id_, x, y)
+                    if distance < best_distance \
+                            or distance == best_distance and best_id is None:
+                        best_id = id_
+                        best_distance = distance
+            radius += 1
+        return best_id
+
+    def get_distance(self, id_, x, y):
+        x1, y1, x2, y2 = self.get_rect(id_)
+        dx = max(x1 - x, 0, x - x2)
+        dy = max(y1 - y, 0, y - y2)
+        return math.hypot(dx, dy)
+
+    # Расстояние от точки (x, y) до ближайшей к ней ячейки кольца с номером
+    # `radius` вокруг ячейки, содержащей точку.
+    def get_ring_distance(self, x, y, radius):
+        if radius == 0:
+            return 0
+        c = self.cell_size
+        ci, cj = x // c, y // c
+        return min(
+            x - (ci - radius + 1) * c,
+            (ci + radius) * c - x,
+            y - (cj - radius + 1) * c,
+            (cj + radius) * c - y
+        )
+
+    @staticmethod
+    def get_ring(ci, cj, radius):
+        if radius == 0:
+            return [(ci, cj)]
+        ring = []
+        for i in range(ci - radius, ci + radius + 1):
+            ring.append((i, cj - radius))
+            ring.append((i, cj + radius))
+        for j in range(cj - radius + 1, cj + radius):
+            ring.append((ci - radius, j))
+            ring.append((ci + radius, j))
+        return ring
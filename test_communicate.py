@@ -0,0 +1,549 @@
+import os
+import pickle
+import socket
+
+import pytest
+
+from communicate import StreamFramer, CorruptedMessageError, encode_frame, \
+    NUM_BYTES_FOR_MSG_LENGTH, MSG_BYTEORDER, MAX_MSG_SIZE, CODECS, \
+    BINARY_FORMATS, PICKLE_TAG, SequencedFormat, RecordListFormat, \
+    decode_payload, COMPRESSIONS, COMPRESSION_SHIFT, COMPRESSION_IDS, \
+    COMPRESSION_THRESHOLD, compress_payload, OutboundQueue, \
+    make_hello_msg, make_hello_ack_msg, get_hello_ack_encoding, \
+    FrameEncoding, PROTOCOL_VERSIONS, MIN_NEGOTIATED_MSG_SIZE, \
+    decode_datagram, DECODING_ERRORS, CLIENT_DATAGRAM_TAGS, \
+    SERVER_DATAGRAM_TAGS, UDP_HELLO_TAGS
+
+
+MSGS = [
+    {'type': 'event', 'event': {'type': '<Button-1>', 'x': 1, 'y': 2}},
+    {'type': 'ack', 'version': 7},
+    {'type': 'error_msg', 'error_class': 'ValueError', 'msg': 'текст'},
+]
+
+
+# Поврежденные сообщения `StreamFramer` сохраняет в каталог logs, поэтому
+# тесты выполняются во временном каталоге.
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture
+def socket_pair():
+    left, right = socket.socketpair()
+    right.settimeout(0)
+    yield left, right
+    left.close()
+    right.close()
+
+
+def make_stream(msgs, **kwargs):
+    return b''.join(encode_frame(msg, **kwargs) for msg in msgs)
+
+
+def make_header(length):
+    return length.to_bytes(NUM_BYTES_FOR_MSG_LENGTH, MSG_BYTEORDER)
+
+
+def get_compression_id(frame):
+    header = int.from_bytes(frame[:NUM_BYTES_FOR_MSG_LENGTH], MSG_BYTEORDER)
+    return header >> COMPRESSION_SHIFT
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 64])
+def test_feed_frames_split_across_reads(chunk_size):
+    stream = make_stream(MSGS)
+    framer = StreamFramer(None, 'test')
+    received = []
+    for start in range(0, len(stream), chunk_size):
+        msgs, error = framer.feed(stream[start:start + chunk_size])
+        assert error is None
+        received += msgs
+    assert received == MSGS
+    assert framer.start == framer.end == 0
+
+
+def test_feed_message_larger_than_initial_buffer():
+    msg = {'type': 'error_msg', 'msg': 'x' * (MAX_MSG_SIZE // 2)}
+    stream = make_stream([msg, MSGS[1]])
+    framer = StreamFramer(None, 'test')
+    msgs, error = framer.feed(stream[:1000])
+    assert msgs == [] and error is None
+    msgs, error = framer.feed(stream[1000:])
+    assert msgs == [msg, MSGS[1]] and error is None
+
+
+def test_keep_frames():
+    stream = make_stream(MSGS)
+    framer = StreamFramer(None, 'test', keep_frames=True)
+    msgs, error = framer.feed(stream)
+    assert msgs == MSGS
+    assert b''.join(framer.frames) == stream
+
+
+def test_receive_from_socket(socket_pair):
+    left, right = socket_pair
+    stream = make_stream(MSGS)
+    framer = StreamFramer(right, 'test')
+    left.sendall(stream[:5])
+    msgs, error = framer.receive()
+    assert msgs == [] and isinstance(error, BlockingIOError)
+    left.sendall(stream[5:])
+    msgs, error = framer.receive()
+    assert msgs == MSGS and isinstance(error, BlockingIOError)
+
+
+def test_receive_reports_closed_connection(socket_pair):
+    left, right = socket_pair
+    framer = StreamFramer(right, 'test')
+    left.sendall(make_stream(MSGS[:1]))
+    left.close()
+    msgs, error = framer.receive()
+    assert msgs == MSGS[:1]
+    assert isinstance(error, ConnectionResetError)
+
+
+# Поврежденное сообщение пропускается, а следующие за ним разбираются.
+def test_corrupted_message_is_skipped():
+    bad = make_header(3) + b'\x00\x01\x02'
+    framer = StreamFramer(None, 'test')
+    msgs, error = framer.feed(make_stream(MSGS[:1]) + bad)
+    assert msgs == MSGS[:1]
+    assert isinstance(error, CorruptedMessageError)
+    msgs, error = framer.feed(make_stream(MSGS[1:]))
+    assert msgs == MSGS[1:] and error is None
+
+
+def test_too_long_message():
+    framer = StreamFramer(None, 'test')
+    msgs, error = framer.feed(make_header(MAX_MSG_SIZE + 1) + b'\x00' * 10)
+    assert msgs == []
+    assert isinstance(error, CorruptedMessageError)
+
+
+# Значения полей тестовых сообщений для кодов формата `struct`.
+SAMPLE_VALUES = {'I': 7, 'i': -5, 'H': 3, 'Q': 2 ** 40}
+
+
+# Строит сообщение, которое кодируется форматом `format_`.
+def make_sample_msg(format_):
+    fmt = format_.struct.format[2:]
+    inner = dict(zip(format_.keys[1:], [SAMPLE_VALUES[c] for c in fmt]))
+    if isinstance(format_, RecordListFormat):
+        inner[format_.list_field] = [
+            tuple(SAMPLE_VALUES[c] + i for c in format_.record_fmt)
+            for i in range(3)
+        ]
+    if isinstance(format_, SequencedFormat):
+        seq = inner.pop('seq')
+    if format_.inner_type is None:
+        msg = dict(inner, type=format_.msg_type)
+    else:
+        msg = {
+            'type': format_.msg_type,
+            format_.msg_type: dict(inner, type=format_.inner_type)
+        }
+    if isinstance(format_, SequencedFormat):
+        msg['seq'] = seq
+    return msg
+
+
+@pytest.mark.parametrize(
+    'format_', BINARY_FORMATS, ids=lambda format_: str(format_.tag))
+def test_binary_round_trip(format_):
+    msg = make_sample_msg(format_)
+    payload = CODECS['binary'].encode(msg)
+    assert payload[0] == format_.tag
+    assert decode_payload(payload) == msg
+    msgs, error = StreamFramer(None, 'test').feed(encode_frame(msg))
+    assert msgs == [msg] and error is None
+
+
+def test_binary_tags_are_unique():
+    tags = [format_.tag for format_ in BINARY_FORMATS]
+    assert len(set(tags)) == len(tags)
+    assert PICKLE_TAG not in tags
+
+
+# Сообщения, которые не помещаются в форматы `struct`, кодируются
+# `pickle` без потерь.
+@pytest.mark.parametrize('msg', [
+    {'type': 'ack', 'version': 7, 'extra': 1},
+    {'type': 'ack', 'version': -1},
+    {'type': 'ack', 'version': 2 ** 40},
+    {'type': 'ack', 'version': 1.5},
+    {'type': 'ack', 'version': '7'},
+    {'type': 'ack'},
+    {'type': 'event', 'event': {'type': '<Button-1>', 'x': 2 ** 40, 'y': 0}},
+    {'type': 'event', 'event': {'type': '<Button-1>', 'x': 1}},
+    {'type': 'event', 'event': {'type': '<Unknown>', 'x': 1, 'y': 2}},
+    {'type': 'event', 'event': 'text'},
+    {'type': 'event', 'seq': -1,
+     'event': {'type': '<B1-Motion>', 'x': 1, 'y': 2}},
+    {'type': 'event', 'seq': 1, 'extra': 1,
+     'event': {'type': '<B1-Motion>', 'x': 1, 'y': 2}},
+    {'type': 'command', 'command': {
+        'type': 'delta', 'version': 1, 'base': 0, 'cubes': [(1, 2)]}},
+    {'type': 'command', 'command': {
+        'type': 'delta', 'version': 1, 'base': 0, 'cubes': None}},
+    {'type': 'command', 'command': {
+        'type': 'add_cubes', 'version': 1, 'cubes': [(1, 2, 3, 4, 5, 6)]}},
+    {'type': 'unknown'},
+    {'type': ['unhashable']},
+    {'no_type': 1},
+    ['not', 'a', 'dict'],
+    None,
+])
+def test_pickle_fallback(msg):
+    payload = CODECS['binary'].encode(msg)
+    assert payload[0] == PICKLE_TAG
+    assert decode_payload(payload) == msg
+
+
+@pytest.mark.parametrize(
+    'format_', BINARY_FORMATS, ids=lambda format_: str(format_.tag))
+def test_pickle_codec(format_):
+    msg = make_sample_msg(format_)
+    payload = CODECS['pickle'].encode(msg)
+    assert payload[0] == PICKLE_TAG
+    assert decode_payload(payload) == msg
+
+
+def test_unknown_tag():
+    with pytest.raises(ValueError):
+        decode_payload(bytes([255, 0, 0]))
+
+
+# Снимок мира хорошо сжимается.
+BIG_MSG = {
+    'type': 'command',
+    'command': {
+        'type': 'add_cubes',
+        'version': 1,
+        'cubes': [(id_, id_, id_, 45, 0, id_) for id_ in range(1, 2001)]
+    }
+}
+
+
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+@pytest.mark.parametrize('chunk_size', [1000, 10 ** 6])
+def test_compressed_frames(compression, chunk_size):
+    frame = encode_frame(BIG_MSG, compression=compression)
+    assert get_compression_id(frame) == COMPRESSION_IDS[compression]
+    assert len(frame) < len(encode_frame(BIG_MSG))
+    stream = frame + encode_frame(MSGS[1], compression=compression) + frame
+    framer = StreamFramer(None, 'test')
+    received = []
+    for start in range(0, len(stream), chunk_size):
+        msgs, error = framer.feed(stream[start:start + chunk_size])
+        assert error is None
+        received += msgs
+    assert received == [BIG_MSG, MSGS[1], BIG_MSG]
+
+
+# Небольшие сообщения и сообщения, которые не удалось уменьшить, не
+# сжимаются.
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+def test_small_and_incompressible_frames_are_not_compressed(compression):
+    assert get_compression_id(
+        encode_frame(MSGS[0], compression=compression)) == 0
+    noise = {'type': 'error_msg', 'msg': os.urandom(COMPRESSION_THRESHOLD)}
+    frame = encode_frame(noise, compression=compression)
+    assert get_compression_id(frame) == 0
+    assert StreamFramer(None, 'test').feed(frame) == ([noise], None)
+
+
+# Сообщение, которое после распаковки больше `MAX_MSG_SIZE`, считается
+# поврежденным.
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+def test_decompressed_size_is_limited(compression):
+    payload = bytes([PICKLE_TAG]) + bytes(MAX_MSG_SIZE + 1)
+    compressed = compress_payload(payload, compression)
+    header = make_header(
+        len(compressed)
+        | COMPRESSION_IDS[compression] << COMPRESSION_SHIFT)
+    framer = StreamFramer(None, 'test')
+    msgs, error = framer.feed(header + compressed + encode_frame(MSGS[1]))
+    assert msgs == []
+    assert isinstance(error, CorruptedMessageError)
+    assert framer.feed(encode_frame(MSGS[0])) == ([MSGS[1], MSGS[0]], None)
+
+
+# Сокет, который за каждый вызов `sendmsg()` принимает не больше байтов,
+# чем очередное значение из `limits`. Когда значения заканчиваются, сокет
+# не принимает данные.
+class FakeConn:
+    def __init__(self, limits):
+        self.limits = list(limits)
+        self.sent = bytearray()
+
+    def sendmsg(self, buffers):
+        if not self.limits:
+            raise BlockingIOError
+        data = b''.join(bytes(buffer) for buffer in buffers)
+        num_bytes = min(self.limits.pop(0), len(data))
+        self.sent += data[:num_bytes]
+        return num_bytes
+
+
+# В Windows у сокетов нет метода `sendmsg()`.
+class FakeConnWithoutSendmsg:
+    def __init__(self, limits):
+        self.conn = FakeConn(limits)
+
+    @property
+    def sent(self):
+        return self.conn.sent
+
+    def send(self, data):
+        return self.conn.sendmsg([data])
+
+
+FRAMES = [b'a' * 10, b'b' * 7, b'c' * 3, b'd' * 12]
+
+
+@pytest.mark.parametrize('conn_class', [FakeConn, FakeConnWithoutSendmsg])
+def test_flush_partial_writes(conn_class):
+    conn = conn_class([3, 9, 1, 0, 6, 100])
+    queue = OutboundQueue(conn, 'test')
+    for frame in FRAMES:
+        queue.put(frame)
+    results = [queue.flush() for _ in range(6)]
+    assert results == [False] * 5 + [True]
+    assert conn.sent == b''.join(FRAMES)
+    assert not queue and queue.num_buffered_bytes == 0
+    assert queue.offset == 0
+
+
+def test_flush_would_block():
+    conn = FakeConn([4])
+    queue = OutboundQueue(conn, 'test')
+    queue.put(FRAMES[0])
+    assert queue.flush() is False
+    assert queue.flush() is False
+    assert queue.num_buffered_bytes == len(FRAMES[0]) - 4
+    conn.limits.append(100)
+    queue.put(FRAMES[1])
+    assert queue.flush() is True
+    assert conn.sent == FRAMES[0] + FRAMES[1]
+
+
+# При политике 'drop' из сообщений с одинаковым ключом остается последнее.
+# Первое сообщение могло быть отправлено частично, поэтому оно остается в
+# очереди.
+def test_drop_policy_keeps_latest_frames():
+    conn = FakeConn([5])
+    queue = OutboundQueue(conn, 'test', 35, 'drop')
+    queue.put(b'1' * 10, 'delta')
+    queue.flush()
+    queue.put(b'2' * 10, 'delta')
+    queue.put(b'e' * 5)
+    queue.put(b'3' * 10, 'delta')
+    queue.put(b'4' * 10, 'delta')
+    assert not queue.overflowed
+    assert [frame for frame, _ in queue.frames] == \
+        [b'1' * 10, b'e' * 5, b'4' * 10]
+    assert queue.num_buffered_bytes == 5 + 5 + 10
+    conn.limits.append(100)
+    assert queue.flush() is True
+    assert conn.sent == b'1' * 10 + b'e' * 5 + b'4' * 10
+
+
+def test_drop_policy_overflows_without_stale_frames():
+    queue = OutboundQueue(FakeConn([]), 'test', 20, 'drop')
+    queue.put(b'a' * 10, 'a')
+    queue.put(b'b' * 10)
+    queue.put(b'c' * 10, 'c')
+    assert queue.overflowed
+    assert not queue.wants_write()
+    queue.put(b'd' * 10)
+    assert len(queue.frames) == 3
+
+
+def test_disconnect_policy():
+    queue = OutboundQueue(FakeConn([]), 'test', 20, 'disconnect')
+    queue.put(b'a' * 10, 'delta')
+    queue.put(b'b' * 10, 'delta')
+    assert not queue.overflowed
+    queue.put(b'c' * 10, 'delta')
+    assert queue.overflowed
+    assert len(queue.frames) == 3
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        OutboundQueue(FakeConn([]), 'test', 20, 'ignore')
+
+
+def test_hello_defaults():
+    ack = make_hello_ack_msg(make_hello_msg(), 60)
+    assert ack == {
+        'type': 'hello_ack',
+        'protocol_version': max(PROTOCOL_VERSIONS),
+        'codec': 'binary',
+        'compression': COMPRESSIONS[0],
+        'max_msg_size': MAX_MSG_SIZE,
+        'tick_rate': 60
+    }
+    assert get_hello_ack_encoding(ack) == \
+        FrameEncoding('binary', COMPRESSIONS[0], MAX_MSG_SIZE)
+
+
+@pytest.mark.parametrize('changes, expected', [
+    ({'codecs': ['pickle']}, FrameEncoding('pickle', 'zlib', MAX_MSG_SIZE)),
+    (
+        {'codecs': ['json', 'pickle', 'binary']},
+        FrameEncoding('binary', 'zlib', MAX_MSG_SIZE)
+    ),
+    ({'compression': []}, FrameEncoding('binary', None, MAX_MSG_SIZE)),
+    (
+        {'compression': ['brotli', 'zlib']},
+        FrameEncoding('binary', 'zlib', MAX_MSG_SIZE)
+    ),
+    (
+        {'max_msg_size': MIN_NEGOTIATED_MSG_SIZE},
+        FrameEncoding('binary', 'zlib', MIN_NEGOTIATED_MSG_SIZE)
+    ),
+    (
+        {'max_msg_size': 2 * MAX_MSG_SIZE},
+        FrameEncoding('binary', 'zlib', MAX_MSG_SIZE)
+    ),
+    (
+        {'protocol_versions': PROTOCOL_VERSIONS + [1000]},
+        FrameEncoding('binary', 'zlib', MAX_MSG_SIZE)
+    ),
+])
+def test_hello_negotiation(changes, expected):
+    # Способ сжатия 'lz4' доступен, только если установлен модуль `lz4`.
+    hello = dict(make_hello_msg(), compression=['zlib'])
+    hello.update(changes)
+    ack = make_hello_ack_msg(hello, 60)
+    assert ack['type'] == 'hello_ack'
+    assert ack['protocol_version'] in PROTOCOL_VERSIONS
+    assert get_hello_ack_encoding(ack) == expected
+
+
+@pytest.mark.parametrize('changes', [
+    {'protocol_versions': [1000]},
+    {'codecs': ['json']},
+    {'max_msg_size': MIN_NEGOTIATED_MSG_SIZE - 1},
+    {'max_msg_size': '1024'},
+    {'codecs': 'binary'},
+    {'compression': None},
+    {'protocol_versions': None},
+])
+def test_hello_errors(changes):
+    ack = make_hello_ack_msg(dict(make_hello_msg(), **changes), 60)
+    assert ack['type'] == 'error_msg'
+    assert ack['error_class'] == 'ValueError'
+
+
+@pytest.mark.parametrize('changes', [
+    {'protocol_version': 1000},
+    {'codec': 'json'},
+    {'compression': 'brotli'},
+    {'max_msg_size': MIN_NEGOTIATED_MSG_SIZE - 1},
+    {'max_msg_size': MAX_MSG_SIZE + 1},
+    {'max_msg_size': None},
+])
+def test_hello_ack_with_unsupported_choice(changes):
+    ack = dict(make_hello_ack_msg(make_hello_msg(), 60), **changes)
+    assert get_hello_ack_encoding(ack) is None
+
+
+# Сообщения, закодированные согласованным способом, декодируются
+# получателем.
+@pytest.mark.parametrize('codec', ['binary', 'pickle'])
+@pytest.mark.parametrize('compression', COMPRESSIONS + [None])
+def test_negotiated_encoding_round_trip(codec, compression):
+    hello = dict(
+        make_hello_msg(), codecs=[codec],
+        compression=[] if compression is None else [compression])
+    encoding = get_hello_ack_encoding(make_hello_ack_msg(hello, 60))
+    assert encoding == FrameEncoding(codec, compression, MAX_MSG_SIZE)
+    stream = encode_frame(BIG_MSG, *encoding) \
+        + encode_frame(MSGS[0], *encoding)
+    assert StreamFramer(None, 'test').feed(stream) == \
+        ([BIG_MSG, MSGS[0]], None)
+
+
+CLIENT_DATAGRAMS = [
+    {'type': 'motion', 'seq': 5, 'x': 10, 'y': -20},
+    {'type': 'ack', 'version': 7},
+    {'type': 'udp_hello', 'token': 2 ** 63},
+]
+SERVER_DATAGRAMS = [
+    {'type': 'udp_ready'},
+    {'type': 'command', 'command': {
+        'type': 'delta', 'version': 2, 'base': 1, 'cubes': [(1, 2, 3)]}},
+]
+
+
+@pytest.mark.parametrize('msg', CLIENT_DATAGRAMS)
+def test_client_datagrams(msg):
+    data = encode_frame(msg)
+    assert decode_datagram(data, CLIENT_DATAGRAM_TAGS, False) == msg
+    with pytest.raises(DECODING_ERRORS):
+        decode_datagram(data, SERVER_DATAGRAM_TAGS)
+
+
+@pytest.mark.parametrize('msg', SERVER_DATAGRAMS)
+def test_server_datagrams(msg):
+    data = encode_frame(msg)
+    assert decode_datagram(data, SERVER_DATAGRAM_TAGS) == msg
+    with pytest.raises(DECODING_ERRORS):
+        decode_datagram(data, CLIENT_DATAGRAM_TAGS)
+
+
+# С адреса, не привязанного к игроку, принимается только 'udp_hello'.
+def test_unbound_address_datagrams():
+    hello = CLIENT_DATAGRAMS[2]
+    assert decode_datagram(encode_frame(hello), UDP_HELLO_TAGS, False) == hello
+    for msg in CLIENT_DATAGRAMS[:2]:
+        with pytest.raises(DECODING_ERRORS):
+            decode_datagram(encode_frame(msg), UDP_HELLO_TAGS, False)
+
+
+# Датаграммы, закодированные `pickle`, не декодируются: сообщение,
+# которое не помещается в формат `struct`, и сообщение, которое кодек
+# 'pickle' закодировал бы и без этого, отбрасываются одинаково.
+@pytest.mark.parametrize('msg, codec', [
+    ({'type': 'motion', 'seq': 5, 'x': 2 ** 40, 'y': 0}, 'binary'),
+    ({'type': 'motion', 'seq': 5, 'x': 1, 'y': 0}, 'pickle'),
+    ({'type': 'ack', 'version': 7}, 'pickle'),
+])
+def test_pickled_datagrams_are_rejected(msg, codec, monkeypatch):
+    def fail(*args):
+        raise AssertionError("pickle.loads() вызван для датаграммы")
+
+    monkeypatch.setattr(pickle, 'loads', fail)
+    data = encode_frame(msg, codec)
+    assert data[NUM_BYTES_FOR_MSG_LENGTH] == PICKLE_TAG
+    with pytest.raises(DECODING_ERRORS):
+        decode_datagram(data, CLIENT_DATAGRAM_TAGS, False)
+
+
+def test_compressed_datagrams():
+    msg = {'type': 'command', 'command': {
+        'type': 'delta', 'version': 2, 'base': 1,
+        'cubes': [(1, 2, 3)] * COMPRESSION_THRESHOLD
+    }}
+    data = encode_frame(msg, compression='zlib')
+    assert get_compression_id(data) != 0
+    assert decode_datagram(data, SERVER_DATAGRAM_TAGS) == msg
+    with pytest.raises(DECODING_ERRORS):
+        decode_datagram(data, SERVER_DATAGRAM_TAGS, False)
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'\x00\x00\x00',
+    make_header(0),
+    make_header(5) + b'\x07',
+    make_header(1) + b'\x07',
+    b'garbage',
+])
+def test_malformed_datagrams(data):
+    with pytest.raises(DECODING_ERRORS):
+        decode_datagram(data, CLIENT_DATAGRAM_TAGS, False)
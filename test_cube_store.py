@@ -0,0 +1,118 @@
+import random
+from array import array
+
+import pytest
+
+import colors
+from cube_store import COLOR_INDICES, CubeStore
+
+
+def make_store(num_cubes=5):
+    store = CubeStore()
+    for i in range(num_cubes):
+        store.add(10 * i, 20 * i, 30 + i, colors.ALL_COLORS[i])
+    return store
+
+
+def get_cube(store, id_):
+    return (
+        store.get_rect(id_), store.get_color(id_), store.z[id_ - 1],
+        store.grabbed[id_ - 1]
+    )
+
+
+def test_add():
+    store = make_store()
+    assert len(store) == 5
+    assert list(store.ids()) == [1, 2, 3, 4, 5]
+    assert store.get_rect(3) == (20, 40, 52, 72)
+    assert store.get_color(3) == colors.ALL_COLORS[2]
+    assert list(store.z) == [0, 1, 2, 3, 4]
+    assert list(store.grabbed) == [0] * 5
+
+
+def test_remove_and_reuse_id():
+    store = make_store()
+    store.remove(2)
+    store.remove(4)
+    assert len(store) == 3
+    assert list(store.ids()) == [1, 3, 5]
+    assert 2 not in store and 4 not in store
+    # Последний освобожденный id выдается первым, столбцы не растут.
+    assert store.add(0, 0, 10, 'red') == 4
+    assert store.add(0, 0, 10, 'blue') == 2
+    assert store.add(0, 0, 10, 'green') == 6
+    assert len(store.alive) == 6
+    assert len(store) == 6
+    # Кубик с переиспользованным id рисуется поверх остальных.
+    assert store.z[4 - 1] == 5
+    assert store.z[2 - 1] == 6
+    assert store.get_color(2) == 'blue'
+
+
+@pytest.mark.parametrize('id_', [0, -1, 6, 100, 1.0, '1', None, (1,)])
+def test_contains_invalid_ids(id_):
+    store = make_store()
+    assert id_ not in store
+
+
+def test_add_many():
+    store = make_store(2)
+    ids = store.add_many(
+        array('i', [1, 2, 3]), array('i', [4, 5, 6]), array('i', [7, 8, 9]),
+        array('H', [0, 1, 2])
+    )
+    assert list(ids) == [3, 4, 5]
+    assert len(store) == 5
+    assert get_cube(store, 4) == ((2, 5, 10, 13), colors.ALL_COLORS[1], 3, 0)
+    assert all(len(column) == 5 for column in store.columns)
+
+
+# Если есть свободные id, `add_many()` выдает их так же, как `add()`.
+def test_add_many_with_free_ids():
+    store = make_store(3)
+    store.remove(2)
+    ids = store.add_many(
+        array('i', [1, 2]), array('i', [3, 4]), array('i', [5, 6]),
+        array('H', [7, 8])
+    )
+    assert list(ids) == [2, 4]
+    assert list(store.ids()) == [1, 2, 3, 4]
+    assert get_cube(store, 2) == ((1, 3, 6, 8), colors.ALL_COLORS[7], 3, 0)
+    assert get_cube(store, 4) == ((2, 4, 8, 10), colors.ALL_COLORS[8], 4, 0)
+
+
+def test_grabbing_point():
+    store = make_store()
+    assert store.get_grabbing_point(1) is None
+    store.set_grabbing_point(1, (5, 6))
+    assert store.get_grabbing_point(1) == (5, 6)
+    assert store.grabbed[0] == 1
+    store.set_grabbing_point(1, None)
+    assert store.get_grabbing_point(1) is None
+    assert store.grabbed[0] == 0
+    # Удаленный кубик отпускается.
+    store.set_grabbing_point(2, (1, 1))
+    store.remove(2)
+    assert store.get_grabbing_point(2) is None
+    assert store.add(0, 0, 10, 'red') == 2
+    assert store.grabbed[1] == 0
+
+
+def test_create_random_cubes():
+    random.seed(0)
+    store = make_store(1)
+    color_choices = ['red', 'green', 'blue']
+    ids = store.create_random_cubes(
+        1000, (-50, 100), (200, 300), (15, 76), color_choices)
+    assert list(ids) == list(range(2, 1002))
+    assert len(store) == 1001
+    for id_ in ids:
+        x1, y1, x2, y2 = store.get_rect(id_)
+        assert -50 <= x1 < 100
+        assert 200 <= y1 < 300
+        assert 15 <= x2 - x1 < 76
+        assert store.get_color(id_) in color_choices
+    assert {store.color[id_ - 1] for id_ in ids} == \
+        {COLOR_INDICES[color] for color in color_choices}
+    assert list(store.z) == list(range(1001))
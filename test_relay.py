@@ -0,0 +1,113 @@
+import socket
+import sys
+
+import pytest
+
+from communicate import StreamFramer, encode_frame
+from relay import CubeGameRelay, get_app_args
+from test_server import Player
+
+
+@pytest.fixture
+def relay(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['relay.py'])
+    config = vars(get_app_args())
+    config.update(
+        server_address='unix://{}'.format(tmp_path / 'server.sock'),
+        relay_address='unix://{}'.format(tmp_path / 'relay.sock')
+    )
+    relay = CubeGameRelay(config)
+    yield relay
+    relay.close_all_sockets()
+
+
+# Один проход главных циклов сервера и ретранслятора.
+def pump(server, relay):
+    server.connect_to_clients()
+    server.receive_from_clients()
+    server.guide_players()
+    server.flush_outboxes()
+    relay.receive_from_server()
+    relay.connect_to_clients()
+    for addr in list(relay.conns_to_clients):
+        relay.receive_from_client(addr)
+    relay.flush_to_server()
+    relay.flush_outboxes()
+
+
+class Spectator:
+    def __init__(self, server, relay, tmp_path, join=True):
+        self.server = server
+        self.relay = relay
+        self.conn = socket.socket(socket.AF_UNIX)
+        self.conn.connect(str(tmp_path / 'relay.sock'))
+        self.conn.settimeout(0)
+        self.framer = StreamFramer(self.conn, 'relay')
+        pump(server, relay)
+        self.addr, = set(relay.conns_to_clients) - relay.spectators
+        if join:
+            self.send(
+                {'type': 'join', 'room': 'default', 'role': 'spectator'})
+
+    def send(self, msg):
+        self.conn.sendall(encode_frame(msg))
+        pump(self.server, self.relay)
+
+    def receive(self):
+        msgs, error = self.framer.receive()
+        assert isinstance(error, BlockingIOError)
+        return msgs
+
+    def receive_commands(self):
+        return [
+            msg['command']['type'] for msg in self.receive()
+            if msg['type'] == 'command'
+        ]
+
+
+@pytest.fixture
+def initialized_relay(server, relay):
+    for _ in range(3):
+        pump(server, relay)
+    assert relay.is_initialized()
+    return relay
+
+
+# Сообщения зрителя, которые нельзя обработать, не должны останавливать
+# ретранслятор и мешать остальным зрителям. Зритель, при обработке
+# сообщения которого возникло исключение, отключается.
+@pytest.mark.parametrize('msg, join, is_disconnected', [
+    ([1, 2, 3], True, False),
+    (None, True, False),
+    ({'type': ['join']}, True, False),
+    ({'type': 'unknown'}, False, False),
+    ({'type': 'error_msg'}, True, False),
+    (
+        {
+            'type': 'hello', 'protocol_versions': [[1]], 'codecs': [],
+            'compression': [], 'max_msg_size': 2 ** 20
+        },
+        False,
+        True
+    ),
+])
+def test_malformed_spectator_msg(
+        initialized_relay, server, tmp_path, msg, join, is_disconnected):
+    relay = initialized_relay
+    good = Spectator(server, relay, tmp_path)
+    assert good.receive_commands() == ['world_shape', 'add_cubes', 'bind_all']
+    bad = Spectator(server, relay, tmp_path, join=join)
+    bad.receive()
+    bad.send(msg)
+    assert (bad.addr not in relay.conns_to_clients) is is_disconnected
+    if not is_disconnected and msg != {'type': 'error_msg'}:
+        error, = bad.receive()
+        assert error['type'] == 'error_msg'
+
+    player = Player(server)
+    player.grab(1)
+    player.drag(5, 5)
+    player.room.tick()
+    pump(server, relay)
+    assert good.addr in relay.spectators
+    assert good.receive_commands() == ['delta']
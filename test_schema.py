@@ -0,0 +1,138 @@
+import pytest
+
+from schema import COMMAND_SCHEMAS, EVENT_SCHEMAS, MESSAGE_SCHEMAS, \
+    CLIENT_MSG_TYPES, INT32_RANGE, COORD_RANGE, find_schema, has_known_type
+
+
+VALID_COMMANDS = [
+    {
+        'type': 'add_cubes', 'version': 3,
+        'cubes': [(1, 10, 20, 45, 0, 0), (2, 10.5, 20, 45, 1, 1)]
+    },
+    {'type': 'add_cubes', 'version': 3, 'cubes': []},
+    {'type': 'remove_cube', 'id': 1},
+    {'type': 'delta', 'version': 3, 'base': 1, 'cubes': [(1, -5, 7)]},
+    {'type': 'world_shape', 'width': 800, 'height': 600},
+    {'type': 'bind_all'},
+    {
+        'type': 'input_ack', 'seq': 4, 'version': 3, 'id': 0, 'x': 1,
+        'y': 2
+    },
+]
+
+
+@pytest.mark.parametrize('command', VALID_COMMANDS)
+def test_valid_commands(command):
+    assert find_schema(COMMAND_SCHEMAS, command).is_valid(command)
+
+
+@pytest.mark.parametrize('command', [
+    {'type': 'remove_cube'},
+    {'type': 'remove_cube', 'id': 1, 'extra': 2},
+    {'type': 'remove_cube', 'id': '1'},
+    {'type': 'remove_cube', 'id': 1.0},
+    {'type': 'remove_cube', 'id': None},
+    {'type': 'remove_cube', 'id': 2 ** 31},
+    {'type': 'remove_cube', 'id': -2 ** 31 - 1},
+    {'type': 'world_shape', 'width': 800, 'height': 2 ** 40},
+    {'type': 'delta', 'version': 3, 'base': 1, 'cubes': None},
+    {'type': 'delta', 'version': 3, 'base': 1, 'cubes': ((1, 2, 3),)},
+    {'type': 'delta', 'version': 3, 'base': 1, 'cubes': [[1, 2, 3]]},
+    {'type': 'delta', 'version': 3, 'base': 1, 'cubes': [(1, 2)]},
+    {'type': 'delta', 'version': 3, 'base': 1, 'cubes': [(1, 2, 3, 4)]},
+    {'type': 'delta', 'version': 3, 'base': 1, 'cubes': [(1, 'x', 3)]},
+    {'type': 'delta', 'version': 3, 'base': 1, 'cubes': [(1, 2 ** 40, 3)]},
+    {'type': 'delta', 'version': 3, 'base': 1,
+     'cubes': [(1, 2, 3), (1.5, 2, 3)]},
+    {'type': 'delta', 'version': 3, 'base': 1,
+     'cubes': [(1, float('nan'), 3)]},
+    {'type': 'add_cubes', 'version': 3, 'cubes': [(1, 10, 20, 45, 0)]},
+    {'type': 'input_ack', 'seq': 4, 'version': 3, 'id': 0, 'x': 1},
+])
+def test_invalid_commands(command):
+    schema = find_schema(COMMAND_SCHEMAS, command)
+    assert not schema.is_valid(command)
+    assert repr(command['type']) in schema.explain(command)
+
+
+@pytest.mark.parametrize('value, is_valid', [
+    (INT32_RANGE[0], True),
+    (INT32_RANGE[1], True),
+    (INT32_RANGE[0] - 1, False),
+    (INT32_RANGE[1] + 1, False),
+    (2 ** 40, False),
+])
+def test_int32_range(value, is_valid):
+    command = {'type': 'remove_cube', 'id': value}
+    assert COMMAND_SCHEMAS['remove_cube'].is_valid(command) is is_valid
+
+
+@pytest.mark.parametrize('event_type', sorted(EVENT_SCHEMAS))
+@pytest.mark.parametrize('x, is_valid', [
+    (0, True),
+    (-7, True),
+    (COORD_RANGE[0], True),
+    (COORD_RANGE[1], True),
+    (COORD_RANGE[0] - 1, False),
+    (COORD_RANGE[1] + 1, False),
+    (2 ** 40, False),
+    (1.5, False),
+    ('1', False),
+    (None, False),
+])
+def test_event_coordinates(event_type, x, is_valid):
+    event = {'type': event_type, 'x': x, 'y': 0}
+    assert EVENT_SCHEMAS[event_type].is_valid(event) is is_valid
+    event = {'type': event_type, 'x': 0, 'y': x}
+    assert EVENT_SCHEMAS[event_type].is_valid(event) is is_valid
+
+
+@pytest.mark.parametrize('msg', [
+    {'type': 'motion', 'seq': 5, 'x': 2 ** 40, 'y': 0},
+    {'type': 'motion', 'seq': 2 ** 31, 'x': 0, 'y': 0},
+    {'type': 'motion', 'seq': 5, 'x': 0},
+    {'type': 'motion', 'seq': 5, 'x': 0, 'y': 0, 'z': 0},
+    {'type': 'viewport', 'x1': 0, 'y1': 0, 'x2': 2 ** 31, 'y2': 0},
+    {'type': 'viewport', 'x1': 0, 'y1': 0, 'x2': 1.5, 'y2': 0},
+])
+def test_invalid_client_messages(msg):
+    schema = MESSAGE_SCHEMAS[msg['type']]
+    assert not schema.is_valid(msg)
+    schema.explain(msg)
+
+
+def test_explain():
+    explanation = COMMAND_SCHEMAS['input_ack'].explain(
+        {'type': 'input_ack', 'seq': 2 ** 40, 'version': '3', 'id': 0,
+         'x': 1, 'z': 2})
+    assert "Лишние ключи: ['z']" in explanation
+    assert "Недостающие ключи: ['y']" in explanation
+    assert "значениями: ['seq', 'version']" in explanation
+    assert 'словарем' in COMMAND_SCHEMAS['bind_all'].explain(['bind_all'])
+
+
+@pytest.mark.parametrize('msg', [
+    None,
+    [],
+    {},
+    {'type': None},
+    {'type': ['add_cubes']},
+    {'type': 'unknown'},
+])
+def test_find_schema_without_schema(msg):
+    assert find_schema(COMMAND_SCHEMAS, msg) is None
+
+
+@pytest.mark.parametrize('msg, is_known', [
+    ({'type': 'join'}, True),
+    ({'type': 'event', 'event': None}, True),
+    ({'type': 'unknown'}, False),
+    ({'type': ['join']}, False),
+    ({'type': 5}, False),
+    ({}, False),
+    (['join'], False),
+    ('join', False),
+    (None, False),
+])
+def test_has_known_type(msg, is_known):
+    assert has_known_type(msg, CLIENT_MSG_TYPES) is is_known
@@ -0,0 +1,271 @@
+import os
+import resource
+import socket
+
+import pytest
+
+from communicate import StreamFramer, encode_frame, quantize_coord, \
+    MAX_ROOM_NAME_LENGTH
+from server import CubeGameServer
+from shared_world import get_shm_block_name, MAX_SHM_BLOCK_NAME_LENGTH, \
+    MAX_SHM_NAME_LENGTH
+
+
+FD_SETSIZE = 1024
+
+
+# Игрок, подключенный к серверу через `socket.socketpair()`. Сервер
+# обрабатывает сообщения игрока сразу после отправки, без главного цикла.
+class Player:
+    def __init__(self, server, room='default'):
+        self.server = server
+        addrs = set(server.conns_to_clients)
+        self.conn = server.connect_local_player()
+        self.conn.settimeout(0)
+        self.addr, = set(server.conns_to_clients) - addrs
+        self.framer = StreamFramer(self.conn, self.addr)
+        self.send({'type': 'join', 'room': room})
+        self.receive()
+
+    @property
+    def room(self):
+        return self.server.players_rooms[self.addr]
+
+    @property
+    def cube_canvas(self):
+        return self.room.main_frame.cube_canvas
+
+    def send(self, msg):
+        self.conn.sendall(encode_frame(msg))
+        self.server.receive_from_clients()
+        self.server.guide_players()
+
+    def receive(self):
+        self.server.flush_outboxes()
+        msgs, error = self.framer.receive()
+        assert isinstance(error, BlockingIOError)
+        return msgs
+
+    def receive_commands(self, command_type):
+        return [
+            msg['command'] for msg in self.receive()
+            if msg['type'] == 'command'
+            and msg['command']['type'] == command_type
+        ]
+
+    def send_event(self, event_type, x, y):
+        self.send({
+            'type': 'event',
+            'event': {'type': event_type, 'x': x, 'y': y}
+        })
+
+    # Хватает кубик за середину и возвращает id схваченного кубика.
+    def grab(self, id_):
+        x1, y1, x2, y2 = self.cube_canvas.cubes.get_rect(id_)
+        self.point = ((x1 + x2) // 2, (y1 + y2) // 2)
+        self.send_event('<Button-1>', *self.point)
+        return self.cube_canvas.grabbed_cubes_ids[self.addr]
+
+    def drag(self, dx, dy):
+        self.point = (self.point[0] + dx, self.point[1] + dy)
+        self.send_event('<B1-Motion>', *self.point)
+
+    def release(self):
+        self.send_event('<ButtonRelease-1>', *self.point)
+
+
+def get_quantized_coords(cube_canvas, id_):
+    store = cube_canvas.cubes
+    return (
+        id_,
+        quantize_coord(store.x[id_ - 1]),
+        quantize_coord(store.y[id_ - 1])
+    )
+
+
+def test_no_delta_without_moves(server):
+    player = Player(server)
+    player.room.tick()
+    assert player.receive() == []
+
+
+# Пока игрок не подтвердил получение, каждое новое сообщение 'delta'
+# строится относительно последней подтвержденной версии мира.
+def test_delta_base_is_acked_version(server):
+    player = Player(server)
+    room, cube_canvas = player.room, player.cube_canvas
+    id_ = player.grab(1)
+    player.drag(10, 5)
+    room.tick()
+    delta, = player.receive_commands('delta')
+    assert (delta['base'], delta['version']) == (0, 1)
+    assert delta['cubes'] == [get_quantized_coords(cube_canvas, id_)]
+
+    player.drag(10, 5)
+    room.tick()
+    delta, = player.receive_commands('delta')
+    assert (delta['base'], delta['version']) == (0, 2)
+    assert delta['cubes'] == [get_quantized_coords(cube_canvas, id_)]
+
+    player.send({'type': 'ack', 'version': 2})
+    assert room.acked_versions[player.addr] == 2
+    player.drag(10, 5)
+    room.tick()
+    delta, = player.receive_commands('delta')
+    assert (delta['base'], delta['version']) == (2, 3)
+
+
+# Сообщение 'delta' содержит все кубики, сдвинутые после подтвержденной
+# версии, и только их.
+def test_delta_contains_cubes_moved_after_base(server):
+    player = Player(server)
+    room, cube_canvas = player.room, player.cube_canvas
+    first_id = player.grab(1)
+    player.drag(3, 0)
+    player.release()
+    room.tick()
+    player.receive()
+    player.send({'type': 'ack', 'version': 1})
+
+    second_id = player.grab(next(
+        id_ for id_ in cube_canvas.cubes.ids() if id_ != first_id))
+    assert second_id != first_id
+    player.drag(0, 3)
+    room.tick()
+    delta, = player.receive_commands('delta')
+    assert delta['base'] == 1
+    assert delta['cubes'] == [get_quantized_coords(cube_canvas, second_id)]
+
+    player.send({'type': 'ack', 'version': 0})
+    assert room.acked_versions[player.addr] == 1
+    player.release()
+    first_id = player.grab(first_id)
+    player.drag(3, 0)
+    room.tick()
+    delta, = player.receive_commands('delta')
+    assert (delta['base'], delta['version']) == (1, 3)
+    assert sorted(delta['cubes']) == sorted([
+        get_quantized_coords(cube_canvas, first_id),
+        get_quantized_coords(cube_canvas, second_id)
+    ])
+
+
+@pytest.mark.parametrize('version', [2, -1, 1.0, '1', None])
+def test_ack_of_unsent_version(server, version):
+    player = Player(server)
+    player.grab(1)
+    player.drag(1, 1)
+    player.room.tick()
+    player.receive()
+    player.send({'type': 'ack', 'version': version})
+    assert player.room.acked_versions[player.addr] == 0
+    error, = player.receive()
+    assert error['type'] == 'error_msg'
+
+
+# Игрокам с одинаковой подтвержденной версией отправляется одно и то же
+# закодированное сообщение.
+def test_delta_frame_is_shared(server):
+    players = [Player(server) for _ in range(3)]
+    room = players[0].room
+    players[0].grab(1)
+    players[0].drag(1, 1)
+    room.tick()
+    players[0].receive()
+    players[1].send({'type': 'ack', 'version': 1})
+    players[0].drag(1, 1)
+    room.tick()
+    frames = [server.outboxes[player.addr].frames[-1][0]
+              for player in players]
+    assert frames[0] is frames[2]
+    assert frames[1] is not frames[0]
+    assert [player.receive_commands('delta')[-1]['base']
+            for player in players] == [0, 1, 0]
+
+
+def test_make_delta_msg_with_ids(server):
+    player = Player(server)
+    room, cube_canvas = player.room, player.cube_canvas
+    first_id = player.grab(1)
+    player.drag(3, 0)
+    player.release()
+    second_id = player.grab(next(
+        id_ for id_ in cube_canvas.cubes.ids() if id_ != first_id))
+    player.drag(0, 3)
+    room.tick()
+    command = cube_canvas.make_delta_msg(0, ids={second_id})['command']
+    assert command['cubes'] == [get_quantized_coords(cube_canvas, second_id)]
+    assert cube_canvas.make_delta_msg(0, ids=set())['command']['cubes'] == []
+    assert cube_canvas.make_delta_msg(1)['command']['cubes'] == []
+
+
+# Длина имени блока разделяемой памяти не зависит от длины названия
+# комнаты в кодировке UTF-8.
+def test_shm_block_name_of_long_room_name(server_config):
+    shm_name = 'cube-test-{}'.format(os.getpid())
+    room_name = 'я' * MAX_ROOM_NAME_LENGTH
+    server = CubeGameServer(dict(server_config, shm_name=shm_name))
+    try:
+        player = Player(server, room_name)
+        assert player.room.name == room_name
+        publisher = player.cube_canvas.publisher
+        block_name = get_shm_block_name(shm_name, room_name)
+        assert publisher.shm.name.lstrip('/') == block_name
+        assert block_name != get_shm_block_name(shm_name, room_name[1:])
+    finally:
+        server.close_all_sockets()
+    block_name = get_shm_block_name('s' * MAX_SHM_NAME_LENGTH, room_name)
+    assert len(block_name) == MAX_SHM_BLOCK_NAME_LENGTH
+
+
+@pytest.mark.parametrize('shm_name', ['', 's' * (MAX_SHM_NAME_LENGTH + 1)])
+def test_shm_name_length(server_config, shm_name):
+    with pytest.raises(ValueError):
+        CubeGameServer(dict(server_config, shm_name=shm_name))
+
+
+# Движок 'polling' должен рассылать сообщения игрокам, номера дескрипторов
+# сокетов которых не меньше FD_SETSIZE.
+def test_flush_outboxes_with_large_fd(server):
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit <= FD_SETSIZE:
+        pytest.skip("Нельзя открыть дескриптор с номером от FD_SETSIZE.")
+    player = Player(server)
+    conn = server.conns_to_clients[player.addr]
+    large_fd = os.dup2(conn.fileno(), FD_SETSIZE)
+    large_conn = socket.socket(fileno=large_fd)
+    conn.close()
+    server.conns_to_clients[player.addr] = large_conn
+    server.framers[player.addr].conn = large_conn
+    server.outboxes[player.addr].conn = large_conn
+    player.send({'type': 'ack', 'version': 1})
+    error, = player.receive()
+    assert error['type'] == 'error_msg'
+
+
+# Если видимые игроку кубики не сдвигаются, базовая версия игрока
+# сдвигается вместе с версией мира, и сообщения 'delta' ему не
+# отправляются.
+def test_base_of_player_without_visible_moves(server):
+    mover, idle = Player(server), Player(server)
+    room, cube_canvas = mover.room, mover.cube_canvas
+    idle.send({
+        'type': 'viewport', 'x1': 10000, 'y1': 10000, 'x2': 10100,
+        'y2': 10100
+    })
+    assert len(idle.receive_commands('remove_cube')) == 3
+    mover.grab(1)
+    for _ in range(3):
+        mover.drag(1, 1)
+        room.tick()
+        assert room.acked_versions[idle.addr] == cube_canvas.version
+        assert room.sent_versions[idle.addr] == cube_canvas.version
+    assert idle.receive() == []
+
+    idle.send(
+        {'type': 'viewport', 'x1': 0, 'y1': 0, 'x2': 800, 'y2': 600})
+    assert len(idle.receive_commands('add_cubes')) == 1
+    mover.drag(1, 1)
+    room.tick()
+    delta, = idle.receive_commands('delta')
+    assert (delta['base'], delta['version']) == (3, 4)
@@ -0,0 +1,142 @@
+import math
+import random
+
+import pytest
+
+from spatial import UniformGrid
+
+
+CELL_SIZE = 50
+
+
+# Индекс со случайными прямоугольниками и словарь их координат, по
+# которому результаты запросов проверяются перебором.
+def make_grid(seed, num_rects=300, span=2000):
+    rng = random.Random(seed)
+    rects = {}
+    grid = UniformGrid(CELL_SIZE, rects.__getitem__)
+    for id_ in range(1, num_rects + 1):
+        rects[id_] = make_rect(rng, span)
+        grid.insert(id_, *rects[id_])
+    return grid, rects, rng
+
+
+def make_rect(rng, span):
+    x, y = rng.randint(-span, span), rng.randint(-span, span)
+    size = rng.randint(0, CELL_SIZE)
+    return x, y, x + size, y + size
+
+
+def brute_force_rect(rects, x1, y1, x2, y2):
+    return sorted(
+        id_ for id_, (rx1, ry1, rx2, ry2) in rects.items()
+        if rx1 <= x2 and x1 <= rx2 and ry1 <= y2 and y1 <= ry2
+    )
+
+
+def brute_force_distance(rects, x, y):
+    return min(
+        (
+            math.hypot(max(x1 - x, 0, x - x2), max(y1 - y, 0, y - y2))
+            for x1, y1, x2, y2 in rects.values()
+        ),
+        default=None
+    )
+
+
+# Индекс меняется так же, как в игре: прямоугольники сдвигаются на
+# небольшие расстояния, удаляются и добавляются.
+def shuffle_rects(grid, rects, rng, num_changes=300):
+    for _ in range(num_changes):
+        id_ = rng.choice(list(rects))
+        action = rng.random()
+        if action < 0.8:
+            old_rect = rects[id_]
+            dx, dy = rng.randint(-80, 80), rng.randint(-80, 80)
+            rects[id_] = (
+                old_rect[0] + dx, old_rect[1] + dy,
+                old_rect[2] + dx, old_rect[3] + dy
+            )
+            grid.move(id_, old_rect, rects[id_])
+        elif action < 0.9:
+            grid.remove(id_, *rects.pop(id_))
+        else:
+            new_id = max(rects, default=0) + 1
+            rects[new_id] = make_rect(rng, 2000)
+            grid.insert(new_id, *rects[new_id])
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('shuffled', [False, True])
+def test_query_rect(seed, shuffled):
+    grid, rects, rng = make_grid(seed)
+    if shuffled:
+        shuffle_rects(grid, rects, rng)
+    for _ in range(200):
+        x1, y1 = rng.randint(-2500, 2500), rng.randint(-2500, 2500)
+        w, h = rng.randint(0, 600), rng.randint(0, 600)
+        query = (x1, y1, x1 + w, y1 + h)
+        assert sorted(grid.query_rect(*query)) == \
+            brute_force_rect(rects, *query)
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('shuffled', [False, True])
+def test_query_point(seed, shuffled):
+    grid, rects, rng = make_grid(seed)
+    if shuffled:
+        shuffle_rects(grid, rects, rng)
+    for _ in range(200):
+        x, y = rng.uniform(-2100, 2100), rng.uniform(-2100, 2100)
+        assert sorted(grid.query_point(x, y)) == \
+            brute_force_rect(rects, x, y, x, y)
+    # Точки на границе принадлежат прямоугольнику.
+    for id_, (x1, y1, x2, y2) in rects.items():
+        assert id_ in grid.query_point(x2, y2)
+
+
+# При равных расстояниях `nearest()` может вернуть любой из ближайших
+# прямоугольников, поэтому сравниваются расстояния.
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('shuffled', [False, True])
+def test_nearest(seed, shuffled):
+    grid, rects, rng = make_grid(seed, num_rects=100)
+    if shuffled:
+        shuffle_rects(grid, rects, rng)
+    for _ in range(200):
+        # Часть точек лежит далеко за пределами прямоугольников.
+        x, y = rng.uniform(-4000, 4000), rng.uniform(-4000, 4000)
+        id_ = grid.nearest(x, y)
+        assert grid.get_distance(id_, x, y) == \
+            pytest.approx(brute_force_distance(rects, x, y))
+
+
+def test_nearest_max_distance():
+    grid, rects, rng = make_grid(0, num_rects=50)
+    for _ in range(200):
+        x, y = rng.uniform(-2500, 2500), rng.uniform(-2500, 2500)
+        max_distance = rng.uniform(0, 300)
+        id_ = grid.nearest(x, y, max_distance)
+        distance = brute_force_distance(rects, x, y)
+        if distance > max_distance:
+            assert id_ is None
+        else:
+            assert grid.get_distance(id_, x, y) == pytest.approx(distance)
+
+
+def test_empty_grid():
+    rects = {1: (0, 0, 10, 10)}
+    grid = UniformGrid(CELL_SIZE, rects.__getitem__)
+    assert grid.nearest(5, 5) is None
+    assert grid.query_rect(-100, -100, 100, 100) == []
+    assert grid.is_covered_by(0, 0, 0, 0)
+    grid.insert(1, *rects[1])
+    grid.remove(1, *rects[1])
+    assert grid.cells == {}
+    assert grid.nearest(5, 5) is None
+
+
+def test_is_covered_by():
+    grid, rects, rng = make_grid(0)
+    assert grid.is_covered_by(-3000, -3000, 3000, 3000)
+    assert not grid.is_covered_by(-1000, -3000, 3000, 3000)
@@ -0,0 +1,143 @@
+import itertools
+import os
+import socket
+import stat
+
+
+# Адрес соединения задается строкой со схемой:
+# 'tcp://HOST:PORT' -- TCP, HOST может быть пустым, тогда сервер принимает
+# подключения на всех интерфейсах;
+# 'unix://PATH' -- сокет Unix (AF_UNIX) для программ на той же машине,
+# например, ботов и ретранслятора. Такое соединение быстрее TCP через
+# loopback: данные не проходят через сетевой стек.
+# Программы в одном процессе, например, тесты, могут соединяться через
+# `socket.socketpair()` (см. `CubeGameServer.connect_local_player()`).
+SCHEMES = ['tcp', 'unix']
+
+# Адреса корреспондентов, подключившихся через сокеты Unix, пусты, поэтому
+# им присваиваются адреса ('unix', n) с номером подключения.
+LOCAL_ADDR_NAME = 'unix'
+local_addr_numbers = itertools.count(1)
+
+
+def make_tcp_address(host, port):
+    return 'tcp://{}:{}'.format(host, port)
+
+
+# Возвращает семейство сокета и адрес в виде, принимаемом методами
+# `socket.bind()` и `socket.connect()`. Если адрес неверен, возбуждается
+# `ValueError`.
+def parse_address(address):
+    scheme, sep, target = address.partition('://')
+    if not sep or scheme not in SCHEMES:
+        raise ValueError(
+            "Адрес должен начинаться с одной из схем {}, в то время как "
+            "address = {}".format(
+                ["{}://".format(scheme) for scheme in SCHEMES],
+                repr(address))
+        )
+    if scheme == 'unix':
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError(
+                "Сокеты Unix не поддерживаются в этой системе.\n"
+                "address = {}".format(repr(address)))
+        if not target:
+            raise ValueError(
+                "В адресе сокета Unix не указан путь, в то время как "
+                "address = {}".format(repr(address)))
+        return socket.AF_UNIX, target
+    host, sep, port = target.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError(
+            "Адрес TCP должен иметь вид 'tcp://HOST:PORT', в то время как "
+            "address = {}".format(repr(address)))
+    return socket.AF_INET, (host, int(port))
+
+
+# Удаляет файл сокета Unix, оставшийся от завершившегося процесса. Если
+# сокет принимает подключения, файл не удаляется, и `socket.bind()`
+# сообщит, что адрес занят.
+def remove_stale_unix_socket(path):
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    probe = socket.socket(socket.AF_UNIX)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+    finally:
+        probe.close()
+
+
+def listen(address, backlog):
+    family, sockaddr = parse_address(address)
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        remove_stale_unix_socket(sockaddr)
+    listener.settimeout(0)
+    listener.bind(sockaddr)
+    listener.listen(min(backlog, socket.SOMAXCONN))
+    return listener
+
+
+# Закрывает сокет, созданный `listen()`. Файл сокета Unix удаляет только
+# владелец сокета: копии сокета в дочерних процессах закрываются с
+# `remove_file=False`.
+def close_listener(listener, remove_file=True):
+    path = None
+    if remove_file and listener.family == getattr(socket, 'AF_UNIX', None):
+        path = listener.getsockname()
+    listener.close()
+    if path:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+# Создает сокет для неблокирующего подключения по адресу `address`.
+# Возвращает сокет и адрес для `socket.connect()`.
+def create_client_socket(address):
+    family, sockaddr = parse_address(address)
+    conn = socket.socket(family, socket.SOCK_STREAM)
+    conn.settimeout(0)
+    return conn, sockaddr
+
+
+# Устанавливает соединение, блокируя выполнение программы.
+def create_connection(address):
+    family, sockaddr = parse_address(address)
+    if family == socket.AF_INET:
+        return socket.create_connection(sockaddr)
+    conn = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        conn.connect(sockaddr)
+    except OSError:
+        conn.close()
+        raise
+    return conn
+
+
+# Адрес сервера `address` в виде кортежа, которым программа обозначает
+# корреспондентов в словарях и предупреждениях.
+def get_addr(address):
+    family, sockaddr = parse_address(address)
+    if family == socket.AF_INET:
+        return sockaddr
+    return LOCAL_ADDR_NAME, sockaddr
+
+
+# Адрес корреспондента, по которому его различают словари программы.
+# `addr` -- адрес, возвращенный `socket.accept()` или `getpeername()`.
+def get_peer_addr(addr):
+    if isinstance(addr, tuple):
+        return addr
+    return LOCAL_ADDR_NAME, next(local_addr_numbers)
+
+
+def accept(listener):
+    conn, addr = listener.accept()
+    return conn, get_peer_addr(addr)